@@ -1,8 +1,13 @@
 import streamlit as st
 import pandas as pd
 from datetime import datetime, date, timedelta
-from database import Database
-from messaging import MessagingService
+from caching import CachedDatabase, get_database, get_marked_days, get_messaging_service
+from delivery import reconcile_deliveries
+from exports import XLSX_MIME, payroll_workbook_name, write_payroll_workbook
+from messaging import MESSAGING_RATE, OUTBOX_WORKERS
+from payroll import ABSENT, HOLIDAY, LEAVE, PRESENT, STATUS_LABELS, UNMARKED
+from payslips import write_payslips_zip
+from trends import attendance_trend, trend_figure
 import calendar
 import plotly.express as px
 import plotly.graph_objects as go
@@ -10,9 +15,9 @@ from streamlit_option_menu import option_menu
 import secrets
 import io
 
-# Initialize database and messaging service
-db = Database()
-messaging = MessagingService()
+# Shared database and messaging service; database reads are cached until the next write
+db = CachedDatabase(get_database())
+messaging = get_messaging_service()
 
 # Session state initialization
 if 'authenticated' not in st.session_state:
@@ -582,27 +587,30 @@ def main_app():
     elif selected == "Settings":
         render_settings()
 
+# Staff listed under the dashboard's outstanding amounts
+DASHBOARD_OUTSTANDING_ROWS = 10
+
+# Attendance trend ranges on the dashboard, in days
+TREND_RANGES = {
+    "Last 90 Days": 90,
+    "Last Year": 365,
+    "Last 3 Years": 3 * 365,
+}
+
 def render_dashboard():
     st.title("Dashboard")
     
-    # Get all non-hidden staff
-    staff_df = db.get_all_staff()
-    staff_ids = set(staff_df['id'])
-    
-    # Get today's attendance and filter to non-hidden staff
-    today_attendance = db.get_attendance(date.today())
-    today_attendance = today_attendance[today_attendance['id'].isin(staff_ids)]
-    present_count = len(today_attendance[today_attendance['is_present']]) if not today_attendance.empty else 0
-    total_count = len(today_attendance) if not today_attendance.empty else 1  # Prevent division by zero
+    # Figures come from counters kept current on every write
+    stats = db.get_dashboard_stats()
+    present_count = stats['present_today']
+    total_count = stats['total_staff']
     attendance_percentage = (present_count/total_count)*100 if total_count > 0 else 0
     
-    # Get staff outstanding amounts
-    outstanding_df = db.get_staff_outstanding()
-    outstanding_df = outstanding_df[outstanding_df['id'].isin(staff_ids)]
-    total_outstanding = outstanding_df['outstanding'].sum() if not outstanding_df.empty else 0
+    # Largest outstanding amounts; the total covers every staff member
+    outstanding_df = db.get_staff_outstanding(limit=DASHBOARD_OUTSTANDING_ROWS)
     
     # Display metrics
-    col1, col2, col3 = st.columns(3)
+    col1, col2, col3, col4 = st.columns(4)
     
     with col1:
         render_metric_card(
@@ -615,7 +623,7 @@ def render_dashboard():
     with col2:
         render_metric_card(
             "Total Staff",
-            str(len(staff_df)),
+            str(total_count),
             "👨‍💼",
             color="#1976d2"
         )
@@ -623,14 +631,22 @@ def render_dashboard():
     with col3:
         render_metric_card(
             "Total Outstanding",
-            f"₹{total_outstanding:,.2f}",
+            f"₹{stats['total_outstanding']:,.2f}",
             "💰",
             color="#d32f2f"
         )
     
+    with col4:
+        render_metric_card(
+            "This Month's Payroll",
+            f"₹{stats['total_salary']:,.2f}",
+            "🧾",
+            color="#6a1b9a"
+        )
+    
     # Display staff with outstanding amounts
     if not outstanding_df.empty:
-        st.subheader("Staff with Outstanding Amounts")
+        st.subheader("Largest Outstanding Amounts")
         st.dataframe(
             outstanding_df[['name', 'total_advance', 'total_paid', 'outstanding']],
             hide_index=True,
@@ -651,11 +667,69 @@ def render_dashboard():
             }
         )
     
+    # Rolling attendance rates; long ranges come back downsampled
+    st.subheader("Attendance Trends")
+    staff_df = db.get_all_staff()
+    col1, col2 = st.columns(2)
+    with col1:
+        trend_range = st.selectbox("Range", list(TREND_RANGES), key="trend_range")
+    with col2:
+        trend_staff = st.selectbox(
+            "Staff",
+            [None] + staff_df['id'].tolist(),
+            format_func=lambda x: "All Staff" if x is None else staff_df[staff_df['id'] == x]['name'].iloc[0],
+            key="trend_staff"
+        )
+    trend_end = date.today()
+    trend = attendance_trend(
+        db, trend_end - timedelta(days=TREND_RANGES[trend_range] - 1), trend_end, staff_id=trend_staff
+    )
+    st.plotly_chart(trend_figure(trend), use_container_width=True)
+    
     # Recent Activity section
     st.markdown("""
         <h3>Recent Activity</h3>
     """, unsafe_allow_html=True)
 
+# Heatmap colour per attendance status code on the overview tab
+CALENDAR_COLORS = {
+    UNMARKED: "#eeeeee",
+    ABSENT: "#d32f2f",
+    PRESENT: "#2e7d32",
+    LEAVE: "#ff9800",
+    HOLIDAY: "#1976d2",
+}
+
+def render_attendance_heatmap(cal):
+    codes = sorted(CALENDAR_COLORS)
+    # Stepped colourscale: each integer code gets a solid band
+    colorscale = []
+    for i, code in enumerate(codes):
+        colorscale.append([i / len(codes), CALENDAR_COLORS[code]])
+        colorscale.append([(i + 1) / len(codes), CALENDAR_COLORS[code]])
+    labels = [STATUS_LABELS[code] or "Unmarked" for code in codes]
+
+    fig = go.Figure(go.Heatmap(
+        z=cal.status,
+        x=cal.day_labels,
+        y=[f"{name} (#{staff_id})" for staff_id, name in zip(cal.staff_ids, cal.names)],
+        customdata=[[labels[code] for code in row] for row in cal.status.tolist()],
+        hovertemplate="%{y}<br>%{x}: %{customdata}<extra></extra>",
+        zmin=codes[0] - 0.5,
+        zmax=codes[-1] + 0.5,
+        colorscale=colorscale,
+        xgap=1,
+        ygap=1,
+        colorbar=dict(tickvals=codes, ticktext=labels),
+    ))
+    fig.update_layout(
+        height=min(max(300, 22 * len(cal.staff_ids) + 120), 1200),
+        margin=dict(l=10, r=10, t=10, b=10),
+        yaxis=dict(autorange="reversed"),
+        xaxis=dict(side="top"),
+    )
+    st.plotly_chart(fig, use_container_width=True)
+
 def render_attendance():
     st.title("Attendance Management")
     try:
@@ -789,11 +863,11 @@ def render_attendance():
                     submitted = st.form_submit_button("Save Attendance", use_container_width=True)
                     
                     if submitted:
-                        for _, staff in attendance_df.iterrows():
-                            status = st.session_state[f"status_{staff['id']}"]
-                            is_present = status == "Present"
-                            is_holiday = status == "Holiday"
-                            db.mark_attendance(staff['id'], selected_date, is_present, is_holiday)
+                        rows = []
+                        for staff_id in attendance_df['id']:
+                            status = st.session_state[f"status_{staff_id}"]
+                            rows.append((staff_id, selected_date, status == "Present", status == "Holiday"))
+                        db.mark_attendance_bulk(rows)
                         
                         st.success("Attendance saved successfully!")
                         st.rerun()
@@ -801,6 +875,47 @@ def render_attendance():
                     st.markdown("</div>", unsafe_allow_html=True)
             else:
                 st.info("No staff members found for attendance on this date.")
+        with tab2:
+            col1, col2 = st.columns(2)
+            with col1:
+                overview_year = st.selectbox(
+                    "Year",
+                    options=range(date.today().year-1, date.today().year+2),
+                    index=1,
+                    key="overview_year"
+                )
+            with col2:
+                overview_month = st.selectbox(
+                    "Month",
+                    options=range(1, 13),
+                    format_func=lambda x: calendar.month_name[x],
+                    index=date.today().month-1,
+                    key="overview_month"
+                )
+
+            cal = db.get_attendance_calendar(overview_year, overview_month)
+            if len(cal.staff_ids):
+                present = cal.counts(PRESENT).sum()
+                marked = present + cal.counts(ABSENT).sum() + cal.counts(LEAVE).sum()
+                col1, col2, col3 = st.columns(3)
+                with col1:
+                    render_metric_card("Staff", str(len(cal.staff_ids)), "group", "#1976d2")
+                with col2:
+                    render_metric_card(
+                        "Attendance Rate",
+                        f"{present / marked * 100:.1f}%" if marked else "-",
+                        "check_circle",
+                        "#2e7d32"
+                    )
+                with col3:
+                    render_metric_card("Holidays", str(len(cal.holidays)), "beach_access", "#ff9800")
+
+                render_attendance_heatmap(cal)
+                for day, name in sorted(cal.holidays.items()):
+                    st.caption(f"{cal.day_labels[day - 1]}: {name}")
+            else:
+                st.info("No staff members found.")
+
         # --- Long Holiday/Leave Section (now below attendance) ---
         st.markdown("""
             <div class="dashboard-card">
@@ -832,10 +947,11 @@ def render_attendance():
                         st.error("Start date cannot be after end date.")
                     else:
                         is_holiday = leave_type == "Paid Holiday"
-                        current = start_date
-                        while current <= end_date:
-                            db.mark_attendance(staff_id, current, is_present=False, is_holiday=is_holiday)
-                            current += timedelta(days=1)
+                        num_days = (end_date - start_date).days + 1
+                        db.mark_attendance_bulk([
+                            (staff_id, start_date + timedelta(days=i), False, is_holiday)
+                            for i in range(num_days)
+                        ])
                         st.success(f"Marked {leave_type.lower()} for {staff_df[staff_df['id'] == staff_id]['name'].iloc[0]} from {start_date} to {end_date}.")
         else:
             st.info("No staff members found.")
@@ -857,8 +973,8 @@ def render_staff_management():
             phone = st.text_input("Phone Number")
             monthly_salary = st.number_input("Monthly Salary", min_value=0.0, step=100.0)
         with col2:
-            salary_cycle_start = st.date_input("Salary Cycle Start Date")
-            salary_cycle_end = st.date_input("Salary Cycle End Date")
+            salary_cycle_start = st.number_input("Salary Cycle Start Day", min_value=1, max_value=31, value=1)
+            salary_cycle_end = st.number_input("Salary Cycle End Day", min_value=1, max_value=31, value=31)
         
         submit = st.form_submit_button("Add Staff")
         if submit:
@@ -1111,13 +1227,168 @@ def render_advance_payments():
     
     st.markdown("</div>", unsafe_allow_html=True)
 
+REPORT_RANGE_PRESETS = {
+    "Last Quarter": "quarter",
+    "Financial Year": "financial_year",
+    "Trailing 12 Months": "trailing",
+    "Custom": "custom",
+}
+
+GRANULARITY_LABELS = {
+    "month": "Month",
+    "quarter": "Quarter",
+    "year": "Year",
+    "financial_year": "Financial Year",
+    "total": "Whole Range",
+}
+
+def report_range_dates(preset, today):
+    """Default start and end dates for a range report preset."""
+    this_month = today.replace(day=1)
+    if preset == "quarter":
+        quarter_start = this_month.replace(month=3 * ((today.month - 1) // 3) + 1)
+        end = quarter_start - timedelta(days=1)
+        return end.replace(day=1, month=end.month - 2), end
+    if preset == "financial_year":
+        fy_start_year = today.year if today.month >= 4 else today.year - 1
+        return date(fy_start_year, 4, 1), date(fy_start_year + 1, 3, 31)
+    start = this_month.replace(year=this_month.year - 1)
+    return start, this_month - timedelta(days=1)
+
+def render_range_report():
+    col1, col2 = st.columns(2)
+    with col1:
+        preset = st.selectbox("Range", options=list(REPORT_RANGE_PRESETS), key="report_range_preset")
+    with col2:
+        granularity = st.selectbox(
+            "Group By",
+            options=list(GRANULARITY_LABELS),
+            format_func=GRANULARITY_LABELS.get,
+            key="report_granularity"
+        )
+
+    default_start, default_end = report_range_dates(REPORT_RANGE_PRESETS[preset], date.today())
+    if REPORT_RANGE_PRESETS[preset] == "custom":
+        col1, col2 = st.columns(2)
+        with col1:
+            start_date = st.date_input("Start Date", value=default_start, key="report_range_start")
+        with col2:
+            end_date = st.date_input("End Date", value=default_end, key="report_range_end")
+        if end_date < start_date:
+            st.error("End date must be on or after the start date")
+            return
+    else:
+        start_date, end_date = default_start, default_end
+        st.caption(f"{start_date.strftime('%d %b %Y')} to {end_date.strftime('%d %b %Y')}")
+
+    report_df = db.get_report_range(start_date, end_date, granularity)
+    if report_df.empty:
+        st.info("No data available for the selected range")
+        return
+
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        st.metric("Total Salary", f"₹{report_df['calculated_salary'].sum():,.2f}")
+    with col2:
+        st.metric("Total Advances", f"₹{report_df['total_advance'].sum():,.2f}")
+    with col3:
+        st.metric("Final Payout", f"₹{report_df['final_salary'].sum():,.2f}")
+
+    st.markdown("<br>", unsafe_allow_html=True)
+    st.dataframe(
+        report_df,
+        hide_index=True,
+        column_config={
+            "id": None,
+            "period_start": None,
+            "period_end": None,
+            "period": GRANULARITY_LABELS[granularity],
+            "name": "Staff Name",
+            "monthly_salary": st.column_config.NumberColumn(
+                "Monthly Salary",
+                format="₹%.2f"
+            ),
+            "days_present": "Days Present",
+            "working_days": "Working Days",
+            "calculated_salary": st.column_config.NumberColumn(
+                "Calculated Salary",
+                format="₹%.2f"
+            ),
+            "total_advance": st.column_config.NumberColumn(
+                "Advance Deduction",
+                format="₹%.2f"
+            ),
+            "final_salary": st.column_config.NumberColumn(
+                "Final Salary",
+                format="₹%.2f"
+            )
+        },
+        use_container_width=True
+    )
+
+def render_send_progress(batch):
+    """Show a message batch's progress as of this run.
+
+    Never waits for the outbox: retries can back off for minutes, so the
+    user refreshes while messages are still waiting.
+    """
+    progress = db.get_outbox_progress(batch)
+    total = sum(progress.values())
+    done = progress['sent'] + progress['failed']
+    st.progress(done / total if total else 1.0)
+    st.caption(f"{progress['sent']} sent, {progress['failed']} failed, {total - done} waiting")
+    if done < total:
+        # Any button press reruns the page with fresh counts
+        st.button("Refresh", key="send_progress_refresh", use_container_width=True)
+
+    failures = db.get_outbox_failures(batch)
+    if not failures.empty:
+        st.dataframe(
+            failures[['name', 'to_number', 'error']],
+            hide_index=True,
+            column_config={"name": "Staff Name", "to_number": "Phone", "error": "Error"},
+            use_container_width=True
+        )
+
+    # Delivery statuses arrive by status callback, or in bulk on request
+    if messaging.is_configured() and st.button("Check Delivery Status", use_container_width=True):
+        with st.spinner("Checking delivery status..."):
+            reconcile_deliveries(db, messaging.transport)
+    summary = db.get_delivery_summary(batch)
+    if summary:
+        st.caption("Delivery: " + ", ".join(f"{count} {status}" for status, count in summary.items()))
+    undelivered = db.get_message_log(batch, ['undelivered', 'failed'])
+    if not undelivered.empty:
+        st.dataframe(
+            undelivered[['name', 'to_number', 'status', 'error_code']],
+            hide_index=True,
+            column_config={
+                "name": "Staff Name",
+                "to_number": "Phone",
+                "status": "Delivery",
+                "error_code": st.column_config.NumberColumn("Error Code", format="%d"),
+            },
+            use_container_width=True
+        )
+
 def render_reports():
     st.title("Reports")
+
+    report_type = st.radio("Report Type", ["Monthly", "Salary Cycle", "Date Range"], horizontal=True, key="report_type")
+    if report_type == "Date Range":
+        st.markdown("""
+            <div class="dashboard-card">
+                <h3>Range Report</h3>
+        """, unsafe_allow_html=True)
+        render_range_report()
+        st.markdown("</div>", unsafe_allow_html=True)
+        return
     
-    # Month selection
-    st.markdown("""
+    # Month selection; a salary cycle report pays each staff member for
+    # their own cycle ending in the selected month
+    st.markdown(f"""
         <div class="dashboard-card">
-            <h3>Monthly Report</h3>
+            <h3>{"Salary Cycle Report" if report_type == "Salary Cycle" else "Monthly Report"}</h3>
     """, unsafe_allow_html=True)
     
     col1, col2 = st.columns(2)
@@ -1140,7 +1411,10 @@ def render_reports():
         )
     
     # Generate report
-    report_df = db.get_monthly_report(selected_year, selected_month)
+    if report_type == "Salary Cycle":
+        report_df = db.get_cycle_report(selected_year, selected_month)
+    else:
+        report_df = db.get_monthly_report(selected_year, selected_month)
     
     if not report_df.empty:
         # Summary metrics
@@ -1177,6 +1451,8 @@ def render_reports():
                 "phone": None,
                 "created_at": None,
                 "name": "Staff Name",
+                "period_start": "Cycle From",
+                "period_end": "Cycle To",
                 "monthly_salary": st.column_config.NumberColumn(
                     "Monthly Salary",
                     format="₹%.2f"
@@ -1200,25 +1476,54 @@ def render_reports():
         
         # Export options
         st.markdown("<br>", unsafe_allow_html=True)
-        col1, col2 = st.columns(2)
+        col1, col2, col3 = st.columns(3)
         
         with col1:
             if st.button("Export to Excel", use_container_width=True):
-                # Add export functionality
-                pass
+                with st.spinner("Preparing workbook..."):
+                    workbook = io.BytesIO()
+                    write_payroll_workbook(db, selected_year, selected_month, workbook)
+                st.session_state.report_export = (selected_year, selected_month, workbook.getvalue())
+            export = st.session_state.get('report_export')
+            if export and export[:2] == (selected_year, selected_month):
+                st.download_button(
+                    "Download Excel",
+                    data=export[2],
+                    file_name=payroll_workbook_name(selected_year, selected_month),
+                    mime=XLSX_MIME,
+                    use_container_width=True
+                )
         
         with col2:
+            if st.button("Generate Payslips", use_container_width=True):
+                with st.spinner("Rendering payslips..."):
+                    archive = io.BytesIO()
+                    write_payslips_zip(db, selected_year, selected_month, archive)
+                st.session_state.report_payslips = (selected_year, selected_month, archive.getvalue())
+            payslips = st.session_state.get('report_payslips')
+            if payslips and payslips[:2] == (selected_year, selected_month):
+                st.download_button(
+                    "Download Payslips",
+                    data=payslips[2],
+                    file_name=f"payslips_{selected_year}_{selected_month:02d}.zip",
+                    mime="application/zip",
+                    use_container_width=True
+                )
+        
+        with col3:
             if st.button("Send Reports to Staff", use_container_width=True):
-                for _, row in report_df.iterrows():
-                    success, message = messaging.send_attendance_summary(
-                        row['id'],
-                        selected_year,
-                        selected_month
-                    )
-                    if success:
-                        st.success(f"Sent to {row['name']}")
-                    else:
-                        st.error(f"Failed to send to {row['name']}: {message}")
+                # Only queue here; the outbox workers do the sending
+                batch, skipped = messaging.send_monthly_summaries(
+                    selected_year,
+                    selected_month,
+                    report_df['id'].tolist()
+                )
+                names = dict(zip(report_df['id'], report_df['name']))
+                for staff_id, reason in skipped.items():
+                    st.error(f"Not sending to {names.get(staff_id, staff_id)}: {reason}")
+                st.session_state.report_send_batch = batch
+            if st.session_state.get('report_send_batch'):
+                render_send_progress(st.session_state.report_send_batch)
     else:
         st.info("No data available for the selected month")
     
@@ -1419,11 +1724,33 @@ def render_settings():
         "Twilio Phone Number",
         value=db.get_setting('twilio_number', '')
     )
+    messaging_workers = st.number_input(
+        "Messages Sent at Once",
+        min_value=1,
+        max_value=32,
+        value=int(db.get_setting('messaging_workers', OUTBOX_WORKERS)),
+        help="Outbox worker threads; applies after the app restarts"
+    )
+    messaging_rate = st.number_input(
+        "Messages per Second",
+        min_value=0.1,
+        max_value=100.0,
+        value=float(db.get_setting('messaging_rate', MESSAGING_RATE)),
+        help="Most messages sent per second from the Twilio number; applies after the app restarts"
+    )
+    status_callback = st.text_input(
+        "Status Callback URL",
+        value=db.get_setting('messaging_status_callback', ''),
+        help="Public URL of `manage.py status-webhook`, where Twilio posts delivery statuses; applies after the app restarts"
+    )
     
     if st.button("Save Messaging Settings", use_container_width=True):
         db.set_setting('twilio_sid', twilio_sid)
         db.set_setting('twilio_token', twilio_token)
         db.set_setting('twilio_number', twilio_number)
+        db.set_setting('messaging_workers', messaging_workers)
+        db.set_setting('messaging_rate', messaging_rate)
+        db.set_setting('messaging_status_callback', status_callback)
         st.success("Messaging settings saved successfully")
     
     st.markdown("</div>", unsafe_allow_html=True)
@@ -1450,13 +1777,23 @@ def logout():
     st.session_state.clear()
     st.rerun()
 
+def ensure_attendance_marked(day):
+    """Auto-mark attendance for a day until it succeeds, once per server process."""
+    marked_days = get_marked_days()
+    if day in marked_days:
+        return
+    # auto_mark_attendance logs and swallows errors, so success is checked
+    # with the probe rather than its return value
+    if not db.has_attendance(day):
+        db.auto_mark_attendance(day)
+        if not db.has_attendance(day):
+            return
+    marked_days.add(day)
+
 # Main application flow
 if not st.session_state.authenticated:
     login_page()
 else:
     # Auto-mark attendance for today if not already marked
-    today = date.today()
-    today_attendance = db.get_attendance(today)
-    if today_attendance.empty:
-        db.auto_mark_attendance(today)
+    ensure_attendance_marked(date.today())
     main_app() 
\ No newline at end of file
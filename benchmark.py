@@ -0,0 +1,562 @@
+"""Benchmarks for HaazriBook database paths on synthetic data.
+
+Usage:
+    python benchmark.py report --staff 800
+    python benchmark.py startup
+    python benchmark.py payroll --staff 10000 --months 12
+    python benchmark.py export --staff 5000 --budget-mb 32
+    python benchmark.py payslips --staff 2000 --workers 1 2 4
+    python benchmark.py calendar --staff 3000
+    python benchmark.py trends --staff 2000 --months 36
+    python benchmark.py snapshot --staff 2000 --months 6
+    python benchmark.py messaging --staff 500 --latency 0.05 --workers 1 4 16
+"""
+import argparse
+import io
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+import sqlite3
+import zipfile
+import calendar
+from datetime import date, timedelta
+
+import bcrypt
+import pandas as pd
+from openpyxl import load_workbook
+
+import database
+import messaging
+from database import ATTENDANCE_STORES, REPORT_GRANULARITIES, Database
+from delivery import StatusCallbackServer, reconcile_deliveries
+from exports import write_payroll_workbook
+from payroll import HOLIDAY
+from payslips import write_payslips_zip
+from snapshot import MANIFEST_NAME, STAFF_FILE, Snapshot, write_snapshot
+from transports import LocalTwilioServer, TwilioTransport
+from trends import attendance_trend, staff_rolling_rates
+
+
+def timed(fn, repeat=3):
+    """Return (best wall time in seconds, last result) over `repeat` runs."""
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def seed_database(db, staff_count, year, month, months=1, rng_seed=7):
+    """Fill a database with staff, attendance, holidays and advances."""
+    rng = random.Random(rng_seed)
+    first_day = date(year, month, 1)
+    days = []
+    current = first_day
+    for _ in range(months):
+        _, num_days = calendar.monthrange(current.year, current.month)
+        days.extend(current + timedelta(days=i) for i in range(num_days))
+        current = days[-1] + timedelta(days=1)
+
+    with db.transaction() as conn:
+        conn.executemany('''
+            INSERT INTO staff (name, phone, monthly_salary, salary_cycle_start, salary_cycle_end)
+            VALUES (?, ?, ?, 1, 31)
+        ''', [(f"Staff {i:05d}", f"+9100000{i:05d}", rng.randrange(12000, 60000, 500))
+              for i in range(staff_count)])
+        staff_ids = [row[0] for row in conn.execute('SELECT id FROM staff')]
+
+        holidays = [d for d in days if d.day == 26 or d.weekday() == 6]
+        conn.executemany('INSERT OR IGNORE INTO holidays (date, name) VALUES (?, ?)',
+                         [(d.isoformat(), 'Holiday') for d in holidays])
+
+        conn.executemany('''
+            INSERT OR REPLACE INTO attendance (staff_id, date, is_present, is_holiday)
+            VALUES (?, ?, ?, ?)
+        ''', ((staff_id, d.isoformat(), int(rng.random() < 0.9), 0)
+              for staff_id in staff_ids for d in days))
+
+        for staff_id in rng.sample(staff_ids, max(1, staff_count // 5)):
+            cursor = conn.execute('''
+                INSERT INTO advances (staff_id, amount, date, repayment_type, remaining_amount)
+                VALUES (?, ?, ?, 'Monthly', ?)
+            ''', (staff_id, 6000, first_day.isoformat(), 6000))
+            conn.executemany('''
+                INSERT INTO advance_repayments (advance_id, amount, due_date)
+                VALUES (?, ?, ?)
+            ''', [(cursor.lastrowid, 2000, d.isoformat()) for d in days if d.day == 1][:3])
+    # Rows were inserted directly, so bring the rollup up to date
+    db.rebuild_monthly_summary()
+    return staff_ids
+
+
+def legacy_monthly_report(db, year, month):
+    """The original per-staff report loop, kept for comparison."""
+    working_days = db.get_working_days_in_month(year, month)
+    report_data = []
+    for _, staff_member in db.get_all_staff().iterrows():
+        staff_id = staff_member['id']
+        attendance = db.get_monthly_attendance_for_staff(staff_id, year, month)
+        days_present = len(attendance[attendance['is_present'] | attendance['is_holiday']])
+        attendance_ratio = days_present / working_days if working_days > 0 else 0
+        calculated_salary = staff_member['monthly_salary'] * attendance_ratio
+        advance_deduction = db.get_advance_deduction(staff_id, year, month)
+        report_data.append({
+            'id': staff_id,
+            'name': staff_member['name'],
+            'monthly_salary': staff_member['monthly_salary'],
+            'days_present': days_present,
+            'working_days': working_days,
+            'calculated_salary': calculated_salary,
+            'total_advance': advance_deduction,
+            'final_salary': calculated_salary - advance_deduction
+        })
+    return pd.DataFrame(report_data)
+
+
+def bench_report(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, 'bench.db'))
+        seed_database(db, args.staff, args.year, args.month)
+
+        legacy_time, legacy = timed(lambda: legacy_monthly_report(db, args.year, args.month), args.repeat)
+        set_time, report = timed(lambda: db.get_monthly_report(args.year, args.month), args.repeat)
+
+        pd.testing.assert_frame_equal(
+            report.reset_index(drop=True), legacy.reset_index(drop=True),
+            check_dtype=False
+        )
+        print(f"get_monthly_report, {args.staff} staff")
+        print(f"  per-staff loop: {legacy_time * 1000:9.1f} ms")
+        print(f"  rollup:         {set_time * 1000:9.1f} ms  ({legacy_time / set_time:.0f}x)")
+
+
+def bench_payroll(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, 'bench.db'))
+        print(f"Seeding {args.staff} staff x {args.months} months...")
+        seed_database(db, args.staff, args.year, args.month, months=args.months)
+        if args.store != 'rows':
+            db.convert_attendance_store(args.store)
+
+        start = date(args.year, args.month, 1)
+        matrix = db.get_payroll_matrix(start, start)
+        pd.testing.assert_frame_equal(
+            matrix.report(), db.get_monthly_report(args.year, args.month),
+            check_dtype=False
+        )
+
+        end = start
+        for _ in range(args.months - 1):
+            end = (end + timedelta(days=31)).replace(day=1)
+        load_time, matrix = timed(lambda: db.get_payroll_matrix(start, end), args.repeat)
+        compute_time, report = timed(matrix.report, args.repeat)
+
+        print(f"Payroll matrix, {args.staff} staff x {len(matrix.days)} days ({args.store} store)")
+        print(f"  load:    {load_time * 1000:9.1f} ms")
+        print(f"  compute: {compute_time * 1000:9.1f} ms")
+        print(f"  total payroll: {report['final_salary'].sum():,.2f}")
+
+
+def bench_snapshot(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, 'bench.db'))
+        print(f"Seeding {args.staff} staff x {args.months} months...")
+        staff_ids = seed_database(db, args.staff, args.year, args.month, months=args.months)
+        # Older versions of the staff form saved full dates as cycle bounds
+        with db.transaction() as conn:
+            conn.execute(
+                "UPDATE staff SET salary_cycle_start = '2024-01-05', salary_cycle_end = '2024-02-04' WHERE id = ?",
+                (staff_ids[0],)
+            )
+
+        start = date(args.year, args.month, 1)
+        end = start
+        for _ in range(args.months - 1):
+            end = (end + timedelta(days=31)).replace(day=1)
+        root = os.path.join(tmp, 'snapshot')
+        elapsed, written = timed(lambda: write_snapshot(db, root, through=end.isoformat()[:7], full=True), args.repeat)
+
+        # Nothing staged is left behind
+        tables = [table for table, months in written.items() if months]
+        assert sorted(os.listdir(root)) == sorted([*tables, STAFF_FILE, MANIFEST_NAME]), os.listdir(root)
+        snap = Snapshot(root)
+        staff = snap.frame('staff').set_index('id')
+        assert (staff.loc[staff_ids[0], ['salary_cycle_start', 'salary_cycle_end']] == [5, 4]).all()
+        pd.testing.assert_frame_equal(
+            snap.payroll_matrix(start, end).report(), db.get_payroll_matrix(start, end).report(),
+            check_dtype=False
+        )
+        pd.testing.assert_frame_equal(
+            db.get_monthly_report(end.year, end.month, source=snap),
+            db.get_monthly_report(end.year, end.month), check_dtype=False
+        )
+        for granularity in REPORT_GRANULARITIES:
+            pd.testing.assert_frame_equal(
+                db.get_report_range(start, end, granularity, source=snap),
+                db.get_report_range(start, end, granularity), check_dtype=False
+            )
+
+        # Rows of closed months change in normal use; an incremental run must pick them up
+        repayment_id, = db.get_connection().execute(
+            'SELECT id FROM advance_repayments WHERE is_paid = 0 AND due_date BETWEEN ? AND ? LIMIT 1',
+            (start.isoformat(), end.isoformat())
+        ).fetchone()
+        db.mark_repayment_paid(repayment_id, end)
+        db.update_staff_salary(staff_ids[1], 99999, start + timedelta(days=10))
+        incremental, rewritten = timed(lambda: write_snapshot(db, root, through=end.isoformat()[:7]), 1)
+        assert not rewritten['attendance'] and rewritten['advance_repayments'], rewritten
+        pd.testing.assert_frame_equal(
+            Snapshot(root).payroll_matrix(start, end).report(), db.get_payroll_matrix(start, end).report(),
+            check_dtype=False
+        )
+
+        print(f"Snapshot, {args.staff} staff x {args.months} months")
+        print(f"  full write:        {elapsed * 1000:9.1f} ms ({sum(map(len, written.values()))} partitions)")
+        print(f"  incremental write: {incremental * 1000:9.1f} ms")
+
+
+def bench_export(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, 'bench.db'))
+        print(f"Seeding {args.staff} staff...")
+        seed_database(db, args.staff, args.year, args.month)
+        if args.store != 'rows':
+            db.convert_attendance_store(args.store)
+
+        path = os.path.join(tmp, 'payroll.xlsx')
+        elapsed, _ = timed(lambda: write_payroll_workbook(db, args.year, args.month, path), args.repeat)
+        # Peak Python heap, from a separate run since tracing slows it down
+        tracemalloc.start()
+        write_payroll_workbook(db, args.year, args.month, path)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        # Write-only sheets carry no dimensions, so count rows by reading them
+        workbook = load_workbook(path, read_only=True)
+        sheets = {sheet.title: list(sheet.iter_rows(min_row=2, values_only=True)) for sheet in workbook.worksheets}
+        rows = {title: len(sheet_rows) for title, sheet_rows in sheets.items()}
+        report = db.get_monthly_report(args.year, args.month)
+        assert rows['Payroll'] == rows['Attendance'] == len(report), rows
+        pd.testing.assert_frame_equal(
+            pd.DataFrame(sheets['Payroll'], columns=report.columns), report, check_dtype=False
+        )
+
+        print(f"Excel export, {args.staff} staff x 1 month ({args.store} store)")
+        print(f"  write:       {elapsed * 1000:9.1f} ms")
+        print(f"  peak memory: {peak / 2**20:9.1f} MiB (budget {args.budget_mb} MiB)")
+        print(f"  file:        {os.path.getsize(path) / 2**20:9.1f} MiB, rows {rows}")
+        assert peak < args.budget_mb * 2**20, "export exceeded its memory budget"
+
+
+def bench_payslips(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, 'bench.db'))
+        print(f"Seeding {args.staff} staff...")
+        seed_database(db, args.staff, args.year, args.month)
+
+        print(f"Payslips, {args.staff} staff ({os.cpu_count()} CPUs)")
+        baseline = None
+        for workers in args.workers:
+            archive = io.BytesIO()
+            elapsed, count = timed(lambda: write_payslips_zip(db, args.year, args.month, archive, workers), args.repeat)
+            assert count == len(zipfile.ZipFile(archive).namelist()) == args.staff
+            baseline = baseline or elapsed
+            print(f"  {workers} worker(s): {elapsed * 1000:9.1f} ms  ({baseline / elapsed:.2f}x)")
+
+
+# Runs inside a Streamlit runtime: a bare script gets a new st.cache_data
+# store on every call, so CachedDatabase would never hit there
+_CACHED_CALENDAR_SCRIPT = '''
+import sys
+import time
+import streamlit as st
+sys.path.insert(0, {root!r})
+import database
+from caching import CachedDatabase
+
+loads = []
+load = database.Database.get_attendance_calendar
+database.Database.get_attendance_calendar = lambda self, *a: loads.append(1) or load(self, *a)
+db = CachedDatabase(database.Database({path!r}))
+db.get_attendance_calendar({year}, {month})
+best = None
+for _ in range({repeat}):
+    start = time.perf_counter()
+    db.get_attendance_calendar({year}, {month})
+    elapsed = time.perf_counter() - start
+    best = elapsed if best is None else min(best, elapsed)
+st.text(f"{{best}} {{len(loads)}}")
+'''
+
+
+def cached_calendar_hit(path, year, month, repeat):
+    """(best time of a cached get_attendance_calendar read, underlying loads),
+    measured through CachedDatabase in a Streamlit AppTest runtime."""
+    from streamlit.testing.v1 import AppTest
+    script = _CACHED_CALENDAR_SCRIPT.format(
+        root=os.path.dirname(os.path.abspath(__file__)), path=path,
+        year=year, month=month, repeat=repeat,
+    )
+    app = AppTest.from_string(script, default_timeout=120).run()
+    if app.exception:
+        raise RuntimeError(app.exception[0].value)
+    best, loads = app.text[0].value.split()
+    return float(best), int(loads)
+
+
+def bench_calendar(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, 'bench.db'))
+        print(f"Seeding {args.staff} staff...")
+        seed_database(db, args.staff, args.year, args.month)
+        if args.store != 'rows':
+            db.convert_attendance_store(args.store)
+
+        elapsed, cal = timed(lambda: db.get_attendance_calendar(args.year, args.month), args.repeat)
+        assert cal.status.shape == (args.staff, calendar.monthrange(args.year, args.month)[1])
+        register = {staff_id: statuses for staff_id, _, statuses in db.iter_attendance_register(args.year, args.month)}
+        for staff_id, row in zip(cal.staff_ids, cal.status.tolist()):
+            assert all(code == HOLIDAY or code == stored for code, stored in zip(row, register[staff_id])), staff_id
+
+        hit, loads = cached_calendar_hit(db.db_name, args.year, args.month, args.repeat)
+        assert loads == 1, f"cached reads loaded the calendar {loads} times"
+
+        print(f"Attendance calendar, {args.staff} staff x 1 month ({args.store} store)")
+        print(f"  load:   {elapsed * 1000:9.1f} ms")
+        print(f"  cached: {hit * 1000:9.3f} ms")
+
+
+def bench_trends(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, 'bench.db'))
+        print(f"Seeding {args.staff} staff x {args.months} months...")
+        staff_ids = seed_database(db, args.staff, args.year, args.month, months=args.months)
+        if args.store != 'rows':
+            db.convert_attendance_store(args.store)
+
+        start = date(args.year, args.month, 1)
+        end = start
+        for _ in range(args.months):
+            end = (end + timedelta(days=31)).replace(day=1)
+        end -= timedelta(days=1)
+
+        # The company series must come from the counters alone
+        tables = set()
+
+        def record_reads(action, table, *_):
+            if action == sqlite3.SQLITE_READ:
+                tables.add(table)
+            return sqlite3.SQLITE_OK
+
+        conn = db.get_connection()
+        conn.set_authorizer(record_reads)
+        company_time, company = timed(lambda: attendance_trend(db, start, end), args.repeat)
+        conn.set_authorizer(None)
+        assert not tables & {'attendance', 'attendance_bitmap'}, tables
+        staff_time, _ = timed(lambda: attendance_trend(db, start, end, staff_id=staff_ids[0]), args.repeat)
+        rates_time, rates = timed(lambda: staff_rolling_rates(db, end), args.repeat)
+        assert len(rates) == args.staff
+
+        print(f"Attendance trends, {args.staff} staff x {(end - start).days + 1} days ({args.store} store)")
+        print(f"  company series:  {company_time * 1000:9.1f} ms ({len(company)} points)")
+        print(f"  one staff:       {staff_time * 1000:9.1f} ms")
+        print(f"  per-staff rates: {rates_time * 1000:9.1f} ms")
+
+
+def bench_messaging(args):
+    messaging.RETRY_BASE_DELAY = args.retry_delay
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, 'bench.db'))
+        print(f"Seeding {args.staff} staff...")
+        seed_database(db, args.staff, args.year, args.month)
+        db.set_setting('twilio_from_number', '+15005550006')
+        db.set_setting('messaging_rate', args.rate)
+
+        server = LocalTwilioServer(
+            latency=args.latency, error_rate=args.error_rate,
+            throttle_rate=args.throttle_rate, seed=7,
+            delivery_delay=args.delivery_delay, undelivered_rate=args.undelivered_rate
+        ).start()
+        callbacks = args.callbacks and StatusCallbackServer(db, flush_interval=0.1).start()
+        print(f"Messaging, {args.staff} summaries through a local Twilio stand-in "
+              f"({args.latency * 1000:.0f} ms latency, {args.throttle_rate:.0%} throttled, "
+              f"{args.error_rate:.0%} errors, {args.rate:g}/s limit, "
+              f"statuses by {'callback' if callbacks else 'reconciliation'})")
+        try:
+            for workers in args.workers:
+                with db.transaction(invalidates=False) as conn:
+                    conn.execute('DELETE FROM message_log')
+                    conn.execute('DELETE FROM message_outbox')
+                server.counts = dict.fromkeys(server.counts, 0)
+                service = messaging.MessagingService(db, TwilioTransport(
+                    'AC' + '0' * 32, 'token', server.url, callbacks and callbacks.url + '/status'
+                ))
+
+                service.start_workers(workers)
+                start = time.perf_counter()
+                batch, _ = service.send_monthly_summaries(args.year, args.month)
+                queued = time.perf_counter() - start
+                while True:
+                    progress = db.get_outbox_progress(batch)
+                    if not progress['pending'] and not progress['sending']:
+                        break
+                    time.sleep(0.01)
+                elapsed = time.perf_counter() - start
+                service.workers.stop()
+
+                attempts = db.get_connection().execute(
+                    'SELECT COALESCE(SUM(attempts), 0) FROM message_outbox WHERE batch = ?', (batch,)
+                ).fetchone()[0]
+                assert progress['sent'] == server.counts['accepted'], (progress, server.counts)
+                print(f"  {workers:3d} worker(s): {elapsed:7.2f} s, {progress['sent'] / elapsed:7.1f} msg/s "
+                      f"(queued in {queued * 1000:.0f} ms), sent {progress['sent']}, failed {progress['failed']}, "
+                      f"retries {attempts - progress['sent'] - progress['failed']}, server {server.counts}")
+
+                # Wait out delivery, then bring every status up to date
+                time.sleep(args.delivery_delay)
+                pages = server.counts['pages']
+                start = time.perf_counter()
+                if callbacks:
+                    while db.get_unresolved_message_sids(1)[1]:
+                        time.sleep(0.01)
+                    how = f"{server.counts['callbacks']} callbacks settled"
+                else:
+                    unresolved, updated = reconcile_deliveries(db, service.transport)
+                    how = f"reconciled {updated} of {unresolved} in {server.counts['pages'] - pages} page(s)"
+                settled = time.perf_counter() - start
+                summary = db.get_delivery_summary(batch)
+                assert sum(summary.get(status, 0) for status in ('delivered', 'undelivered')) == progress['sent'], summary
+                print(f"      delivery: {how} in {settled * 1000:.0f} ms, {summary}")
+        finally:
+            server.stop()
+            if callbacks:
+                callbacks.stop()
+
+
+def bench_startup(args):
+    """Time Database() construction and check the bootstrap runs once per file.
+
+    The repository has no test suite; this doubles as the startup test.
+    """
+    calls = {'migrations': 0, 'hashpw': 0}
+
+    def counted(name, fn):
+        def wrapper(*a, **kw):
+            calls[name] += 1
+            return fn(*a, **kw)
+        return wrapper
+
+    run_migrations, hashpw = database.run_migrations, bcrypt.hashpw
+    database.run_migrations = counted('migrations', run_migrations)
+    bcrypt.hashpw = counted('hashpw', hashpw)
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'bench.db')
+            start = time.perf_counter()
+            Database(path)
+            cold = time.perf_counter() - start
+            assert calls == {'migrations': 1, 'hashpw': 1}, calls
+
+            warm, _ = timed(lambda: [Database(path) for _ in range(args.constructions)], args.repeat)
+            per_construction = warm / args.constructions
+            assert calls == {'migrations': 1, 'hashpw': 1}, f"repeated Database() bootstrapped again: {calls}"
+
+            # A second file gets its own bootstrap
+            Database(os.path.join(tmp, 'other.db'))
+            assert calls == {'migrations': 2, 'hashpw': 2}, calls
+    finally:
+        database.run_migrations, bcrypt.hashpw = run_migrations, hashpw
+
+    print("Database() construction")
+    print(f"  first (migrate + seed): {cold * 1000:9.2f} ms")
+    print(f"  repeated:               {per_construction * 1e6:9.2f} us")
+    print("  bootstrap and bcrypt ran once per database file")
+    assert per_construction < 1e-3, "repeated Database() construction should not touch the database"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=3)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    report = commands.add_parser('report', help='monthly payroll report')
+    report.add_argument('--staff', type=int, default=800)
+    report.add_argument('--year', type=int, default=2024)
+    report.add_argument('--month', type=int, default=1)
+    report.set_defaults(func=bench_report)
+
+    payroll = commands.add_parser('payroll', help='NumPy payroll matrix over a range of months')
+    payroll.add_argument('--staff', type=int, default=10000)
+    payroll.add_argument('--months', type=int, default=12)
+    payroll.add_argument('--year', type=int, default=2024)
+    payroll.add_argument('--month', type=int, default=1)
+    payroll.add_argument('--store', choices=ATTENDANCE_STORES, default='rows')
+    payroll.set_defaults(func=bench_payroll)
+
+    snapshot = commands.add_parser('snapshot', help='Parquet snapshot of history, checked against the database')
+    snapshot.add_argument('--staff', type=int, default=2000)
+    snapshot.add_argument('--months', type=int, default=6)
+    snapshot.add_argument('--year', type=int, default=2024)
+    snapshot.add_argument('--month', type=int, default=1)
+    snapshot.set_defaults(func=bench_snapshot)
+
+    export = commands.add_parser('export', help='streaming Excel export of a month')
+    export.add_argument('--staff', type=int, default=5000)
+    export.add_argument('--year', type=int, default=2024)
+    export.add_argument('--month', type=int, default=1)
+    export.add_argument('--store', choices=ATTENDANCE_STORES, default='rows')
+    export.add_argument('--budget-mb', type=float, default=32)
+    export.set_defaults(func=bench_export)
+
+    payslips = commands.add_parser('payslips', help='zip of HTML payslips for a month')
+    payslips.add_argument('--staff', type=int, default=2000)
+    payslips.add_argument('--year', type=int, default=2024)
+    payslips.add_argument('--month', type=int, default=1)
+    payslips.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    payslips.set_defaults(func=bench_payslips)
+
+    calendar_ = commands.add_parser('calendar', help='staff-by-day attendance calendar for a month')
+    calendar_.add_argument('--staff', type=int, default=3000)
+    calendar_.add_argument('--year', type=int, default=2024)
+    calendar_.add_argument('--month', type=int, default=1)
+    calendar_.add_argument('--store', choices=ATTENDANCE_STORES, default='rows')
+    calendar_.set_defaults(func=bench_calendar)
+
+    trends = commands.add_parser('trends', help='rolling attendance rate series')
+    trends.add_argument('--staff', type=int, default=2000)
+    trends.add_argument('--months', type=int, default=36)
+    trends.add_argument('--year', type=int, default=2022)
+    trends.add_argument('--month', type=int, default=1)
+    trends.add_argument('--store', choices=ATTENDANCE_STORES, default='rows')
+    trends.set_defaults(func=bench_trends)
+
+    messaging_ = commands.add_parser('messaging', help='outbox throughput and retries against a local Twilio stand-in')
+    messaging_.add_argument('--staff', type=int, default=500)
+    messaging_.add_argument('--year', type=int, default=2024)
+    messaging_.add_argument('--month', type=int, default=1)
+    messaging_.add_argument('--workers', type=int, nargs='+', default=[1, 4, 16])
+    messaging_.add_argument('--latency', type=float, default=0.05, help='seconds per request at the stand-in')
+    messaging_.add_argument('--error-rate', type=float, default=0.0, help='share of requests answered 500')
+    messaging_.add_argument('--throttle-rate', type=float, default=0.0, help='share of requests answered 429')
+    messaging_.add_argument('--rate', type=float, default=1000.0, help='messaging_rate, sends per second')
+    messaging_.add_argument('--retry-delay', type=float, default=0.05, help='RETRY_BASE_DELAY in seconds')
+    messaging_.add_argument('--delivery-delay', type=float, default=0.5, help='seconds from send to delivery at the stand-in')
+    messaging_.add_argument('--undelivered-rate', type=float, default=0.05, help='share of messages never delivered')
+    messaging_.add_argument('--callbacks', action='store_true', help='take statuses from callbacks instead of reconciliation')
+    messaging_.set_defaults(func=bench_messaging)
+
+    startup = commands.add_parser('startup', help='Database() construction cost')
+    startup.add_argument('--constructions', type=int, default=1000)
+    startup.set_defaults(func=bench_startup)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
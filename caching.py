@@ -0,0 +1,89 @@
+import streamlit as st
+from database import Database
+from messaging import MessagingService
+
+# Database methods that only read. Results are memoized by arguments and the
+# database's data generation, which every committed write bumps, so a cached
+# result is never served after the data it came from has changed.
+READ_METHODS = {
+    'get_advance_deduction',
+    'get_advance_details',
+    'get_advance_repayment_history',
+    'get_advances',
+    'get_all_advances',
+    'get_all_staff',
+    'get_all_users',
+    'get_attendance',
+    'get_attendance_calendar',
+    'get_attendance_range',
+    'get_cycle_report',
+    'get_holidays',
+    'get_monthly_attendance',
+    'get_monthly_attendance_for_staff',
+    'get_monthly_report',
+    'get_pending_advances',
+    'get_pending_repayments',
+    'get_report_range',
+    'get_salary_cycle',
+    'get_setting',
+    'get_staff_directory',
+    'get_staff_outstanding',
+    'get_staff_salary_cycle',
+    'get_staff_salary_history',
+    'get_working_days',
+    'get_working_days_in_month',
+    'has_attendance',
+    'is_holiday',
+}
+
+
+@st.cache_resource(show_spinner=False)
+def get_database():
+    """Database shared by every session in this server process."""
+    return Database()
+
+
+@st.cache_resource(show_spinner=False)
+def get_messaging_service():
+    """MessagingService shared by every session in this server process.
+
+    Its outbox workers start here, so messages queued before a restart
+    are sent without waiting for a new batch.
+    """
+    service = MessagingService()
+    service.start_workers()
+    return service
+
+
+@st.cache_resource(show_spinner=False)
+def get_marked_days():
+    """Days this server process has seen attendance recorded for.
+
+    Filled only once a day is known to be marked, so a failed auto-mark is
+    tried again on the next run.
+    """
+    return set()
+
+
+@st.cache_data(max_entries=512, show_spinner=False)
+def _cached_read(db_name, method, args, kwargs, generation, _db):
+    return getattr(_db, method)(*args, **dict(kwargs))
+
+
+class CachedDatabase:
+    """Database proxy that memoizes read methods until the next write."""
+
+    def __init__(self, db):
+        self._db = db
+
+    def __getattr__(self, name):
+        attr = getattr(self._db, name)
+        if name not in READ_METHODS:
+            return attr
+
+        def cached(*args, **kwargs):
+            return _cached_read(
+                self._db.db_name, name, args, tuple(sorted(kwargs.items())),
+                self._db.get_data_generation(), self._db
+            )
+        return cached
@@ -13,4 +13,7 @@ ADMIN_PASSWORD = get_secret("database", "admin_password", "admin")
 # Twilio configuration
 TWILIO_ACCOUNT_SID = get_secret("twilio", "account_sid", "")
 TWILIO_AUTH_TOKEN = get_secret("twilio", "auth_token", "")
-TWILIO_PHONE_NUMBER = get_secret("twilio", "phone_number", "") 
\ No newline at end of file
+TWILIO_PHONE_NUMBER = get_secret("twilio", "phone_number", "")
+
+# SQLite storage profile, e.g. [database.storage] journal_mode = "WAL", busy_timeout = 5000
+STORAGE_PROFILE = dict(get_secret("database", "storage", {}))
@@ -1,123 +1,1313 @@
+import os
 import sqlite3
+import threading
+from contextlib import contextmanager
 from datetime import datetime, date, timedelta
+import numpy as np
 import pandas as pd
 import bcrypt
 import json
 import calendar
+import uuid
+
+from payroll import AttendanceCalendar, PayrollMatrix, mask_status_codes
+
+# Size of the per-connection prepared statement cache
+STATEMENT_CACHE_SIZE = 256
+
+# Pragmas applied to every connection. Override through config.STORAGE_PROFILE
+# or per database with settings rows named "storage_<key>".
+DEFAULT_STORAGE_PROFILE = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,          # milliseconds
+    'mmap_size': 268435456,        # 256 MB
+    'cache_size': -65536,          # negative means KiB, i.e. 64 MB
+    'temp_store': 'MEMORY',
+    'maintenance_interval': 300,   # seconds between checkpoint/optimize runs, 0 disables
+}
+
+_PRAGMA_CHOICES = {
+    'journal_mode': {'DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF'},
+    'synchronous': {'OFF', 'NORMAL', 'FULL', 'EXTRA'},
+    'temp_store': {'DEFAULT', 'FILE', 'MEMORY'},
+}
+
+
+def _normalize_storage_profile(overrides):
+    """Merge overrides onto the defaults, dropping values that are not valid pragmas."""
+    profile = dict(DEFAULT_STORAGE_PROFILE)
+    for key, value in overrides.items():
+        if key not in DEFAULT_STORAGE_PROFILE or value in (None, ''):
+            continue
+        try:
+            if key in _PRAGMA_CHOICES:
+                value = str(value).upper()
+                if value not in _PRAGMA_CHOICES[key]:
+                    raise ValueError(value)
+            else:
+                value = int(value)
+        except ValueError:
+            print(f"Ignoring invalid storage setting {key}={value!r}")
+            continue
+        profile[key] = value
+    return profile
+
+
+def load_storage_profile(conn):
+    """Resolve the storage profile from config.py and the settings table."""
+    overrides = {}
+    try:
+        from config import STORAGE_PROFILE
+        overrides.update(STORAGE_PROFILE)
+    except Exception:
+        pass
+    try:
+        rows = conn.execute("SELECT key, value FROM settings WHERE substr(key, 1, 8) = 'storage_'").fetchall()
+        overrides.update({key[len('storage_'):]: value for key, value in rows})
+    except sqlite3.OperationalError:
+        pass  # settings table not created yet
+    return _normalize_storage_profile(overrides)
+
+
+def apply_storage_profile(conn, profile):
+    conn.execute(f"PRAGMA busy_timeout = {profile['busy_timeout']}")
+    conn.execute(f"PRAGMA journal_mode = {profile['journal_mode']}")
+    conn.execute(f"PRAGMA synchronous = {profile['synchronous']}")
+    conn.execute(f"PRAGMA mmap_size = {profile['mmap_size']}")
+    conn.execute(f"PRAGMA cache_size = {profile['cache_size']}")
+    conn.execute(f"PRAGMA temp_store = {profile['temp_store']}")
+
+
+def salary_day_mask(year, month, valid_from, valid_to):
+    """Day bits of (year, month) inside [valid_from, valid_to); registered as
+    the SQL function salary_day_mask()."""
+    prefix = f"{year:04d}-{month:02d}-"
+    first = int(valid_from[8:10]) if valid_from.startswith(prefix) else (1 if valid_from < prefix else 32)
+    stop = int(valid_to[8:10]) if valid_to.startswith(prefix) else (1 if valid_to < prefix else 32)
+    return ((1 << (stop - 1)) - 1) & ~((1 << (first - 1)) - 1)
+
+
+def popcount(value):
+    """Number of set bits; registered as the SQL function popcount()."""
+    return None if value is None else bin(value).count('1')
+
+
+class ConnectionManager:
+    """Hands out one long-lived SQLite connection per thread for a database file."""
+
+    def __init__(self, db_name, cached_statements=STATEMENT_CACHE_SIZE):
+        self.db_name = db_name
+        self.cached_statements = cached_statements
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.stats = {'opened': 0, 'reused': 0}
+        # Committed write transactions from this process
+        self.local_writes = 0
+        self.profile = None
+        # Schema version this process has already migrated and seeded
+        self.bootstrapped_version = None
+        self.bootstrap_lock = threading.Lock()
+        self._maintenance_thread = None
+        self._maintenance_stop = threading.Event()
+
+    def _open(self):
+        conn = sqlite3.connect(self.db_name, cached_statements=self.cached_statements)
+        conn.create_function('popcount', 1, popcount, deterministic=True)
+        conn.create_function('salary_day_mask', 4, salary_day_mask, deterministic=True)
+        if self.profile is None:
+            self.profile = load_storage_profile(conn)
+        apply_storage_profile(conn, self.profile)
+        self.start_maintenance()
+        return conn
+
+    def connection(self):
+        conn = getattr(self._local, 'conn', None)
+        with self._lock:
+            if conn is None:
+                self.stats['opened'] += 1
+            else:
+                self.stats['reused'] += 1
+        if conn is None:
+            conn = self._open()
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def transaction(self, invalidates=True):
+        """Run the enclosed writes in one IMMEDIATE transaction on this thread's connection.
+
+        Nested scopes join the outermost transaction. Pass invalidates=False
+        for writes no cached read depends on (the message outbox), so they
+        leave the data generation alone.
+        """
+        conn = self.connection()
+        if conn.in_transaction:
+            yield conn
+            return
+        conn.execute('BEGIN IMMEDIATE')
+        changes = conn.total_changes
+        try:
+            yield conn
+            if invalidates and conn.total_changes != changes:
+                self._bump_generation(conn)
+        except BaseException:
+            conn.rollback()
+            raise
+        else:
+            conn.commit()
+            if invalidates and conn.total_changes != changes:
+                with self._lock:
+                    self.local_writes += 1
+
+    def _bump_generation(self, conn):
+        conn.execute('''
+            INSERT INTO settings (key, value) VALUES ('data_generation', '1')
+            ON CONFLICT (key) DO UPDATE SET value = CAST(value AS INTEGER) + 1
+        ''')
+
+    def data_generation(self):
+        """Token that changes whenever any process commits a write to the database.
+
+        The settings counter is only re-read when this connection's
+        PRAGMA data_version (commits by other connections) or the process
+        write count has moved since the last read.
+        """
+        conn = self.connection()
+        key = (conn.execute('PRAGMA data_version').fetchone()[0], self.local_writes)
+        cached = getattr(self._local, 'generation', None)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        row = conn.execute("SELECT value FROM settings WHERE key = 'data_generation'").fetchone()
+        token = int(row[0]) if row else 0
+        self._local.generation = (key, token)
+        return token
+
+    def run_maintenance(self):
+        """Checkpoint the WAL without blocking writers and refresh planner statistics."""
+        conn = self.connection()
+        try:
+            conn.execute('PRAGMA wal_checkpoint(PASSIVE)')
+            conn.execute('PRAGMA optimize')
+        except sqlite3.Error as e:
+            print(f"Error in storage maintenance: {e}")
+
+    def start_maintenance(self):
+        """Start the background checkpoint/optimize task once per manager."""
+        interval = self.profile['maintenance_interval'] if self.profile else 0
+        with self._lock:
+            if interval <= 0 or self._maintenance_thread is not None:
+                return
+            self._maintenance_thread = threading.Thread(
+                target=self._maintenance_loop, args=(interval,),
+                name=f"sqlite-maintenance:{self.db_name}", daemon=True
+            )
+        self._maintenance_thread.start()
+
+    def stop_maintenance(self):
+        self._maintenance_stop.set()
+
+    def _maintenance_loop(self, interval):
+        while not self._maintenance_stop.wait(interval):
+            self.run_maintenance()
+        self.close()
+
+    def close(self):
+        """Close the calling thread's connection."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+_managers = {}
+_managers_lock = threading.Lock()
+
+def get_connection_manager(db_name):
+    """Return the process-wide connection manager for a database file."""
+    key = db_name if db_name == ':memory:' else os.path.abspath(db_name)
+    with _managers_lock:
+        manager = _managers.get(key)
+        if manager is None:
+            manager = ConnectionManager(db_name)
+            _managers[key] = manager
+        return manager
+
+
+def _migrate_base_schema(cursor):
+    # Staff table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS staff (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            phone TEXT,
+            monthly_salary REAL NOT NULL,
+            salary_cycle_start INTEGER DEFAULT 1,
+            salary_cycle_end INTEGER DEFAULT 31,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # Salary history table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS salary_history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            staff_id INTEGER,
+            salary REAL NOT NULL,
+            effective_from DATE NOT NULL,
+            effective_to DATE,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (staff_id) REFERENCES staff (id)
+        )
+    ''')
+
+    # Attendance table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS attendance (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            staff_id INTEGER,
+            date DATE NOT NULL,
+            is_present BOOLEAN DEFAULT 1,
+            is_holiday BOOLEAN DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (staff_id) REFERENCES staff (id),
+            UNIQUE(staff_id, date)
+        )
+    ''')
+
+    # Advances table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS advances (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            staff_id INTEGER,
+            amount REAL NOT NULL,
+            date DATE NOT NULL,
+            repayment_type TEXT CHECK(repayment_type IN ('OneTime', 'Weekly', 'Monthly')),
+            emi_amount REAL,
+            total_emi_count INTEGER,
+            remaining_amount REAL,
+            status TEXT DEFAULT 'Active' CHECK(status IN ('Active', 'Completed')),
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (staff_id) REFERENCES staff (id)
+        )
+    ''')
+
+    # Advance repayments table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS advance_repayments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            advance_id INTEGER,
+            amount REAL NOT NULL,
+            due_date DATE NOT NULL,
+            is_paid BOOLEAN DEFAULT 0,
+            paid_date DATE,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (advance_id) REFERENCES advances (id)
+        )
+    ''')
+
+    # Settings table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS settings (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        )
+    ''')
+
+    # Users table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            password TEXT NOT NULL,
+            role TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # Holidays table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS holidays (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            date DATE NOT NULL,
+            name TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE(date)
+        )
+    ''')
+
+    # Databases created before staff could be hidden lack this column
+    columns = [row[1] for row in cursor.execute('PRAGMA table_info(staff)')]
+    if 'hidden' not in columns:
+        cursor.execute("ALTER TABLE staff ADD COLUMN hidden INTEGER DEFAULT 0")
+
+
+def _migrate_production_indexes(cursor):
+    # Date range scans in attendance and dashboard queries
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_attendance_date ON attendance (date)')
+    # Per-staff advance lookups in get_staff_outstanding and get_advance_deduction
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_advances_staff_date ON advances (staff_id, date)')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_repayments_advance_paid_due
+        ON advance_repayments (advance_id, is_paid, due_date)
+    ''')
+    # get_pending_repayments only ever reads unpaid rows ordered by due date
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_repayments_pending_due
+        ON advance_repayments (due_date) WHERE is_paid = 0
+    ''')
+    # Duplicate phone check in add_staff
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_staff_phone ON staff (phone)')
+    # get_all_staff lists visible staff ordered by name
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_staff_visible_name
+        ON staff (name) WHERE hidden IS NULL OR hidden = 0
+    ''')
+    cursor.execute('ANALYZE')
+
+
+def _migrate_monthly_summary(cursor):
+    # Per staff, per month attendance counts and advance deductions kept
+    # current by the Database write paths. Keyed by period first so a month's
+    # report is one primary key range read.
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS monthly_summary (
+            year INTEGER NOT NULL,
+            month INTEGER NOT NULL,
+            staff_id INTEGER NOT NULL,
+            present_days INTEGER NOT NULL DEFAULT 0,
+            leave_days INTEGER NOT NULL DEFAULT 0,
+            absent_days INTEGER NOT NULL DEFAULT 0,
+            holiday_days INTEGER NOT NULL DEFAULT 0,
+            advance_deduction REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (year, month, staff_id)
+        ) WITHOUT ROWID
+    ''')
+    # Holiday dates are excluded from the per-staff marks: they count as paid
+    # days for everyone and are reported separately in holiday_days.
+    cursor.execute('''
+        WITH marks AS (
+            SELECT
+                staff_id,
+                CAST(substr(date, 1, 4) AS INTEGER) AS year,
+                CAST(substr(date, 6, 2) AS INTEGER) AS month,
+                SUM(is_present = 1) AS present_days,
+                SUM(is_present = 0 AND is_holiday = 1) AS leave_days,
+                SUM(is_present = 0 AND is_holiday = 0) AS absent_days
+            FROM attendance
+            WHERE date NOT IN (SELECT date FROM holidays)
+            GROUP BY staff_id, year, month
+        ),
+        holiday_counts AS (
+            SELECT
+                CAST(substr(date, 1, 4) AS INTEGER) AS year,
+                CAST(substr(date, 6, 2) AS INTEGER) AS month,
+                COUNT(*) AS holiday_days
+            FROM holidays
+            GROUP BY year, month
+        ),
+        deductions AS (
+            SELECT
+                a.staff_id,
+                CAST(substr(ar.due_date, 1, 4) AS INTEGER) AS year,
+                CAST(substr(ar.due_date, 6, 2) AS INTEGER) AS month,
+                SUM(ar.amount) AS amount
+            FROM advance_repayments ar
+            JOIN advances a ON ar.advance_id = a.id
+            WHERE ar.is_paid = 0
+            GROUP BY a.staff_id, year, month
+        ),
+        period_keys AS (
+            SELECT staff_id, year, month FROM marks
+            UNION
+            SELECT staff_id, year, month FROM deductions
+        )
+        INSERT INTO monthly_summary (
+            year, month, staff_id, present_days, leave_days, absent_days,
+            holiday_days, advance_deduction
+        )
+        SELECT
+            k.year, k.month, k.staff_id,
+            COALESCE(m.present_days, 0),
+            COALESCE(m.leave_days, 0),
+            COALESCE(m.absent_days, 0),
+            COALESCE(h.holiday_days, 0),
+            COALESCE(d.amount, 0.0)
+        FROM period_keys k
+        LEFT JOIN marks m ON m.staff_id = k.staff_id AND m.year = k.year AND m.month = k.month
+        LEFT JOIN holiday_counts h ON h.year = k.year AND h.month = k.month
+        LEFT JOIN deductions d ON d.staff_id = k.staff_id AND d.year = k.year AND d.month = k.month
+    ''')
+
+
+def _migrate_attendance_bitmap(cursor):
+    # Optional compact attendance store: one row per staff member per month,
+    # bit (day - 1) of each mask describing that day. See convert_attendance_store.
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS attendance_bitmap (
+            staff_id INTEGER NOT NULL,
+            year INTEGER NOT NULL,
+            month INTEGER NOT NULL,
+            marked_mask INTEGER NOT NULL DEFAULT 0,
+            present_mask INTEGER NOT NULL DEFAULT 0,
+            holiday_mask INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (staff_id, year, month)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_attendance_bitmap_period
+        ON attendance_bitmap (year, month)
+    ''')
+    # Day numbers used to expand masks back into one row per day
+    cursor.execute('CREATE TABLE IF NOT EXISTS day_numbers (day INTEGER PRIMARY KEY)')
+    cursor.executemany('INSERT OR IGNORE INTO day_numbers (day) VALUES (?)',
+                       [(day,) for day in range(1, 32)])
+
+
+def _migrate_effective_salary(cursor):
+    # Payroll resolves the salary in force on each day from salary_history
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_salary_history_staff_from
+        ON salary_history (staff_id, effective_from)
+    ''')
+    cursor.execute("PRAGMA table_info(monthly_summary)")
+    if 'present_salary' not in [column[1] for column in cursor.fetchall()]:
+        cursor.execute('''
+            ALTER TABLE monthly_summary
+            ADD COLUMN present_salary REAL NOT NULL DEFAULT 0
+        ''')
+    # present_salary is filled by rebuild_rollups; see ROLLUP_MIGRATIONS
+
+
+def _migrate_dashboard_counters(cursor):
+    # Dashboard figures kept current by the Database write paths, so the
+    # dashboard reads a few primary keys instead of aggregating staff and
+    # history. See ATTENDANCE_COUNTERS, MONTH_COUNTERS and STAFF_COUNTERS.
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS dashboard_counters (
+            name TEXT NOT NULL,
+            period TEXT NOT NULL DEFAULT '',
+            value REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (name, period)
+        ) WITHOUT ROWID
+    ''')
+    # Filled by rebuild_rollups; see ROLLUP_MIGRATIONS
+
+
+def _migrate_message_outbox(cursor):
+    # Outgoing SMS queued by MessagingService and drained by its worker
+    # pool; see OUTBOX_STATUSES. Rows of one send share a batch id.
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS message_outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            batch TEXT NOT NULL,
+            staff_id INTEGER,
+            to_number TEXT NOT NULL,
+            body TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (staff_id) REFERENCES staff (id)
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_message_outbox_status ON message_outbox (status, id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_message_outbox_batch ON message_outbox (batch, status)')
+
+
+def _migrate_outbox_delivery(cursor):
+    # Each message's idempotency key (unique; see message_key in messaging)
+    # and when a retry after a transient failure may go out
+    cursor.execute('ALTER TABLE message_outbox ADD COLUMN idempotency_key TEXT')
+    cursor.execute('ALTER TABLE message_outbox ADD COLUMN next_attempt_at TIMESTAMP')
+    cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_message_outbox_key ON message_outbox (idempotency_key)')
+
+
+def _migrate_message_log(cursor):
+    # One row per send attempt: the provider's SID and delivery status once
+    # accepted (see MESSAGE_FINAL_STATUSES), or 'rejected' with the error
+    # when the provider refused it. Status callbacks and reconciliation
+    # upsert by SID, so a callback may create the row before the worker does.
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS message_log (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            sid TEXT UNIQUE,
+            outbox_id INTEGER,
+            batch TEXT,
+            staff_id INTEGER,
+            to_number TEXT,
+            status TEXT NOT NULL,
+            error_code INTEGER,
+            error_message TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            status_updated_at TIMESTAMP,
+            FOREIGN KEY (outbox_id) REFERENCES message_outbox (id),
+            FOREIGN KEY (staff_id) REFERENCES staff (id)
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_message_log_batch ON message_log (batch, outbox_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_message_log_open ON message_log (created_at) WHERE sid IS NOT NULL')
+
+
+def _migrate_outbox_leases(cursor):
+    # Which outbox worker claimed a sending message, and when; the claim
+    # lapses after OUTBOX_LEASE seconds (see claim_outbox_messages)
+    cursor.execute('ALTER TABLE message_outbox ADD COLUMN claimed_at TIMESTAMP')
+    cursor.execute('ALTER TABLE message_outbox ADD COLUMN claimed_by TEXT')
+
+
+# Ordered schema migrations. PRAGMA user_version records the last one applied,
+# so each runs exactly once per database file. Append new entries; never reorder.
+MIGRATIONS = [
+    (1, 'base schema', _migrate_base_schema),
+    (2, 'production indexes', _migrate_production_indexes),
+    (3, 'monthly summary rollup', _migrate_monthly_summary),
+    (4, 'bitmap attendance store', _migrate_attendance_bitmap),
+    (5, 'effective-dated salary', _migrate_effective_salary),
+    (6, 'dashboard counters', _migrate_dashboard_counters),
+    (7, 'message outbox', _migrate_message_outbox),
+    (8, 'outbox retries and idempotency keys', _migrate_outbox_delivery),
+    (9, 'message delivery log', _migrate_message_log),
+    (10, 'outbox claim leases', _migrate_outbox_leases),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+# Migrations that leave the derived tables to be recomputed. Migrations only
+# change the schema as it stood at their version; run_migrations calls
+# rebuild_rollups once after the last of them, against the final schema.
+ROLLUP_MIGRATIONS = {5, 6}
+
+# message_outbox statuses: waiting, claimed by a worker, and the two outcomes
+OUTBOX_STATUSES = ('pending', 'sending', 'sent', 'failed')
+
+# Seconds a worker's claim on an outbox message lasts. Any process's pool
+# may take over a message still sending after that, so it must outlast a
+# send, including the wait for the sender number's rate limit.
+OUTBOX_LEASE = 600
+
+# message_log statuses that never change again: the provider's outcomes, and
+# 'rejected' for attempts it refused. Twilio's queued, sending and sent can
+# still move on, though 'sent' is the last status from carriers that send no
+# delivery receipts.
+MESSAGE_FINAL_STATUSES = ('delivered', 'undelivered', 'failed', 'read', 'canceled', 'rejected')
+_FINAL_STATUS_LIST = ', '.join(f"'{status}'" for status in MESSAGE_FINAL_STATUSES)
+
+# Logs a send attempt for an outbox message, or fills in the message_log row
+# a status callback created first without overwriting its status
+_LOG_OUTBOX_ATTEMPT_SQL = '''
+    INSERT INTO message_log (sid, outbox_id, batch, staff_id, to_number, status, error_code, error_message)
+    SELECT :sid, id, batch, staff_id, to_number, :status, :error_code, :error FROM message_outbox
+    WHERE id = :outbox_id
+    ON CONFLICT (sid) DO UPDATE SET
+        outbox_id = excluded.outbox_id,
+        batch = excluded.batch,
+        staff_id = excluded.staff_id,
+        to_number = excluded.to_number,
+        updated_at = CURRENT_TIMESTAMP
+'''
+
+# Columns accepted by mark_attendance_bulk when given a DataFrame
+ATTENDANCE_MARK_COLUMNS = ['staff_id', 'date', 'is_present', 'is_holiday']
+
+# Column order of get_monthly_report
+REPORT_COLUMNS = [
+    'id', 'name', 'monthly_salary', 'days_present', 'working_days',
+    'calculated_salary', 'total_advance', 'final_salary'
+]
+
+# Periods get_report_range can group months into, and its column order
+REPORT_GRANULARITIES = ('month', 'quarter', 'year', 'financial_year', 'total')
+REPORT_RANGE_COLUMNS = ['period', 'period_start', 'period_end'] + REPORT_COLUMNS
+
+# Period label for a (year, month) row, keyed by granularity. Financial years
+# run April to March and are labelled like FY2024-25.
+_REPORT_PERIOD_SQL = {
+    'month': "printf('%04d-%02d', m.year, m.month)",
+    'quarter': "printf('%04d-Q%d', m.year, (m.month + 2) / 3)",
+    'year': "printf('%04d', m.year)",
+    'financial_year': "printf('FY%04d-%02d', m.year - (m.month < 4), (m.year - (m.month < 4) + 1) % 100)",
+    'total': "'Total'",
+}
+
+# The same labels for reports computed from a PayrollMatrix
+_REPORT_PERIOD_LABELS = {
+    'month': lambda year, month: f"{year:04d}-{month:02d}",
+    'quarter': lambda year, month: f"{year:04d}-Q{(month + 2) // 3}",
+    'year': lambda year, month: f"{year:04d}",
+    'financial_year': lambda year, month: f"FY{year - (month < 4):04d}-{(year - (month < 4) + 1) % 100:02d}",
+    'total': lambda year, month: 'Total',
+}
+
+# Column order of get_cycle_report
+CYCLE_REPORT_COLUMNS = ['id', 'name', 'period_start', 'period_end'] + REPORT_COLUMNS[2:]
+
+# Column order of iter_advance_ledger: one row per repayment instalment, or
+# one row with empty instalment fields for an advance without a schedule
+ADVANCE_LEDGER_COLUMNS = [
+    'advance_id', 'advance_date', 'staff_id', 'name', 'advance_amount',
+    'repayment_type', 'due_date', 'instalment', 'is_paid', 'paid_date'
+]
+
+
+def to_date_str(value):
+    """Normalise a date, datetime, Timestamp or ISO string to 'YYYY-MM-DD'."""
+    if isinstance(value, str):
+        return value[:10]
+    if hasattr(value, 'date') and callable(value.date):
+        value = value.date()
+    return value.isoformat()
+
+
+def cycle_day(value, default):
+    """Day of month from a stored salary cycle value.
+
+    Staff rows hold a day number, or a full date as saved by older versions
+    of the staff form.
+    """
+    if value is None or value == '':
+        return default
+    if isinstance(value, str) and len(value) >= 10:
+        return int(value[8:10])
+    return min(max(int(value), 1), 31)
+
+
+def salary_cycle_window(year, month, start_day, end_day):
+    """First and last date of the pay period paid in (year, month).
+
+    A cycle such as 21 to 20 runs from the 21st of the previous month to the
+    20th of this one; 1 to 31 is the calendar month. Days are clipped to the
+    length of their month.
+    """
+    def clipped(y, m, day):
+        return date(y, m, min(day, calendar.monthrange(y, m)[1]))
+
+    end = clipped(year, month, end_day)
+    if start_day <= end_day:
+        return clipped(year, month, start_day), end
+    previous = date(year, month, 1) - timedelta(days=1)
+    return clipped(previous.year, previous.month, start_day), end
+
+
+# Attendance can live in the row-per-day `attendance` table (default) or in
+# the compact `attendance_bitmap` table, chosen by the attendance_store setting.
+ATTENDANCE_STORES = ('rows', 'bitmap')
+
+# Row-shaped attendance for :start..:end (inclusive ISO dates) from each store,
+# with columns id, staff_id, date, is_present, is_holiday.
+_ATTENDANCE_ROWS_SQL = {
+    'rows': '''
+        SELECT id, staff_id, date, is_present, is_holiday
+        FROM attendance
+        WHERE date BETWEEN :start AND :end
+    ''',
+    'bitmap': '''
+        SELECT
+            b.staff_id * 100000000 + b.year * 10000 + b.month * 100 + d.day AS id,
+            b.staff_id,
+            printf('%04d-%02d-%02d', b.year, b.month, d.day) AS date,
+            (b.present_mask >> (d.day - 1)) & 1 AS is_present,
+            (b.holiday_mask >> (d.day - 1)) & 1 AS is_holiday
+        FROM attendance_bitmap b
+        JOIN day_numbers d ON (b.marked_mask >> (d.day - 1)) & 1
+        WHERE (b.year, b.month) BETWEEN
+            (CAST(substr(:start, 1, 4) AS INTEGER), CAST(substr(:start, 6, 2) AS INTEGER))
+            AND (CAST(substr(:end, 1, 4) AS INTEGER), CAST(substr(:end, 6, 2) AS INTEGER))
+        AND printf('%04d-%02d-%02d', b.year, b.month, d.day) BETWEEN :start AND :end
+    ''',
+}
+
+
+# One row per visible staff member, ordered by name, with the day bit masks
+# (marked, present, holiday) of their marks in :year/:month (:start..:end).
+_MONTH_MASKS_SQL = {
+    'rows': '''
+        SELECT
+            s.id,
+            s.name,
+            COALESCE(SUM(1 << (CAST(substr(a.date, 9, 2) AS INTEGER) - 1)), 0),
+            COALESCE(SUM(a.is_present << (CAST(substr(a.date, 9, 2) AS INTEGER) - 1)), 0),
+            COALESCE(SUM(a.is_holiday << (CAST(substr(a.date, 9, 2) AS INTEGER) - 1)), 0)
+        FROM staff s
+        LEFT JOIN attendance a ON a.staff_id = s.id AND a.date BETWEEN :start AND :end
+        WHERE s.hidden IS NULL OR s.hidden = 0
+        GROUP BY s.id
+        ORDER BY s.name, s.id
+    ''',
+    'bitmap': '''
+        SELECT
+            s.id,
+            s.name,
+            COALESCE(b.marked_mask, 0),
+            COALESCE(b.present_mask, 0),
+            COALESCE(b.holiday_mask, 0)
+        FROM staff s
+        LEFT JOIN attendance_bitmap b
+            ON b.staff_id = s.id AND b.year = :year AND b.month = :month
+        WHERE s.hidden IS NULL OR s.hidden = 0
+        ORDER BY s.name, s.id
+    ''',
+}
+
+
+def get_attendance_store(conn):
+    row = conn.execute("SELECT value FROM settings WHERE key = 'attendance_store'").fetchone()
+    return row[0] if row and row[0] in ATTENDANCE_STORES else 'rows'
+
+
+def attendance_rows_sql(conn):
+    """SQL yielding attendance rows for :start..:end from the active store."""
+    return _ATTENDANCE_ROWS_SQL[get_attendance_store(conn)]
+
+
+def date_bit(day):
+    """(year, month, bit) addressing an ISO date inside attendance_bitmap."""
+    return int(day[:4]), int(day[5:7]), 1 << (int(day[8:10]) - 1)
+
+
+# Set one day's bits, given (staff_id, year, month, bit, is_present, is_holiday).
+# Rows whose bits already match are left untouched so rowcount counts changes.
+_UPSERT_ATTENDANCE_BITS = '''
+    INSERT INTO attendance_bitmap (staff_id, year, month, marked_mask, present_mask, holiday_mask)
+    VALUES (?1, ?2, ?3, ?4, ?4 * ?5, ?4 * ?6)
+    ON CONFLICT (staff_id, year, month) DO UPDATE SET
+        marked_mask = marked_mask | excluded.marked_mask,
+        present_mask = (present_mask & ~excluded.marked_mask) | excluded.present_mask,
+        holiday_mask = (holiday_mask & ~excluded.marked_mask) | excluded.holiday_mask
+    WHERE (marked_mask & excluded.marked_mask) = 0
+    OR (present_mask & excluded.marked_mask) != excluded.present_mask
+    OR (holiday_mask & excluded.marked_mask) != excluded.holiday_mask
+'''
+
+_DELETE_MONTHLY_SUMMARY = '''
+    DELETE FROM monthly_summary
+    WHERE (year, month) BETWEEN (:start_year, :start_month) AND (:end_year, :end_month)
+    AND (:all_staff OR staff_id IN (SELECT value FROM json_each(:staff_ids)))
+'''
+
+# Holiday dates are excluded from the per-staff marks: they count as paid days
+# for everyone and are reported separately in holiday_days.
+# Salary in force per staff member as half-open [valid_from, valid_to) date
+# ranges. Each salary_history row lasts until the next one and the earliest
+# also covers the days before it; staff without history keep monthly_salary.
+# Filtered by :all_staff / :staff_ids.
+_SALARY_SEGMENTS_SQL = '''
+    SELECT
+        staff_id,
+        salary,
+        CASE WHEN ROW_NUMBER() OVER w = 1 THEN '0001-01-01' ELSE effective_from END AS valid_from,
+        COALESCE(LEAD(effective_from) OVER w, '9999-12-31') AS valid_to
+    FROM salary_history
+    WHERE :all_staff OR staff_id IN (SELECT value FROM json_each(:staff_ids))
+    WINDOW w AS (PARTITION BY staff_id ORDER BY effective_from, id)
+    UNION ALL
+    SELECT id, monthly_salary, '0001-01-01', '9999-12-31'
+    FROM staff
+    WHERE NOT EXISTS (SELECT 1 FROM salary_history h WHERE h.staff_id = staff.id)
+    AND (:all_staff OR id IN (SELECT value FROM json_each(:staff_ids)))
+'''
+
+def salary_at_sql(staff_id, day, fallback):
+    """SQL expression for the salary in force for `staff_id` on `day`.
+
+    Follows the _SALARY_SEGMENTS_SQL rule as two index seeks on
+    idx_salary_history_staff_from, for reports that only need a few days
+    per staff member. Arguments are SQL expressions.
+    """
+    return f'''COALESCE(
+        (SELECT h.salary FROM salary_history h
+         WHERE h.staff_id = {staff_id} AND h.effective_from <= {day}
+         ORDER BY h.effective_from DESC, h.id DESC LIMIT 1),
+        (SELECT h.salary FROM salary_history h
+         WHERE h.staff_id = {staff_id}
+         ORDER BY h.effective_from, h.id LIMIT 1),
+        {fallback})'''
+
+
+_INSERT_MONTHLY_SUMMARY = '''
+    WITH period_holidays AS (
+        SELECT date FROM holidays WHERE date BETWEEN :start AND :end
+    ),
+    salary_segments AS MATERIALIZED ({segments}),
+    {marks},
+    holiday_counts AS (
+        SELECT
+            CAST(substr(date, 1, 4) AS INTEGER) AS year,
+            CAST(substr(date, 6, 2) AS INTEGER) AS month,
+            COUNT(*) AS holiday_days
+        FROM period_holidays
+        GROUP BY year, month
+    ),
+    deductions AS (
+        SELECT
+            a.staff_id,
+            CAST(substr(ar.due_date, 1, 4) AS INTEGER) AS year,
+            CAST(substr(ar.due_date, 6, 2) AS INTEGER) AS month,
+            SUM(ar.amount) AS amount
+        FROM advance_repayments ar
+        JOIN advances a ON ar.advance_id = a.id
+        WHERE ar.due_date BETWEEN :start AND :end
+        AND ar.is_paid = 0
+        AND (:all_staff OR a.staff_id IN (SELECT value FROM json_each(:staff_ids)))
+        GROUP BY a.staff_id, year, month
+    ),
+    -- One pass over both sources; joining them on a union of keys is
+    -- quadratic when SQLite cannot index the grouped CTEs
+    combined AS (
+        SELECT
+            staff_id, year, month, present_days, leave_days, absent_days,
+            present_salary, 0.0 AS amount
+        FROM marks
+        UNION ALL
+        SELECT staff_id, year, month, 0, 0, 0, 0.0, amount
+        FROM deductions
+    )
+    INSERT INTO monthly_summary (
+        year, month, staff_id, present_days, leave_days, absent_days,
+        holiday_days, advance_deduction, present_salary
+    )
+    SELECT
+        c.year, c.month, c.staff_id,
+        SUM(c.present_days),
+        SUM(c.leave_days),
+        SUM(c.absent_days),
+        COALESCE(h.holiday_days, 0),
+        SUM(c.amount),
+        SUM(c.present_salary)
+    FROM combined c
+    LEFT JOIN holiday_counts h ON h.year = c.year AND h.month = c.month
+    GROUP BY c.staff_id, c.year, c.month
+'''
+
+_MONTHLY_SUMMARY_MARKS = {
+    'rows': '''
+    marks AS (
+        SELECT
+            a.staff_id,
+            CAST(substr(a.date, 1, 4) AS INTEGER) AS year,
+            CAST(substr(a.date, 6, 2) AS INTEGER) AS month,
+            SUM(a.is_present = 1) AS present_days,
+            SUM(a.is_present = 0 AND a.is_holiday = 1) AS leave_days,
+            SUM(a.is_present = 0 AND a.is_holiday = 0) AS absent_days,
+            SUM(CASE WHEN a.is_present = 1 THEN COALESCE(g.salary, 0.0) ELSE 0.0 END) AS present_salary
+        FROM attendance a
+        LEFT JOIN salary_segments g
+            ON g.staff_id = a.staff_id AND a.date >= g.valid_from AND a.date < g.valid_to
+        WHERE a.date BETWEEN :start AND :end
+        AND a.date NOT IN (SELECT date FROM period_holidays)
+        AND (:all_staff OR a.staff_id IN (SELECT value FROM json_each(:staff_ids)))
+        GROUP BY a.staff_id, year, month
+    )''',
+    # Same counts from bit masks: holiday dates are masked out, then popcount
+    'bitmap': '''
+    holiday_masks AS (
+        SELECT
+            CAST(substr(date, 1, 4) AS INTEGER) AS year,
+            CAST(substr(date, 6, 2) AS INTEGER) AS month,
+            SUM(1 << (CAST(substr(date, 9, 2) AS INTEGER) - 1)) AS mask
+        FROM period_holidays
+        GROUP BY year, month
+    ),
+    marks AS (
+        SELECT
+            b.staff_id,
+            b.year,
+            b.month,
+            popcount(b.present_mask & ~COALESCE(h.mask, 0)) AS present_days,
+            popcount(b.holiday_mask & ~b.present_mask & ~COALESCE(h.mask, 0)) AS leave_days,
+            popcount(b.marked_mask & ~b.present_mask & ~b.holiday_mask & ~COALESCE(h.mask, 0)) AS absent_days,
+            -- Each salary range overlapping the month pays for the present
+            -- days inside it (see salary_day_mask)
+            COALESCE((
+                SELECT SUM(g.salary * popcount(
+                    b.present_mask & ~COALESCE(h.mask, 0)
+                    & salary_day_mask(b.year, b.month, g.valid_from, g.valid_to)
+                ))
+                FROM salary_segments g
+                WHERE g.staff_id = b.staff_id
+                AND g.valid_from <= printf('%04d-%02d-31', b.year, b.month)
+                AND g.valid_to > printf('%04d-%02d-01', b.year, b.month)
+            ), 0.0) AS present_salary
+        FROM attendance_bitmap b
+        LEFT JOIN holiday_masks h ON h.year = b.year AND h.month = b.month
+        WHERE (b.year, b.month) BETWEEN (:start_year, :start_month) AND (:end_year, :end_month)
+        AND (:all_staff OR b.staff_id IN (SELECT value FROM json_each(:staff_ids)))
+    )''',
+}
+
+
+def refresh_monthly_summary(conn, start, end, staff_ids=None, counters=True):
+    """Recompute monthly_summary for every month touching start..end.
+
+    `conn` may be a connection or cursor inside a write transaction. Limit
+    the work to `staff_ids` when only some staff were affected. The month
+    dashboard counters follow unless `counters` is false.
+    """
+    start = date.fromisoformat(to_date_str(start)).replace(day=1)
+    end = date.fromisoformat(to_date_str(end))
+    end = end.replace(day=calendar.monthrange(end.year, end.month)[1])
+    params = {
+        'start': start.isoformat(),
+        'end': end.isoformat(),
+        'start_year': start.year,
+        'start_month': start.month,
+        'end_year': end.year,
+        'end_month': end.month,
+        'all_staff': int(staff_ids is None),
+        'staff_ids': json.dumps(sorted({int(staff_id) for staff_id in staff_ids or ()})),
+    }
+    marks = _MONTHLY_SUMMARY_MARKS[get_attendance_store(conn)]
+    conn.execute(_DELETE_MONTHLY_SUMMARY, params)
+    conn.execute(_INSERT_MONTHLY_SUMMARY.format(marks=marks, segments=_SALARY_SEGMENTS_SQL), params)
+    if counters:
+        refresh_month_counters(conn, start, end)
+
+
+# Per visible staff member for one month (:year, :month, :start..:end with
+# :holiday_days holidays): salary in force at month end, days present, pay
+# earned before dividing by working days, and advance deductions.
+_MONTHLY_REPORT_SQL = f'''
+    WITH staff_salary AS (
+        SELECT
+            s.id,
+            s.name,
+            {salary_at_sql('s.id', ':end', 's.monthly_salary')} AS monthly_salary,
+            -- Holidays count as present days for everyone; only a
+            -- change inside the month needs each holiday resolved
+            CASE WHEN EXISTS (
+                SELECT 1 FROM salary_history h
+                WHERE h.staff_id = s.id AND h.effective_from > :start AND h.effective_from <= :end
+            ) THEN (
+                SELECT SUM({salary_at_sql('s.id', 'hd.date', 's.monthly_salary')})
+                FROM holidays hd WHERE hd.date BETWEEN :start AND :end
+            ) END AS changed_holiday_salary
+        FROM staff s
+        WHERE (s.hidden IS NULL OR s.hidden = 0)
+        AND (:staff_id IS NULL OR s.id = :staff_id)
+    )
+    SELECT
+        ss.id,
+        ss.name,
+        ss.monthly_salary,
+        COALESCE(ms.present_days, 0) + :holiday_days AS days_present,
+        COALESCE(ms.present_salary, 0.0)
+            + COALESCE(ss.changed_holiday_salary, ss.monthly_salary * :holiday_days) AS earned_salary,
+        COALESCE(ms.advance_deduction, 0.0) AS total_advance
+    FROM staff_salary ss
+    LEFT JOIN monthly_summary ms
+        ON ms.year = :year AND ms.month = :month AND ms.staff_id = ss.id
+    ORDER BY ss.name
+'''
+
+# Visible staff members owing money: advances given minus repayments paid.
+# Each side is totalled on its own so repayment rows do not repeat advances.
+_STAFF_OUTSTANDING_SQL = '''
+    SELECT
+        s.id,
+        s.name,
+        a.total_advance,
+        COALESCE(p.total_paid, 0) AS total_paid,
+        a.total_advance - COALESCE(p.total_paid, 0) AS outstanding
+    FROM staff s
+    JOIN (
+        SELECT staff_id, SUM(amount) AS total_advance
+        FROM advances
+        GROUP BY staff_id
+    ) a ON a.staff_id = s.id
+    LEFT JOIN (
+        SELECT adv.staff_id, SUM(ar.amount) AS total_paid
+        FROM advance_repayments ar
+        JOIN advances adv ON ar.advance_id = adv.id
+        WHERE ar.is_paid = 1
+        GROUP BY adv.staff_id
+    ) p ON p.staff_id = s.id
+    WHERE (s.hidden IS NULL OR s.hidden = 0)
+    AND (:staff_id IS NULL OR s.id = :staff_id)
+    AND a.total_advance - COALESCE(p.total_paid, 0) > 0
+'''
+
+# dashboard_counters names. Attendance counters are per ISO date, month
+# counters per 'YYYY-MM' and staff counters have an empty period.
+ATTENDANCE_COUNTERS = ('attendance_marked', 'attendance_present')
+MONTH_COUNTERS = ('payroll_total', 'month_attended', 'month_marked', 'month_advance')
+STAFF_COUNTERS = ('staff_count', 'outstanding_total')
+
+
+def _replace_counters(conn, names, first, last, rows):
+    """Replace counters `names` for periods first..last with (name, period, value) rows."""
+    conn.execute(f'''
+        DELETE FROM dashboard_counters
+        WHERE name IN ({', '.join('?' * len(names))}) AND period BETWEEN ? AND ?
+    ''', (*names, first, last))
+    conn.executemany('''
+        INSERT INTO dashboard_counters (name, period, value) VALUES (?, ?, ?)
+    ''', [row for row in rows if row[2]])
+
+
+def refresh_attendance_counters(conn, start, end):
+    """Recompute the per-day marked and present counts of visible staff for start..end."""
+    params = {'start': to_date_str(start), 'end': to_date_str(end)}
+    rows = conn.execute(f'''
+        WITH a AS ({attendance_rows_sql(conn)})
+        SELECT a.date, COUNT(*), SUM(a.is_present)
+        FROM a
+        JOIN staff s ON s.id = a.staff_id
+        WHERE s.hidden IS NULL OR s.hidden = 0
+        GROUP BY a.date
+    ''', params).fetchall()
+    _replace_counters(conn, ATTENDANCE_COUNTERS, params['start'], params['end'], [
+        counter
+        for day, marked, present in rows
+        for counter in (('attendance_marked', day, marked), ('attendance_present', day, present))
+    ])
+
+
+def refresh_month_counters(conn, start, end):
+    """Recompute payroll, attendance and advance totals for every month touching start..end.
+
+    Reads monthly_summary, so refresh that first. Months without rollup
+    rows, holidays or advances total zero and keep no counter rows.
+    """
+    start = date.fromisoformat(to_date_str(start)).replace(day=1)
+    end = date.fromisoformat(to_date_str(end))
+    params = {
+        'start': start.isoformat(),
+        'end': end.replace(day=calendar.monthrange(end.year, end.month)[1]).isoformat(),
+        'start_year': start.year,
+        'start_month': start.month,
+        'end_year': end.year,
+        'end_month': end.month,
+    }
+    months = conn.execute('''
+        SELECT DISTINCT year, month FROM monthly_summary
+        WHERE (year, month) BETWEEN (:start_year, :start_month) AND (:end_year, :end_month)
+        UNION
+        SELECT CAST(substr(date, 1, 4) AS INTEGER), CAST(substr(date, 6, 2) AS INTEGER)
+        FROM holidays WHERE date BETWEEN :start AND :end
+        UNION
+        SELECT CAST(substr(date, 1, 4) AS INTEGER), CAST(substr(date, 6, 2) AS INTEGER)
+        FROM advances WHERE date BETWEEN :start AND :end
+    ''', params).fetchall()
+
+    rows = []
+    for year, month in months:
+        num_days = calendar.monthrange(year, month)[1]
+        period = {
+            'year': year,
+            'month': month,
+            'start': date(year, month, 1).isoformat(),
+            'end': date(year, month, num_days).isoformat(),
+            'staff_id': None,
+        }
+        period['holiday_days'] = conn.execute(
+            'SELECT COUNT(*) FROM holidays WHERE date BETWEEN :start AND :end', period
+        ).fetchone()[0]
+        working_days = num_days - period['holiday_days']
+        earned, deducted = conn.execute(f'''
+            SELECT COALESCE(SUM(earned_salary), 0.0), COALESCE(SUM(total_advance), 0.0)
+            FROM ({_MONTHLY_REPORT_SQL})
+        ''', period).fetchone()
+        attended, marked = conn.execute('''
+            SELECT SUM(ms.present_days + ms.leave_days), SUM(ms.present_days + ms.leave_days + ms.absent_days)
+            FROM monthly_summary ms
+            JOIN staff s ON s.id = ms.staff_id
+            WHERE ms.year = :year AND ms.month = :month
+            AND (s.hidden IS NULL OR s.hidden = 0)
+        ''', period).fetchone()
+        advanced = conn.execute(
+            'SELECT SUM(amount) FROM advances WHERE date BETWEEN :start AND :end', period
+        ).fetchone()[0]
+        key = f'{year:04d}-{month:02d}'
+        rows += [
+            ('payroll_total', key, (earned / working_days if working_days > 0 else 0.0) - deducted),
+            ('month_attended', key, attended),
+            ('month_marked', key, marked),
+            ('month_advance', key, advanced),
+        ]
+    _replace_counters(conn, MONTH_COUNTERS, params['start'][:7], params['end'][:7], rows)
+
+
+def adjust_staff_counters(conn, staff_id, sign):
+    """Add (sign=1) or remove (sign=-1) one visible staff member's share of
+    the per-day attendance and per-month payroll and attendance counters.
+
+    Call after adding a staff member, or before hiding one. Only what they
+    can contribute to is read: their own attendance, months in their
+    monthly_summary rows, and months with holidays, which pay everyone.
+    month_advance counts hidden staff too and is left alone.
+    """
+    conn.execute(f'''
+        INSERT INTO dashboard_counters (name, period, value)
+        SELECT * FROM (
+            SELECT 'attendance_marked', date, :sign * COUNT(*)
+            FROM ({attendance_rows_sql(conn)}) WHERE staff_id = :staff_id GROUP BY date
+            UNION ALL
+            SELECT 'attendance_present', date, :sign * SUM(is_present)
+            FROM ({attendance_rows_sql(conn)}) WHERE staff_id = :staff_id GROUP BY date
+        ) WHERE true
+        ON CONFLICT (name, period) DO UPDATE SET value = value + excluded.value
+    ''', {'sign': sign, 'staff_id': staff_id, 'start': date.min.isoformat(), 'end': date.max.isoformat()})
+
+    months = conn.execute('''
+        SELECT year, month FROM monthly_summary WHERE staff_id = ?
+        UNION
+        SELECT DISTINCT CAST(substr(date, 1, 4) AS INTEGER), CAST(substr(date, 6, 2) AS INTEGER)
+        FROM holidays
+    ''', (staff_id,)).fetchall()
+
+    rows = []
+    for year, month in months:
+        num_days = calendar.monthrange(year, month)[1]
+        period = {
+            'year': year,
+            'month': month,
+            'start': date(year, month, 1).isoformat(),
+            'end': date(year, month, num_days).isoformat(),
+            'staff_id': staff_id,
+        }
+        period['holiday_days'] = conn.execute(
+            'SELECT COUNT(*) FROM holidays WHERE date BETWEEN :start AND :end', period
+        ).fetchone()[0]
+        working_days = num_days - period['holiday_days']
+        earned, deducted = conn.execute(f'''
+            SELECT COALESCE(SUM(earned_salary), 0.0), COALESCE(SUM(total_advance), 0.0)
+            FROM ({_MONTHLY_REPORT_SQL})
+        ''', period).fetchone()
+        attended, marked = conn.execute('''
+            SELECT present_days + leave_days, present_days + leave_days + absent_days
+            FROM monthly_summary WHERE staff_id = :staff_id AND year = :year AND month = :month
+        ''', period).fetchone() or (0, 0)
+        key = f'{year:04d}-{month:02d}'
+        rows += [
+            ('payroll_total', key, sign * ((earned / working_days if working_days > 0 else 0.0) - deducted)),
+            ('month_attended', key, sign * attended),
+            ('month_marked', key, sign * marked),
+        ]
+    conn.executemany('''
+        INSERT INTO dashboard_counters (name, period, value) VALUES (?, ?, ?)
+        ON CONFLICT (name, period) DO UPDATE SET value = value + excluded.value
+    ''', [row for row in rows if row[2]])
+
+
+def refresh_staff_counters(conn):
+    """Recompute the visible staff count and the total outstanding advances."""
+    staff_count = conn.execute('SELECT COUNT(*) FROM staff WHERE hidden IS NULL OR hidden = 0').fetchone()[0]
+    outstanding = conn.execute(
+        f'SELECT SUM(outstanding) FROM ({_STAFF_OUTSTANDING_SQL})', {'staff_id': None}
+    ).fetchone()[0]
+    _replace_counters(conn, STAFF_COUNTERS, '', '', [
+        ('staff_count', '', staff_count),
+        ('outstanding_total', '', outstanding),
+    ])
+
+
+def fetch_columns(conn, sql, params, count):
+    """Run a query and return its result as `count` NumPy column arrays."""
+    rows = np.array(conn.execute(sql, params).fetchall()).reshape(-1, count)
+    return [rows[:, i] for i in range(count)]
+
+
+def get_schema_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def run_migrations(connections):
+    """Apply pending migrations, each in its own transaction."""
+    if get_schema_version(connections.connection()) >= SCHEMA_VERSION:
+        return
+    rebuild = False
+    for version, description, migrate in MIGRATIONS:
+        with connections.transaction() as conn:
+            # Re-check under the write lock in case another process migrated first
+            if get_schema_version(conn) >= version:
+                continue
+            print(f"Applying schema migration {version}: {description}")
+            migrate(conn.cursor())
+            rebuild = rebuild or version in ROLLUP_MIGRATIONS
+            # Rebuild in the same transaction as the final migration, so an
+            # upgraded database is never current with stale rollups
+            if rebuild and version == SCHEMA_VERSION:
+                print("Rebuilding monthly summary and dashboard counters")
+                rebuild_rollups(conn)
+            conn.execute(f'PRAGMA user_version = {version}')
+
+
+def rebuild_rollups(conn):
+    """Recompute the monthly_summary rollup and dashboard counters from raw rows."""
+    conn.execute('DELETE FROM monthly_summary')
+    conn.execute('DELETE FROM dashboard_counters')
+    refresh_monthly_summary(conn, date.min, date.max)
+    refresh_attendance_counters(conn, date.min, date.max)
+    refresh_staff_counters(conn)
+
+
+def matrix_report_range(matrix, granularity='month'):
+    """Database.get_report_range rows computed from a PayrollMatrix."""
+    firsts = matrix.days[matrix.month_starts].astype(object)
+    lasts = matrix.days[np.append(matrix.month_starts[1:], len(matrix.days)) - 1]
+    labels = [_REPORT_PERIOD_LABELS[granularity](day.year, day.month) for day in firsts]
+    present = matrix.present_days()
+    working = matrix.working_days()
+    calculated = matrix.calculated_salary()
+
+    frames = []
+    for period in dict.fromkeys(labels):
+        columns = [i for i, label in enumerate(labels) if label == period]
+        period_end = lasts[columns[-1]]
+        period_calculated = calculated[:, columns].sum(axis=1)
+        total_advance = matrix.deductions[:, columns].sum(axis=1)
+        frames.append(pd.DataFrame({
+            'period': period,
+            'period_start': firsts[columns[0]].isoformat(),
+            'period_end': str(period_end),
+            'id': matrix.staff_ids,
+            'name': matrix.names,
+            'monthly_salary': matrix.daily_salary[:, matrix.day_offset(period_end)],
+            'days_present': present[:, columns].sum(axis=1),
+            'working_days': int(working[columns].sum()),
+            'calculated_salary': period_calculated,
+            'total_advance': total_advance,
+            'final_salary': period_calculated - total_advance,
+        }))
+    return pd.concat(frames, ignore_index=True)[REPORT_RANGE_COLUMNS]
+
 
 class Database:
     def __init__(self, db_name="staff.db"):
-        print(f"Using database file: {db_name}")
         self.db_name = db_name
+        self.connections = get_connection_manager(db_name)
         self.init_db()
 
     def get_connection(self):
-        return sqlite3.connect(self.db_name)
-
-    def init_db(self):
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
-            
-            # Staff table
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS staff (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    name TEXT NOT NULL,
-                    phone TEXT,
-                    monthly_salary REAL NOT NULL,
-                    salary_cycle_start INTEGER DEFAULT 1,
-                    salary_cycle_end INTEGER DEFAULT 31,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
+        return self.connections.connection()
 
-            # Salary history table
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS salary_history (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    staff_id INTEGER,
-                    salary REAL NOT NULL,
-                    effective_from DATE NOT NULL,
-                    effective_to DATE,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (staff_id) REFERENCES staff (id)
-                )
-            ''')
-
-            # Attendance table
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS attendance (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    staff_id INTEGER,
-                    date DATE NOT NULL,
-                    is_present BOOLEAN DEFAULT 1,
-                    is_holiday BOOLEAN DEFAULT 0,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (staff_id) REFERENCES staff (id),
-                    UNIQUE(staff_id, date)
-                )
-            ''')
+    def transaction(self, invalidates=True):
+        return self.connections.transaction(invalidates)
 
-            # Advances table
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS advances (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    staff_id INTEGER,
-                    amount REAL NOT NULL,
-                    date DATE NOT NULL,
-                    repayment_type TEXT CHECK(repayment_type IN ('OneTime', 'Weekly', 'Monthly')),
-                    emi_amount REAL,
-                    total_emi_count INTEGER,
-                    remaining_amount REAL,
-                    status TEXT DEFAULT 'Active' CHECK(status IN ('Active', 'Completed')),
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (staff_id) REFERENCES staff (id)
-                )
-            ''')
-
-            # Advance repayments table
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS advance_repayments (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    advance_id INTEGER,
-                    amount REAL NOT NULL,
-                    due_date DATE NOT NULL,
-                    is_paid BOOLEAN DEFAULT 0,
-                    paid_date DATE,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (advance_id) REFERENCES advances (id)
-                )
-            ''')
+    def get_data_generation(self):
+        return self.connections.data_generation()
 
-            # Settings table
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS settings (
-                    key TEXT PRIMARY KEY,
-                    value TEXT NOT NULL
-                )
-            ''')
+    def get_connection_stats(self):
+        """Connection reuse counters: fresh opens versus reused thread connections."""
+        return dict(self.connections.stats)
 
-            # Users table
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS users (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    username TEXT UNIQUE NOT NULL,
-                    password TEXT NOT NULL,
-                    role TEXT NOT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
+    def init_db(self):
+        """Migrate and seed the database once per file, process and schema version."""
+        manager = self.connections
+        if manager.bootstrapped_version == SCHEMA_VERSION:
+            return
+        with manager.bootstrap_lock:
+            if manager.bootstrapped_version == SCHEMA_VERSION:
+                return
+            print(f"Using database file: {self.db_name}")
+            run_migrations(manager)
+            self._seed_defaults()
+            manager.bootstrapped_version = SCHEMA_VERSION
 
-            # Holidays table
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS holidays (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    date DATE NOT NULL,
-                    name TEXT NOT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    UNIQUE(date)
-                )
-            ''')
+    def _seed_defaults(self):
+        with self.transaction() as conn:
+            cursor = conn.cursor()
 
             # Insert default settings if not exists
             cursor.execute('''
@@ -128,19 +1318,13 @@ class Database:
                     ('salary_cycle_end', '31')
             ''')
             
-            # Insert default admin user 'Krish' if not exists
-            cursor.execute('''
-                INSERT OR IGNORE INTO users (username, password, role)
-                VALUES ('Krish', ?, 'admin')
-            ''', (self._hash_password('Krish@9777'),))
-            
-            # Add hidden column to staff table if it doesn't exist
-            try:
-                cursor.execute("ALTER TABLE staff ADD COLUMN hidden INTEGER DEFAULT 0")
-            except Exception as e:
-                pass  # Ignore if column already exists
-            
-            conn.commit()
+            # Insert default admin user 'Krish' if not exists; bcrypt only runs when inserting
+            cursor.execute("SELECT 1 FROM users WHERE username = 'Krish'")
+            if cursor.fetchone() is None:
+                cursor.execute('''
+                    INSERT INTO users (username, password, role)
+                    VALUES ('Krish', ?, 'admin')
+                ''', (self._hash_password('Krish@9777'),))
 
     def _hash_password(self, password):
         return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
@@ -150,37 +1334,35 @@ class Database:
     
     # User Management
     def create_user(self, username, password, role):
-        with self.get_connection() as conn:
+        with self.transaction() as conn:
             cursor = conn.cursor()
             hashed_password = self._hash_password(password)
             cursor.execute('''
                 INSERT INTO users (username, password, role)
                 VALUES (?, ?, ?)
             ''', (username, hashed_password, role))
-            conn.commit()
             return cursor.lastrowid
     
     def verify_user(self, username, password):
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute('SELECT password, role FROM users WHERE username = ?', (username,))
-            result = cursor.fetchone()
-            if result and self._check_password(password, result[0]):
-                return result[1]  # Return role
-            return None
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('SELECT password, role FROM users WHERE username = ?', (username,))
+        result = cursor.fetchone()
+        if result and self._check_password(password, result[0]):
+            return result[1]  # Return role
+        return None
     
     def get_all_users(self):
-        with self.get_connection() as conn:
-            return pd.read_sql_query("SELECT id, username, role FROM users", conn)
+        conn = self.get_connection()
+        return pd.read_sql_query("SELECT id, username, role FROM users", conn)
     
     def delete_user(self, user_id):
-        with self.get_connection() as conn:
+        with self.transaction() as conn:
             cursor = conn.cursor()
             cursor.execute('DELETE FROM users WHERE id = ?', (user_id,))
-            conn.commit()
 
     def update_user(self, user_id, new_username=None, new_password=None):
-        with self.get_connection() as conn:
+        with self.transaction() as conn:
             cursor = conn.cursor()
             if new_username and new_password:
                 hashed_password = self._hash_password(new_password)
@@ -196,12 +1378,11 @@ class Database:
                 cursor.execute('''
                     UPDATE users SET password = ? WHERE id = ?
                 ''', (hashed_password, user_id))
-            conn.commit()
 
     # Staff Management
     def add_staff(self, name, phone, monthly_salary, salary_cycle_start, salary_cycle_end):
         try:
-            with self.get_connection() as conn:
+            with self.transaction() as conn:
                 cursor = conn.cursor()
                 # Check for duplicate phone number
                 cursor.execute("SELECT id FROM staff WHERE phone = ?", (phone,))
@@ -212,215 +1393,193 @@ class Database:
                     INSERT INTO staff (name, phone, monthly_salary, salary_cycle_start, salary_cycle_end)
                     VALUES (?, ?, ?, ?, ?)
                 """, (name, phone, monthly_salary, salary_cycle_start, salary_cycle_end))
-                conn.commit()
+                staff_id = cursor.lastrowid
+                # Everyone is paid for holidays, so every holiday month's payroll grows
+                refresh_staff_counters(cursor)
+                adjust_staff_counters(cursor, staff_id, 1)
             return True, "Staff added successfully"
         except Exception as e:
             return False, f"Error adding staff: {str(e)}"
 
     def get_all_staff(self):
-        with self.get_connection() as conn:
-            return pd.read_sql_query("SELECT * FROM staff WHERE hidden IS NULL OR hidden = 0 ORDER BY name", conn)
+        conn = self.get_connection()
+        return pd.read_sql_query("SELECT * FROM staff WHERE hidden IS NULL OR hidden = 0 ORDER BY name", conn)
+
+    def get_staff_directory(self, staff_ids=None):
+        """{id: (name, phone)} for visible staff, limited to `staff_ids` when given."""
+        ids = None if staff_ids is None else json.dumps([int(staff_id) for staff_id in staff_ids])
+        conn = self.get_connection()
+        rows = conn.execute('''
+            SELECT id, name, phone FROM staff
+            WHERE (hidden IS NULL OR hidden = 0)
+            AND (:ids IS NULL OR id IN (SELECT value FROM json_each(:ids)))
+        ''', {'ids': ids}).fetchall()
+        return {staff_id: (name, phone) for staff_id, name, phone in rows}
 
     def update_staff(self, staff_id, name, phone, monthly_salary):
-        with self.get_connection() as conn:
+        """Edit staff details. A salary edit here corrects the salary currently
+        in force; use update_staff_salary for a dated change."""
+        with self.transaction() as conn:
             cursor = conn.cursor()
+            cursor.execute('SELECT monthly_salary FROM staff WHERE id = ?', (staff_id,))
+            previous = cursor.fetchone()
             cursor.execute('''
                 UPDATE staff
                 SET name = ?, phone = ?, monthly_salary = ?
                 WHERE id = ?
             ''', (name, phone, monthly_salary, staff_id))
-            conn.commit()
+            if previous and previous[0] != monthly_salary:
+                cursor.execute('''
+                    UPDATE salary_history SET salary = ?
+                    WHERE id = (
+                        SELECT id FROM salary_history WHERE staff_id = ?
+                        ORDER BY effective_from DESC, id DESC LIMIT 1
+                    )
+                ''', (monthly_salary, staff_id))
+                refresh_monthly_summary(cursor, date.min, date.max, [staff_id])
 
     def delete_staff(self, staff_id):
         try:
-            with self.get_connection() as conn:
+            with self.transaction() as conn:
                 cursor = conn.cursor()
-                cursor.execute("UPDATE staff SET hidden = 1 WHERE id = ?", (staff_id,))
-                conn.commit()
+                visible = cursor.execute(
+                    'SELECT 1 FROM staff WHERE id = ? AND (hidden IS NULL OR hidden = 0)', (staff_id,)
+                ).fetchone()
+                if visible:
+                    # Hidden staff drop out of every dashboard figure
+                    adjust_staff_counters(cursor, staff_id, -1)
+                    cursor.execute('UPDATE staff SET hidden = 1 WHERE id = ?', (staff_id,))
+                    refresh_staff_counters(cursor)
             return True, "Staff member hidden successfully"
         except Exception as e:
             return False, f"Error hiding staff: {str(e)}"
 
     # Holiday Management
-    def add_holiday(self, date, name):
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                INSERT OR REPLACE INTO holidays (date, name)
-                VALUES (?, ?)
-            ''', (date, name))
-            conn.commit()
-            
-            # Mark all staff as present on this holiday
-            staff_df = self.get_all_staff()
-            for _, staff in staff_df.iterrows():
-                self.mark_attendance(staff['id'], date, True, True)
-            
-            return cursor.lastrowid
-    
-    def get_holidays(self, year=None, month=None, start_date=None, end_date=None):
-        """Get all holidays within a date range"""
-        try:
-            with self.get_connection() as conn:
-                if year is not None and month is not None:
-                    # Get holidays for a specific month
-                    first_day = f"{year}-{month:02d}-01"
-                    last_day = f"{year}-{month:02d}-31"
-                    return pd.read_sql_query('''
-                        SELECT id, date, name FROM holidays 
-                        WHERE date BETWEEN ? AND ?
-                        ORDER BY date
-                    ''', conn, params=(first_day, last_day))
-                elif start_date and end_date:
-                    return pd.read_sql_query('''
-                        SELECT id, date, name FROM holidays 
-                        WHERE date BETWEEN ? AND ?
-                        ORDER BY date
-                    ''', conn, params=(start_date, end_date))
-                else:
-                    return pd.read_sql_query('''
-                        SELECT id, date, name FROM holidays 
-                        ORDER BY date
-                    ''', conn)
-        except Exception as e:
-            print(f"Error in get_holidays: {e}")
-            return pd.DataFrame(columns=['id', 'date', 'name'])
-
     def delete_holiday(self, holiday_id):
-        with self.get_connection() as conn:
+        with self.transaction() as conn:
             cursor = conn.cursor()
+            row = cursor.execute('SELECT date FROM holidays WHERE id = ?', (holiday_id,)).fetchone()
             cursor.execute('DELETE FROM holidays WHERE id = ?', (holiday_id,))
-            conn.commit()
+            if row:
+                refresh_monthly_summary(conn, row[0], row[0])
     
-    def is_holiday(self, date):
-        """Check if a given date is a holiday"""
-        try:
-            cursor = self.get_connection().cursor()
-            cursor.execute('SELECT 1 FROM holidays WHERE date = ?', (date,))
-            return cursor.fetchone() is not None
-        except Exception as e:
-            print(f"Error in is_holiday: {e}")
-            return False
 
     # Attendance Management
     def mark_attendance(self, staff_id, date, is_present, is_holiday=False):
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                INSERT OR REPLACE INTO attendance (staff_id, date, is_present, is_holiday)
-                VALUES (?, ?, ?, ?)
-            ''', (staff_id, date, is_present, is_holiday))
-            conn.commit()
+        self.mark_attendance_bulk([(staff_id, date, is_present, is_holiday)])
+
+    def mark_attendance_bulk(self, rows):
+        """Upsert many attendance marks in a single transaction.
+
+        `rows` is a sequence of (staff_id, date, is_present, is_holiday) tuples
+        or a DataFrame with those columns. Returns the number of rows changed;
+        marks identical to what is already stored are not rewritten.
+        """
+        if isinstance(rows, pd.DataFrame):
+            rows = rows[ATTENDANCE_MARK_COLUMNS].itertuples(index=False, name=None)
+        params = [
+            (int(staff_id), to_date_str(day), int(bool(is_present)), int(bool(is_holiday)))
+            for staff_id, day, is_present, is_holiday in rows
+        ]
+        if not params:
+            return 0
+        with self.transaction() as conn:
+            if get_attendance_store(conn) == 'bitmap':
+                cursor = conn.executemany(_UPSERT_ATTENDANCE_BITS, [
+                    (staff_id, *date_bit(day), is_present, is_holiday)
+                    for staff_id, day, is_present, is_holiday in params
+                ])
+            else:
+                cursor = conn.executemany('''
+                    INSERT INTO attendance (staff_id, date, is_present, is_holiday)
+                    VALUES (?, ?, ?, ?)
+                    ON CONFLICT (staff_id, date) DO UPDATE SET
+                        is_present = excluded.is_present,
+                        is_holiday = excluded.is_holiday
+                    WHERE is_present IS NOT excluded.is_present
+                    OR is_holiday IS NOT excluded.is_holiday
+                ''', params)
+            changed = cursor.rowcount
+            if changed:
+                days = [row[1] for row in params]
+                refresh_monthly_summary(conn, min(days), max(days), {row[0] for row in params})
+                refresh_attendance_counters(conn, min(days), max(days))
+            return changed
 
     def get_attendance(self, date):
-        with self.get_connection() as conn:
-            # Check if the date is a holiday
-            is_holiday = self.is_holiday(date)
-            
-            # Get attendance data
-            attendance_df = pd.read_sql_query('''
-                SELECT 
-                    s.id, 
-                    s.name, 
-                    COALESCE(a.is_present, 0) as is_present,
-                    COALESCE(a.is_holiday, 0) as is_holiday
-                FROM staff s
-                LEFT JOIN attendance a ON s.id = a.staff_id AND a.date = ?
-                ORDER BY s.name
-            ''', conn, params=(date,))
-            
-            # Convert numeric values to boolean
-            attendance_df['is_present'] = attendance_df['is_present'].astype(bool)
-            attendance_df['is_holiday'] = attendance_df['is_holiday'].astype(bool)
-            
-            # If it's a holiday, mark all staff as present
-            if is_holiday:
-                attendance_df['is_present'] = True
-                attendance_df['is_holiday'] = True
-            
-            return attendance_df
+        conn = self.get_connection()
+        # Check if the date is a holiday
+        is_holiday = self.is_holiday(date)
+        
+        # Get attendance data
+        day = to_date_str(date)
+        attendance_df = pd.read_sql_query(f'''
+            WITH a AS ({attendance_rows_sql(conn)})
+            SELECT 
+                s.id, 
+                s.name, 
+                COALESCE(a.is_present, 0) as is_present,
+                COALESCE(a.is_holiday, 0) as is_holiday
+            FROM staff s
+            LEFT JOIN a ON s.id = a.staff_id
+            ORDER BY s.name
+        ''', conn, params={'start': day, 'end': day})
+        
+        # Convert numeric values to boolean
+        attendance_df['is_present'] = attendance_df['is_present'].astype(bool)
+        attendance_df['is_holiday'] = attendance_df['is_holiday'].astype(bool)
+        
+        # If it's a holiday, mark all staff as present
+        if is_holiday:
+            attendance_df['is_present'] = True
+            attendance_df['is_holiday'] = True
+        
+        return attendance_df
     
     def get_monthly_attendance(self, year, month):
-        with self.get_connection() as conn:
-            # Get the first and last day of the month
-            first_day = f"{year}-{month:02d}-01"
-            last_day = f"{year}-{month:02d}-31"
-            
-            # Get all staff
-            staff_df = pd.read_sql_query("SELECT id, name FROM staff", conn)
-            
-            # Get all attendance records for the month
-            attendance_df = pd.read_sql_query('''
-                SELECT staff_id, date, is_present, is_holiday
-                FROM attendance
-                WHERE date BETWEEN ? AND ?
-            ''', conn, params=(first_day, last_day))
-            
-            # Get all holidays for the month
-            holidays_df = self.get_holidays(year, month)
-            
-            # Create a pivot table for the calendar view
-            if not attendance_df.empty:
-                pivot_df = attendance_df.pivot(
-                    index='staff_id', 
-                    columns='date', 
-                    values='is_present'
-                ).fillna(False)
-                
-                # Merge with staff names
-                result_df = staff_df.merge(pivot_df, left_on='id', right_index=True)
-                
-                # Add holiday information
-                if not holidays_df.empty:
-                    for _, holiday in holidays_df.iterrows():
-                        holiday_date = holiday['date']
-                        if holiday_date in result_df.columns:
-                            result_df[holiday_date] = 'Leave'
-                            # Add a note that this is a holiday
-                            result_df.rename(columns={holiday_date: f"{holiday_date} (Holiday: {holiday['name']})"}, inplace=True)
-                
-                return result_df
-            else:
-                return staff_df
+        """get_attendance_calendar as a DataFrame: id, name and a status
+        label ('Present', 'Absent', 'Leave', 'Holiday' or '') per day."""
+        return self.get_attendance_calendar(year, month).to_frame()
 
     def get_monthly_attendance_for_staff(self, staff_id, year, month):
         """Get attendance records for a specific staff member in a given month."""
-        with self.get_connection() as conn:
-            # Get all dates in the month
-            first_day = date(year, month, 1)
-            if month == 12:
-                last_day = date(year + 1, 1, 1) - timedelta(days=1)
-            else:
-                last_day = date(year, month + 1, 1) - timedelta(days=1)
-            
-            # Get attendance records
-            attendance = pd.read_sql_query('''
-                WITH RECURSIVE dates(date) AS (
-                    SELECT date(?)
-                    UNION ALL
-                    SELECT date(date, '+1 day')
-                    FROM dates
-                    WHERE date < date(?)
-                )
-                SELECT 
-                    d.date,
-                    COALESCE(a.is_present, 0) as is_present,
-                    COALESCE(
-                        (SELECT 1 FROM holidays h WHERE h.date = d.date),
-                        0
-                    ) as is_holiday
-                FROM dates d
-                LEFT JOIN attendance a ON d.date = a.date AND a.staff_id = ?
-            ''', conn, params=(first_day, last_day, staff_id))
-            
-            # Convert date strings to datetime
-            attendance['date'] = pd.to_datetime(attendance['date'])
-            
-            # Ensure boolean columns
-            attendance['is_present'] = attendance['is_present'].astype(bool)
-            attendance['is_holiday'] = attendance['is_holiday'].astype(bool)
-            
-            return attendance
+        conn = self.get_connection()
+        # Get all dates in the month
+        first_day = date(year, month, 1)
+        if month == 12:
+            last_day = date(year + 1, 1, 1) - timedelta(days=1)
+        else:
+            last_day = date(year, month + 1, 1) - timedelta(days=1)
+        
+        # Get attendance records
+        attendance = pd.read_sql_query(f'''
+            WITH RECURSIVE dates(date) AS (
+                SELECT date(:start)
+                UNION ALL
+                SELECT date(date, '+1 day')
+                FROM dates
+                WHERE date < date(:end)
+            ),
+            a AS ({attendance_rows_sql(conn)})
+            SELECT 
+                d.date,
+                COALESCE(a.is_present, 0) as is_present,
+                COALESCE(
+                    (SELECT 1 FROM holidays h WHERE h.date = d.date),
+                    0
+                ) as is_holiday
+            FROM dates d
+            LEFT JOIN a ON d.date = a.date AND a.staff_id = :staff_id
+        ''', conn, params={'start': first_day.isoformat(), 'end': last_day.isoformat(), 'staff_id': int(staff_id)})
+        
+        # Convert date strings to datetime
+        attendance['date'] = pd.to_datetime(attendance['date'])
+        
+        # Ensure boolean columns
+        attendance['is_present'] = attendance['is_present'].astype(bool)
+        attendance['is_holiday'] = attendance['is_holiday'].astype(bool)
+        
+        return attendance
 
     def get_working_days_in_month(self, year, month):
         """Get the number of working days in a month (excluding holidays)."""
@@ -434,17 +1593,17 @@ class Database:
             WHERE strftime('%Y', date) = ? AND strftime('%m', date) = ?
         """
         
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute(query, (str(year), str(month).zfill(2)))
-            holiday_count = cursor.fetchone()[0]
-            
-            # Return total days minus holidays
-            return num_days - holiday_count
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute(query, (str(year), str(month).zfill(2)))
+        holiday_count = cursor.fetchone()[0]
+        
+        # Return total days minus holidays
+        return num_days - holiday_count
 
     # Advance Management
     def add_advance(self, staff_id, amount, date, repayment_months=1):
-        with self.get_connection() as conn:
+        with self.transaction() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 INSERT INTO advances (staff_id, amount, date)
@@ -481,118 +1640,149 @@ class Database:
                     VALUES (?, ?, ?)
                 ''', (advance_id, amount, due_date))
             
-            conn.commit()
+            first_due, last_due = cursor.execute(
+                'SELECT MIN(due_date), MAX(due_date) FROM advance_repayments WHERE advance_id = ?',
+                (advance_id,)
+            ).fetchone()
+            refresh_monthly_summary(conn, first_due, last_due, [staff_id])
+            refresh_month_counters(conn, date, date)
+            refresh_staff_counters(conn)
             return advance_id
 
     def get_advances(self, staff_id, start_date, end_date):
-        with self.get_connection() as conn:
-            return pd.read_sql_query('''
-                SELECT * FROM advances
-                WHERE staff_id = ? AND date BETWEEN ? AND ?
-                ORDER BY date
-            ''', conn, params=(staff_id, start_date, end_date))
+        conn = self.get_connection()
+        return pd.read_sql_query('''
+            SELECT * FROM advances
+            WHERE staff_id = ? AND date BETWEEN ? AND ?
+            ORDER BY date
+        ''', conn, params=(staff_id, start_date, end_date))
     
     def get_pending_advances(self, staff_id=None):
-        with self.get_connection() as conn:
-            query = '''
-                SELECT 
-                    a.id as advance_id,
-                    s.id as staff_id,
-                    s.name as staff_name,
-                    a.amount as total_amount,
-                    a.date as advance_date,
-                    SUM(CASE WHEN ar.is_paid = 0 THEN ar.amount ELSE 0 END) as pending_amount,
-                    COUNT(CASE WHEN ar.is_paid = 0 THEN 1 END) as pending_installments
-                FROM advances a
-                JOIN staff s ON a.staff_id = s.id
-                LEFT JOIN advance_repayments ar ON a.id = ar.advance_id
-            '''
-            
-            params = []
-            if staff_id:
-                query += ' WHERE s.id = ?'
-                params.append(staff_id)
-            
-            query += ' GROUP BY a.id, s.id, s.name, a.amount, a.date'
-            query += ' HAVING pending_amount > 0'
-            
-            return pd.read_sql_query(query, conn, params=params)
+        conn = self.get_connection()
+        query = '''
+            SELECT 
+                a.id as advance_id,
+                s.id as staff_id,
+                s.name as staff_name,
+                a.amount as total_amount,
+                a.date as advance_date,
+                SUM(CASE WHEN ar.is_paid = 0 THEN ar.amount ELSE 0 END) as pending_amount,
+                COUNT(CASE WHEN ar.is_paid = 0 THEN 1 END) as pending_installments
+            FROM advances a
+            JOIN staff s ON a.staff_id = s.id
+            LEFT JOIN advance_repayments ar ON a.id = ar.advance_id
+        '''
+        
+        params = []
+        if staff_id:
+            query += ' WHERE s.id = ?'
+            params.append(staff_id)
+        
+        query += ' GROUP BY a.id, s.id, s.name, a.amount, a.date'
+        query += ' HAVING pending_amount > 0'
+        
+        return pd.read_sql_query(query, conn, params=params)
     
-    def mark_repayment_paid(self, repayment_id):
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                UPDATE advance_repayments
-                SET is_paid = 1
-                WHERE id = ?
-            ''', (repayment_id,))
-            conn.commit()
-
     # Settings Management
     def get_working_days(self):
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute('SELECT value FROM settings WHERE key = "working_days"')
-            result = cursor.fetchone()
-            return int(result[0]) if result else 26
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('SELECT value FROM settings WHERE key = "working_days"')
+        result = cursor.fetchone()
+        return int(result[0]) if result else 26
 
     def set_working_days(self, days):
-        with self.get_connection() as conn:
+        with self.transaction() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 INSERT OR REPLACE INTO settings (key, value)
                 VALUES ("working_days", ?)
             ''', (str(days),))
-            conn.commit()
     
     def get_setting(self, key, default=None):
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute('SELECT value FROM settings WHERE key = ?', (key,))
-            result = cursor.fetchone()
-            return result[0] if result else default
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('SELECT value FROM settings WHERE key = ?', (key,))
+        result = cursor.fetchone()
+        return result[0] if result else default
     
     def set_setting(self, key, value):
-        with self.get_connection() as conn:
+        with self.transaction() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 INSERT OR REPLACE INTO settings (key, value)
                 VALUES (?, ?)
             ''', (key, str(value)))
-            conn.commit()
 
     def get_salary_cycle(self):
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute('SELECT value FROM settings WHERE key IN ("salary_cycle_start", "salary_cycle_end")')
-            results = cursor.fetchall()
-            return {
-                'start': int(results[0][0]),
-                'end': int(results[1][0])
-            }
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('SELECT value FROM settings WHERE key IN ("salary_cycle_start", "salary_cycle_end")')
+        results = cursor.fetchall()
+        return {
+            'start': int(results[0][0]),
+            'end': int(results[1][0])
+        }
 
     def set_salary_cycle(self, start_day, end_day):
-        with self.get_connection() as conn:
+        with self.transaction() as conn:
             cursor = conn.cursor()
             cursor.execute('UPDATE settings SET value = ? WHERE key = "salary_cycle_start"', (str(start_day),))
             cursor.execute('UPDATE settings SET value = ? WHERE key = "salary_cycle_end"', (str(end_day),))
-            conn.commit()
 
     def update_staff_salary(self, staff_id, new_salary, effective_from):
-        with self.get_connection() as conn:
+        """Record a salary change that takes effect on `effective_from`.
+
+        Payroll pays each day at the salary in force that day, so the first
+        change also records the salary it replaces, from when the staff
+        member joined or was first marked. A change dated before both
+        leaves nothing for the old salary to cover and records no such row.
+        """
+        effective_from = to_date_str(effective_from)
+        with self.transaction() as conn:
             cursor = conn.cursor()
-            # End the previous salary record
+            cursor.execute(f'''
+                SELECT MIN(date) FROM ({attendance_rows_sql(conn)}) WHERE staff_id = :staff_id
+            ''', {'start': date.min.isoformat(), 'end': effective_from, 'staff_id': staff_id})
+            first_marked = cursor.fetchone()[0]
             cursor.execute('''
-                UPDATE salary_history 
-                SET effective_to = ? 
-                WHERE staff_id = ? AND effective_to IS NULL
-            ''', (effective_from, staff_id))
+                INSERT INTO salary_history (staff_id, salary, effective_from, effective_to)
+                SELECT id, monthly_salary, seed_from, :effective_from
+                FROM (
+                    SELECT id, monthly_salary, MIN(
+                        COALESCE(date(created_at), :effective_from),
+                        COALESCE(:first_marked, :effective_from)
+                    ) AS seed_from
+                    FROM staff
+                    WHERE id = :staff_id
+                )
+                WHERE seed_from < :effective_from
+                AND NOT EXISTS (SELECT 1 FROM salary_history WHERE staff_id = :staff_id)
+            ''', {'staff_id': staff_id, 'effective_from': effective_from, 'first_marked': first_marked})
+
+            # Days from effective_from change pay, or every day when this
+            # becomes the earliest record
+            cursor.execute('SELECT MIN(effective_from) FROM salary_history WHERE staff_id = ?', (staff_id,))
+            earliest = cursor.fetchone()[0]
+            refresh_from = effective_from if earliest is not None and earliest <= effective_from else date.min
             
             # Add new salary record
             cursor.execute('''
                 INSERT INTO salary_history (staff_id, salary, effective_from)
                 VALUES (?, ?, ?)
             ''', (staff_id, new_salary, effective_from))
+
+            # Each record ends where the next one (by date, then insertion) starts
+            cursor.execute('''
+                UPDATE salary_history
+                SET effective_to = (
+                    SELECT n.effective_from FROM salary_history n
+                    WHERE n.staff_id = salary_history.staff_id
+                    AND (n.effective_from, n.id) > (salary_history.effective_from, salary_history.id)
+                    ORDER BY n.effective_from, n.id LIMIT 1
+                )
+                WHERE staff_id = ?
+            ''', (staff_id,))
             
             # Update current salary in staff table
             cursor.execute('''
@@ -600,19 +1790,18 @@ class Database:
                 SET monthly_salary = ? 
                 WHERE id = ?
             ''', (new_salary, staff_id))
-            
-            conn.commit()
+            refresh_monthly_summary(cursor, refresh_from, date.max, [staff_id])
 
     def get_staff_salary_history(self, staff_id):
-        with self.get_connection() as conn:
-            return pd.read_sql_query('''
-                SELECT * FROM salary_history 
-                WHERE staff_id = ? 
-                ORDER BY effective_from DESC
-            ''', conn, params=(staff_id,))
+        conn = self.get_connection()
+        return pd.read_sql_query('''
+            SELECT * FROM salary_history 
+            WHERE staff_id = ? 
+            ORDER BY effective_from DESC
+        ''', conn, params=(staff_id,))
 
     def add_advance_with_emi(self, staff_id, amount, date, repayment_type, emi_amount=None, emi_count=None):
-        with self.get_connection() as conn:
+        with self.transaction() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 INSERT INTO advances (
@@ -621,17 +1810,19 @@ class Database:
                 )
                 VALUES (?, ?, ?, ?, ?, ?, ?)
             ''', (staff_id, amount, date, repayment_type, emi_amount, emi_count, amount))
-            conn.commit()
-            return cursor.lastrowid
+            advance_id = cursor.lastrowid
+            refresh_month_counters(conn, date, date)
+            refresh_staff_counters(conn)
+            return advance_id
 
     def get_advance_details(self, advance_id):
-        with self.get_connection() as conn:
-            return pd.read_sql_query('''
-                SELECT * FROM advances WHERE id = ?
-            ''', conn, params=(advance_id,)).iloc[0]
+        conn = self.get_connection()
+        return pd.read_sql_query('''
+            SELECT * FROM advances WHERE id = ?
+        ''', conn, params=(advance_id,)).iloc[0]
 
     def update_advance_remaining(self, advance_id, paid_amount):
-        with self.get_connection() as conn:
+        with self.transaction() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 UPDATE advances 
@@ -642,42 +1833,75 @@ class Database:
                     END
                 WHERE id = ?
             ''', (paid_amount, paid_amount, advance_id))
-            conn.commit()
 
     def auto_mark_attendance(self, date):
-        """Automatically mark attendance for all staff on a given date"""
-        try:
-            # Check if it's a holiday
-            cursor = self.get_connection().cursor()
-            cursor.execute('SELECT 1 FROM holidays WHERE date = ?', (date,))
-            is_holiday = cursor.fetchone() is not None
+        """Mark all visible staff present on a date, leaving existing marks alone.
 
-            # Get all staff
-            cursor.execute('SELECT id FROM staff')
-            staff_list = cursor.fetchall()
-
-            # Mark attendance for each staff
-            for staff in staff_list:
-                cursor.execute('''
-                    INSERT OR REPLACE INTO attendance (staff_id, date, is_present, is_holiday)
-                    VALUES (?, ?, ?, ?)
-                ''', (staff[0], date, True, is_holiday))
-
-            self.get_connection().commit()
-            return True
+        Holidays are flagged from the holidays table. Returns the number of
+        attendance rows created.
+        """
+        day = to_date_str(date)
+        year, month, bit = date_bit(day)
+        params = {'date': day, 'year': year, 'month': month, 'bit': bit}
+        try:
+            with self.transaction() as conn:
+                if get_attendance_store(conn) == 'bitmap':
+                    cursor = conn.execute('''
+                        INSERT INTO attendance_bitmap (staff_id, year, month, marked_mask, present_mask, holiday_mask)
+                        SELECT s.id, :year, :month, :bit, :bit,
+                            :bit * EXISTS (SELECT 1 FROM holidays WHERE date = :date)
+                        FROM staff s
+                        WHERE s.hidden IS NULL OR s.hidden = 0
+                        ON CONFLICT (staff_id, year, month) DO UPDATE SET
+                            marked_mask = marked_mask | excluded.marked_mask,
+                            present_mask = present_mask | excluded.present_mask,
+                            holiday_mask = holiday_mask | excluded.holiday_mask
+                        WHERE (marked_mask & :bit) = 0
+                    ''', params)
+                else:
+                    cursor = conn.execute('''
+                        INSERT INTO attendance (staff_id, date, is_present, is_holiday)
+                        SELECT s.id, :date, 1, EXISTS (SELECT 1 FROM holidays WHERE date = :date)
+                        FROM staff s
+                        WHERE s.hidden IS NULL OR s.hidden = 0
+                        ON CONFLICT (staff_id, date) DO NOTHING
+                    ''', params)
+                created = cursor.rowcount
+                if created:
+                    refresh_monthly_summary(conn, date, date)
+                    refresh_attendance_counters(conn, day, day)
+                return created
         except Exception as e:
             print(f"Error in auto_mark_attendance: {e}")
-            return False
+            return 0
+
+    def has_attendance(self, date):
+        """Check whether any attendance has been recorded for a date."""
+        conn = self.get_connection()
+        day = to_date_str(date)
+        if get_attendance_store(conn) == 'bitmap':
+            cursor = conn.execute('''
+                SELECT EXISTS (
+                    SELECT 1 FROM attendance_bitmap
+                    WHERE year = ? AND month = ? AND marked_mask & ?
+                )
+            ''', date_bit(day))
+        else:
+            cursor = conn.execute('SELECT EXISTS (SELECT 1 FROM attendance WHERE date = ?)', (day,))
+        return bool(cursor.fetchone()[0])
 
     def add_holiday(self, date, name):
         """Add a new holiday"""
         try:
-            cursor = self.get_connection().cursor()
-            cursor.execute('''
-                INSERT INTO holidays (date, name)
-                VALUES (?, ?)
-            ''', (date, name))
-            self.get_connection().commit()
+            with self.transaction() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    INSERT INTO holidays (date, name)
+                    VALUES (?, ?)
+                ''', (date, name))
+                # Holidays pay everyone through the report query; attendance
+                # marks for the day are left as they are
+                refresh_monthly_summary(conn, date, date)
             return True
         except Exception as e:
             print(f"Error in add_holiday: {e}")
@@ -686,9 +1910,10 @@ class Database:
     def remove_holiday(self, date):
         """Remove a holiday"""
         try:
-            cursor = self.get_connection().cursor()
-            cursor.execute('DELETE FROM holidays WHERE date = ?', (date,))
-            self.get_connection().commit()
+            with self.transaction() as conn:
+                cursor = conn.cursor()
+                cursor.execute('DELETE FROM holidays WHERE date = ?', (date,))
+                refresh_monthly_summary(conn, date, date)
             return True
         except Exception as e:
             print(f"Error in remove_holiday: {e}")
@@ -697,27 +1922,27 @@ class Database:
     def get_holidays(self, year=None, month=None, start_date=None, end_date=None):
         """Get all holidays within a date range"""
         try:
-            with self.get_connection() as conn:
-                if year is not None and month is not None:
-                    # Get holidays for a specific month
-                    first_day = f"{year}-{month:02d}-01"
-                    last_day = f"{year}-{month:02d}-31"
-                    return pd.read_sql_query('''
-                        SELECT id, date, name FROM holidays 
-                        WHERE date BETWEEN ? AND ?
-                        ORDER BY date
-                    ''', conn, params=(first_day, last_day))
-                elif start_date and end_date:
-                    return pd.read_sql_query('''
-                        SELECT id, date, name FROM holidays 
-                        WHERE date BETWEEN ? AND ?
-                        ORDER BY date
-                    ''', conn, params=(start_date, end_date))
-                else:
-                    return pd.read_sql_query('''
-                        SELECT id, date, name FROM holidays 
-                        ORDER BY date
-                    ''', conn)
+            conn = self.get_connection()
+            if year is not None and month is not None:
+                # Get holidays for a specific month
+                first_day = f"{year}-{month:02d}-01"
+                last_day = f"{year}-{month:02d}-31"
+                return pd.read_sql_query('''
+                    SELECT id, date, name FROM holidays 
+                    WHERE date BETWEEN ? AND ?
+                    ORDER BY date
+                ''', conn, params=(first_day, last_day))
+            elif start_date and end_date:
+                return pd.read_sql_query('''
+                    SELECT id, date, name FROM holidays 
+                    WHERE date BETWEEN ? AND ?
+                    ORDER BY date
+                ''', conn, params=(start_date, end_date))
+            else:
+                return pd.read_sql_query('''
+                    SELECT id, date, name FROM holidays 
+                    ORDER BY date
+                ''', conn)
         except Exception as e:
             print(f"Error in get_holidays: {e}")
             return pd.DataFrame(columns=['id', 'date', 'name'])
@@ -725,126 +1950,637 @@ class Database:
     def is_holiday(self, date):
         """Check if a given date is a holiday"""
         try:
-            cursor = self.get_connection().cursor()
-            cursor.execute('SELECT 1 FROM holidays WHERE date = ?', (date,))
+            cursor = self.get_connection().execute('SELECT 1 FROM holidays WHERE date = ?', (date,))
             return cursor.fetchone() is not None
         except Exception as e:
             print(f"Error in is_holiday: {e}")
             return False
 
+    # Message Outbox
+    # Outbox writes use invalidates=False: no cached read depends on them, and
+    # a bulk send would otherwise expire every cached report once per message
+    def enqueue_messages(self, messages, batch=None):
+        """Queue (staff_id, to_number, body, idempotency_key) messages under one batch id.
+
+        A key already in the outbox is never queued twice: a failed message
+        with that key moves into this batch and is tried again, while one
+        pending, sending or sent is left in its batch. Returns (batch id,
+        keys already queued or sent).
+        """
+        batch = batch or uuid.uuid4().hex
+        rows = [
+            (batch, None if staff_id is None else int(staff_id), to_number, body, key)
+            for staff_id, to_number, body, key in messages
+        ]
+        with self.transaction(invalidates=False) as conn:
+            conn.executemany('''
+                INSERT INTO message_outbox (batch, staff_id, to_number, body, idempotency_key)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (idempotency_key) DO UPDATE SET
+                    batch = excluded.batch,
+                    to_number = excluded.to_number,
+                    body = excluded.body,
+                    status = 'pending',
+                    attempts = 0,
+                    error = NULL,
+                    next_attempt_at = NULL,
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE status = 'failed'
+            ''', rows)
+            keys = json.dumps([row[4] for row in rows if row[4] is not None])
+            duplicates = [key for key, in conn.execute('''
+                SELECT idempotency_key FROM message_outbox
+                WHERE idempotency_key IN (SELECT value FROM json_each(?))
+                AND batch != ?
+            ''', (keys, batch))]
+        return batch, duplicates
+
+    def claim_outbox_messages(self, owner, limit=1, lease=OUTBOX_LEASE):
+        """Mark up to `limit` of the oldest due messages as sending, claimed by
+        `owner`, and return them as (id, staff_id, to_number, body, attempts)
+        tuples, attempts counting this one.
+
+        Due messages are pending ones past their next_attempt_at, and sending
+        ones whose claim is older than `lease` seconds: their worker stopped
+        mid-send, in this process or another.
+        """
+        with self.transaction(invalidates=False) as conn:
+            return conn.execute('''
+                UPDATE message_outbox
+                SET status = 'sending', attempts = attempts + 1, claimed_by = :owner,
+                    claimed_at = CURRENT_TIMESTAMP, updated_at = CURRENT_TIMESTAMP
+                WHERE id IN (
+                    SELECT id FROM message_outbox
+                    WHERE (
+                        status = 'pending'
+                        AND (next_attempt_at IS NULL OR next_attempt_at <= datetime('now'))
+                    ) OR (
+                        status = 'sending'
+                        AND (claimed_at IS NULL OR claimed_at <= datetime('now', printf('-%d seconds', :lease)))
+                    )
+                    ORDER BY id
+                    LIMIT :limit
+                )
+                RETURNING id, staff_id, to_number, body, attempts
+            ''', {'owner': owner, 'limit': limit, 'lease': lease}).fetchall()
+
+    def finish_outbox_message(self, message_id, owner, sent, error=None, sid=None, error_code=None):
+        """Mark a message claimed by `owner` sent (with the provider's `sid`)
+        or failed, logging the attempt in message_log. The status is left alone
+        if another worker has taken the message over since."""
+        with self.transaction(invalidates=False) as conn:
+            conn.execute('''
+                UPDATE message_outbox
+                SET status = ?, error = ?, updated_at = CURRENT_TIMESTAMP
+                WHERE id = ? AND claimed_by = ?
+            ''', ('sent' if sent else 'failed', error, message_id, owner))
+            conn.execute(_LOG_OUTBOX_ATTEMPT_SQL, {
+                'sid': sid, 'outbox_id': message_id, 'status': 'queued' if sent else 'rejected',
+                'error_code': error_code, 'error': error,
+            })
+
+    def retry_outbox_message(self, message_id, owner, delay, error, error_code=None):
+        """Return a message claimed by `owner` to pending, due again in `delay`
+        seconds, logging the rejected attempt."""
+        with self.transaction(invalidates=False) as conn:
+            conn.execute('''
+                UPDATE message_outbox
+                SET status = 'pending', error = ?, updated_at = CURRENT_TIMESTAMP,
+                    next_attempt_at = datetime('now', printf('+%.3f seconds', ?))
+                WHERE id = ? AND claimed_by = ?
+            ''', (error, delay, message_id, owner))
+            conn.execute(_LOG_OUTBOX_ATTEMPT_SQL, {
+                'sid': None, 'outbox_id': message_id, 'status': 'rejected',
+                'error_code': error_code, 'error': error,
+            })
+
+    def get_outbox_progress(self, batch):
+        """Message count per status (every OUTBOX_STATUSES key) for a batch.
+
+        Not cached: outbox writes leave the data generation alone.
+        """
+        conn = self.get_connection()
+        counts = dict(conn.execute('''
+            SELECT status, COUNT(*) FROM message_outbox
+            WHERE batch = ?
+            GROUP BY status
+        ''', (batch,)).fetchall())
+        return {status: counts.get(status, 0) for status in OUTBOX_STATUSES}
+
+    def get_outbox_failures(self, batch):
+        """Failed messages of a batch with the staff name and last error."""
+        conn = self.get_connection()
+        return pd.read_sql_query('''
+            SELECT o.id, o.staff_id, s.name, o.to_number, o.attempts, o.error
+            FROM message_outbox o
+            LEFT JOIN staff s ON s.id = o.staff_id
+            WHERE o.batch = ? AND o.status = 'failed'
+            ORDER BY o.id
+        ''', conn, params=(batch,))
+
+    # Message Log
+    def log_message(self, to_number, sid=None, error=None, error_code=None, staff_id=None):
+        """Log a send that did not go through the outbox: accepted as `sid`,
+        or rejected with `error`."""
+        with self.transaction(invalidates=False) as conn:
+            conn.execute('''
+                INSERT INTO message_log (sid, staff_id, to_number, status, error_code, error_message)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (sid) DO UPDATE SET
+                    staff_id = excluded.staff_id,
+                    to_number = excluded.to_number,
+                    updated_at = CURRENT_TIMESTAMP
+            ''', (sid, staff_id, to_number, 'rejected' if sid is None else 'queued', error_code, error))
+
+    def update_message_statuses(self, updates):
+        """Upsert (sid, status, error_code, error_message, status_updated_at)
+        delivery updates in one transaction; returns the rows changed.
+
+        Final statuses are never overwritten, and an update older than the
+        row's status is ignored, so callbacks arriving out of order and
+        repeated reconciliation are harmless. A SID not logged yet gets a
+        row that the sending worker fills in.
+        """
+        with self.transaction(invalidates=False) as conn:
+            cursor = conn.executemany(f'''
+                INSERT INTO message_log (sid, status, error_code, error_message, status_updated_at)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (sid) DO UPDATE SET
+                    status = excluded.status,
+                    error_code = COALESCE(excluded.error_code, error_code),
+                    error_message = COALESCE(excluded.error_message, error_message),
+                    status_updated_at = COALESCE(excluded.status_updated_at, status_updated_at),
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE status NOT IN ({_FINAL_STATUS_LIST})
+                AND excluded.status != status
+                AND (status_updated_at IS NULL OR excluded.status_updated_at IS NULL
+                     OR excluded.status_updated_at >= status_updated_at)
+            ''', [tuple(update) for update in updates])
+            return cursor.rowcount
+
+    def get_unresolved_message_sids(self, days):
+        """(oldest log time, set of SIDs) of messages accepted in the last
+        `days` days whose status is not final yet; (None, empty set) if none."""
+        conn = self.get_connection()
+        rows = conn.execute(f'''
+            SELECT sid, created_at FROM message_log
+            WHERE sid IS NOT NULL AND created_at >= datetime('now', printf('-%d days', ?))
+            AND status NOT IN ({_FINAL_STATUS_LIST})
+        ''', (days,)).fetchall()
+        if not rows:
+            return None, set()
+        return min(created for _, created in rows), {sid for sid, _ in rows}
+
+    def get_delivery_summary(self, batch):
+        """Message count per message_log status for a batch, counting each
+        message's latest attempt."""
+        conn = self.get_connection()
+        return dict(conn.execute('''
+            SELECT status, COUNT(*) FROM message_log
+            WHERE id IN (
+                SELECT MAX(id) FROM message_log WHERE batch = ? GROUP BY outbox_id
+            )
+            GROUP BY status
+            ORDER BY COUNT(*) DESC
+        ''', (batch,)).fetchall())
+
+    def get_message_log(self, batch, statuses=None):
+        """Each message's latest attempt in a batch with the staff name,
+        optionally only those with one of `statuses`."""
+        conn = self.get_connection()
+        return pd.read_sql_query('''
+            SELECT l.outbox_id, l.staff_id, s.name, l.to_number, l.sid, l.status,
+                   l.error_code, l.error_message, l.created_at, l.status_updated_at
+            FROM message_log l
+            LEFT JOIN staff s ON s.id = l.staff_id
+            WHERE l.id IN (
+                SELECT MAX(id) FROM message_log WHERE batch = :batch GROUP BY outbox_id
+            )
+            AND (:statuses IS NULL OR l.status IN (SELECT value FROM json_each(:statuses)))
+            ORDER BY l.outbox_id
+        ''', conn, params={'batch': batch, 'statuses': None if statuses is None else json.dumps(list(statuses))})
+
     # Report Generation
-    def get_monthly_report(self, year, month):
-        """Generate monthly attendance and salary report."""
-        # Get working days for this month
+    def get_monthly_report(self, year, month, source=None):
+        """Generate monthly attendance and salary report for all visible staff.
+
+        Days present and advance deductions come from the monthly_summary
+        rollup, so the cost does not grow with attendance history. Each
+        credited day is paid at the salary in force that day (salary_history),
+        and monthly_salary is the salary in force at the end of the month.
+        `source` is a snapshot.Snapshot to compute the report from instead of
+        this database (see get_payroll_matrix).
+        """
+        if source is not None:
+            _, num_days = calendar.monthrange(year, month)
+            matrix = source.payroll_matrix(date(year, month, 1), date(year, month, num_days))
+            return matrix.report()[REPORT_COLUMNS]
+
         working_days = self.get_working_days_in_month(year, month)
-        
-        # Get all staff
-        staff = self.get_all_staff()
-        report_data = []
-        
-        for _, staff_member in staff.iterrows():
-            staff_id = staff_member['id']
-            
-            # Get attendance for the month
-            attendance = self.get_monthly_attendance_for_staff(staff_id, year, month)
-            # Count days present (including holidays)
-            days_present = len(attendance[attendance['is_present'] | attendance['is_holiday']])
-            
-            # Calculate salary based on attendance
-            attendance_ratio = days_present / working_days if working_days > 0 else 0
-            calculated_salary = staff_member['monthly_salary'] * attendance_ratio
-            
-            # Get pending advances
-            advance_deduction = self.get_advance_deduction(staff_id, year, month)
-            
-            report_data.append({
-                'id': staff_id,
-                'name': staff_member['name'],
-                'monthly_salary': staff_member['monthly_salary'],
+        _, num_days = calendar.monthrange(year, month)
+        holiday_days = num_days - working_days
+        params = {
+            'year': year,
+            'month': month,
+            'start': date(year, month, 1).isoformat(),
+            'end': date(year, month, num_days).isoformat(),
+            'holiday_days': holiday_days,
+            'staff_id': None,
+        }
+
+        conn = self.get_connection()
+        report = pd.read_sql_query(_MONTHLY_REPORT_SQL, conn, params=params)
+
+        report['working_days'] = working_days
+        if working_days > 0:
+            report['calculated_salary'] = report['earned_salary'] / working_days
+        else:
+            report['calculated_salary'] = 0.0
+        report['final_salary'] = report['calculated_salary'] - report['total_advance']
+        return report[REPORT_COLUMNS]
+
+    # Streaming reads: rows come straight from the cursor for registers too
+    # large to hold as a DataFrame (see exports.py)
+    def iter_monthly_report(self, year, month):
+        """Yield get_monthly_report rows as tuples in REPORT_COLUMNS order."""
+        _, num_days = calendar.monthrange(year, month)
+        params = {
+            'year': year,
+            'month': month,
+            'start': date(year, month, 1).isoformat(),
+            'end': date(year, month, num_days).isoformat(),
+            'staff_id': None,
+        }
+        conn = self.get_connection()
+        params['holiday_days'] = conn.execute(
+            'SELECT COUNT(*) FROM holidays WHERE date BETWEEN :start AND :end', params
+        ).fetchone()[0]
+        working_days = num_days - params['holiday_days']
+        for staff_id, name, salary, days_present, earned, advance in conn.execute(_MONTHLY_REPORT_SQL, params):
+            calculated = earned / working_days if working_days > 0 else 0.0
+            yield (staff_id, name, salary, days_present, working_days,
+                   calculated, advance, calculated - advance)
+
+    def iter_attendance_register(self, year, month):
+        """Yield (id, name, statuses) per visible staff member, ordered by name.
+
+        `statuses` has one payroll status code (UNMARKED, ABSENT, PRESENT or
+        LEAVE) per day of the month, as stored; holidays are not applied.
+        """
+        _, num_days = calendar.monthrange(year, month)
+        params = {
+            'year': year,
+            'month': month,
+            'start': date(year, month, 1).isoformat(),
+            'end': date(year, month, num_days).isoformat(),
+        }
+        conn = self.get_connection()
+        cursor = conn.execute(_MONTH_MASKS_SQL[get_attendance_store(conn)], params)
+        while True:
+            rows = cursor.fetchmany(1024)
+            if not rows:
+                break
+            staff_ids, names, *masks = zip(*rows)
+            statuses = mask_status_codes(*masks, num_days=num_days)
+            yield from zip(staff_ids, names, statuses.tolist())
+
+    def iter_advance_ledger(self, end_date=None):
+        """Yield advances given up to `end_date` (default: all) with their
+        repayment schedules, as tuples in ADVANCE_LEDGER_COLUMNS order."""
+        params = {'end': to_date_str(end_date or date.max)}
+        conn = self.get_connection()
+        yield from conn.execute('''
+            SELECT
+                a.id, a.date, a.staff_id, s.name, a.amount, a.repayment_type,
+                ar.due_date, ar.amount, ar.is_paid, ar.paid_date
+            FROM advances a
+            JOIN staff s ON s.id = a.staff_id
+            LEFT JOIN advance_repayments ar ON ar.advance_id = a.id
+            WHERE a.date <= :end
+            ORDER BY a.date, a.id, ar.due_date, ar.id
+        ''', params)
+
+    def get_report_range(self, start_date, end_date, granularity='month', source=None):
+        """Payroll rows per visible staff member and period for whole months.
+
+        Covers every month touching start_date..end_date, grouped by
+        `granularity` (see REPORT_GRANULARITIES). Each month is pro-rated on
+        its own working days, as in get_monthly_report, and the period row
+        sums those months. Days are paid at the salary in force that day, and
+        monthly_salary is the salary in force at the end of the period. Reads
+        the rollup, staff, holidays and salary_history once.
+
+        `source` is a snapshot.Snapshot to compute the rows from instead of
+        this database (see get_payroll_matrix).
+        """
+        if granularity not in REPORT_GRANULARITIES:
+            raise ValueError(f"Unknown report granularity: {granularity}")
+        start = date.fromisoformat(to_date_str(start_date)).replace(day=1)
+        end = date.fromisoformat(to_date_str(end_date))
+        end = end.replace(day=calendar.monthrange(end.year, end.month)[1])
+        if source is not None:
+            return matrix_report_range(source.payroll_matrix(start, end), granularity)
+
+        conn = self.get_connection()
+        return pd.read_sql_query(f'''
+            WITH RECURSIVE months(first_day) AS (
+                SELECT date(:start)
+                UNION ALL
+                SELECT date(first_day, '+1 month') FROM months
+                WHERE first_day < date(:end, 'start of month')
+            ),
+            m AS (
+                SELECT
+                    first_day,
+                    date(first_day, '+1 month', '-1 day') AS last_day,
+                    CAST(strftime('%Y', first_day) AS INTEGER) AS year,
+                    CAST(strftime('%m', first_day) AS INTEGER) AS month,
+                    CAST(strftime('%d', first_day, '+1 month', '-1 day') AS INTEGER) AS num_days
+                FROM months
+            ),
+            holiday_counts AS (
+                SELECT substr(date, 1, 7) AS ym, COUNT(*) AS holiday_days
+                FROM holidays
+                WHERE date BETWEEN :start AND :end
+                GROUP BY ym
+            ),
+            month_days AS MATERIALIZED (
+                SELECT
+                    m.*,
+                    {_REPORT_PERIOD_SQL[granularity]} AS period,
+                    COALESCE(h.holiday_days, 0) AS holiday_days,
+                    m.num_days - COALESCE(h.holiday_days, 0) AS working_days
+                FROM m
+                LEFT JOIN holiday_counts h ON h.ym = substr(m.first_day, 1, 7)
+            ),
+            periods AS (
+                SELECT period, MIN(first_day) AS period_start, MAX(last_day) AS period_end
+                FROM month_days
+                GROUP BY period
+            ),
+            staff_months AS (
+                SELECT
+                    d.period, d.first_day, d.last_day, d.holiday_days, d.working_days,
+                    s.id, s.name, s.monthly_salary AS base_salary,
+                    {salary_at_sql('s.id', 'd.last_day', 's.monthly_salary')} AS month_salary,
+                    COALESCE(ms.present_days, 0) + d.holiday_days AS days_present,
+                    COALESCE(ms.present_salary, 0.0) AS present_salary,
+                    COALESCE(ms.advance_deduction, 0.0) AS total_advance
+                FROM month_days d
+                CROSS JOIN staff s
+                LEFT JOIN monthly_summary ms
+                    ON ms.year = d.year AND ms.month = d.month AND ms.staff_id = s.id
+                WHERE s.hidden IS NULL OR s.hidden = 0
+            ),
+            staff_pay AS (
+                SELECT
+                    sm.period, sm.id, sm.name, sm.base_salary, sm.days_present,
+                    sm.working_days, sm.total_advance,
+                    CASE WHEN sm.working_days > 0 THEN (
+                        sm.present_salary
+                        -- Holidays count as present days for everyone; only
+                        -- a change inside the month needs each one resolved
+                        + CASE WHEN EXISTS (
+                            SELECT 1 FROM salary_history h
+                            WHERE h.staff_id = sm.id
+                            AND h.effective_from > sm.first_day AND h.effective_from <= sm.last_day
+                        ) THEN (
+                            SELECT SUM({salary_at_sql('sm.id', 'hd.date', 'sm.base_salary')})
+                            FROM holidays hd WHERE hd.date BETWEEN sm.first_day AND sm.last_day
+                        ) ELSE sm.month_salary * sm.holiday_days END
+                    ) / sm.working_days ELSE 0.0 END AS calculated_salary
+                FROM staff_months sm
+            ),
+            totals AS (
+                SELECT
+                    period, id, name,
+                    MAX(base_salary) AS base_salary,
+                    SUM(days_present) AS days_present,
+                    SUM(working_days) AS working_days,
+                    SUM(calculated_salary) AS calculated_salary,
+                    SUM(total_advance) AS total_advance
+                FROM staff_pay
+                GROUP BY period, id
+            )
+            -- monthly_salary is the salary in force at the end of the period
+            SELECT
+                t.period,
+                p.period_start,
+                p.period_end,
+                t.id,
+                t.name,
+                {salary_at_sql('t.id', 'p.period_end', 't.base_salary')} AS monthly_salary,
+                t.days_present,
+                t.working_days,
+                t.calculated_salary,
+                t.total_advance,
+                t.calculated_salary - t.total_advance AS final_salary
+            FROM totals t
+            JOIN periods p ON p.period = t.period
+            ORDER BY p.period_start, t.name
+        ''', conn, params={'start': start.isoformat(), 'end': end.isoformat()})[REPORT_RANGE_COLUMNS]
+
+    def get_cycle_report(self, year, month):
+        """Payroll report where each staff member's period follows their own cycle.
+
+        The period paid in (year, month) comes from the staff member's
+        salary_cycle_start/end (see salary_cycle_window). Attendance is loaded
+        once for all windows; staff sharing a cycle share one deduction scan.
+        """
+        conn = self.get_connection()
+        staff = conn.execute('''
+            SELECT id, salary_cycle_start, salary_cycle_end FROM staff
+            WHERE hidden IS NULL OR hidden = 0
+        ''').fetchall()
+
+        groups = {}
+        for staff_id, start_day, end_day in staff:
+            window = salary_cycle_window(year, month, cycle_day(start_day, 1), cycle_day(end_day, 31))
+            groups.setdefault(window, []).append(staff_id)
+        if not groups:
+            return pd.DataFrame(columns=CYCLE_REPORT_COLUMNS)
+
+        matrix = self.get_payroll_matrix(min(start for start, _ in groups), max(end for _, end in groups))
+        frames = []
+        conn = self.get_connection()
+        for (start, end), staff_ids in groups.items():
+            rows, _ = matrix.staff_rows(staff_ids)
+            days_present, working_days, calculated, salary = matrix.window_totals(
+                rows, matrix.day_offset(start), matrix.day_offset(end) + 1
+            )
+            deductions = dict(conn.execute('''
+                SELECT a.staff_id, SUM(ar.amount)
+                FROM advance_repayments ar
+                JOIN advances a ON ar.advance_id = a.id
+                WHERE ar.due_date BETWEEN :start AND :end
+                AND ar.is_paid = 0
+                AND a.staff_id IN (SELECT value FROM json_each(:staff_ids))
+                GROUP BY a.staff_id
+            ''', {
+                'start': start.isoformat(),
+                'end': end.isoformat(),
+                'staff_ids': json.dumps(staff_ids),
+            }).fetchall())
+            total_advance = np.array([deductions.get(int(staff_id), 0.0) for staff_id in matrix.staff_ids[rows]])
+            frames.append(pd.DataFrame({
+                'id': matrix.staff_ids[rows],
+                'name': matrix.names[rows],
+                'period_start': start.isoformat(),
+                'period_end': end.isoformat(),
+                'monthly_salary': salary,
                 'days_present': days_present,
                 'working_days': working_days,
-                'calculated_salary': calculated_salary,
-                'total_advance': advance_deduction,
-                'final_salary': calculated_salary - advance_deduction
-            })
-        
-        return pd.DataFrame(report_data)
+                'calculated_salary': calculated,
+                'total_advance': total_advance,
+                'final_salary': calculated - total_advance,
+            }))
+
+        report = pd.concat(frames, ignore_index=True)
+        return report.sort_values(['name', 'id'], ignore_index=True)[CYCLE_REPORT_COLUMNS]
+
+    def get_payroll_matrix(self, start_date, end_date, source=None):
+        """Load the whole months covering start_date..end_date into a PayrollMatrix.
+
+        Covers all visible staff, ordered by name like get_monthly_report.
+        With a snapshot.Snapshot as `source` the matrix is loaded from its
+        Parquet files instead; months after the snapshot's `through` are
+        empty there.
+        """
+        if source is not None:
+            return source.payroll_matrix(start_date, end_date)
+        start = date.fromisoformat(to_date_str(start_date)).replace(day=1)
+        end = date.fromisoformat(to_date_str(end_date))
+        end = end.replace(day=calendar.monthrange(end.year, end.month)[1])
+        params = {
+            'start': start.isoformat(),
+            'end': end.isoformat(),
+            'start_year': start.year,
+            'start_month': start.month,
+            'end_year': end.year,
+            'end_month': end.month,
+        }
+
+        conn = self.get_connection()
+        staff = conn.execute('''
+            SELECT id, name, monthly_salary FROM staff
+            WHERE hidden IS NULL OR hidden = 0
+            ORDER BY name
+        ''').fetchall()
+        matrix = PayrollMatrix(
+            [row[0] for row in staff], [row[1] for row in staff],
+            [row[2] for row in staff], start, end
+        )
+
+        holidays, = fetch_columns(conn, '''
+            SELECT CAST(julianday(date) - julianday(:start) AS INTEGER)
+            FROM holidays WHERE date BETWEEN :start AND :end
+        ''', params, 1)
+        matrix.set_holidays(holidays)
+
+        if get_attendance_store(conn) == 'bitmap':
+            matrix.set_month_masks(*fetch_columns(conn, '''
+                SELECT staff_id, year, month, marked_mask, present_mask, holiday_mask
+                FROM attendance_bitmap
+                WHERE (year, month) BETWEEN (:start_year, :start_month) AND (:end_year, :end_month)
+            ''', params, 6))
+        else:
+            # One packed integer per mark keeps row materialisation cheap,
+            # and +date makes SQLite scan the table instead of visiting
+            # most of it through idx_attendance_date
+            marks = np.fromiter((value for value, in conn.execute('''
+                SELECT (staff_id << 24)
+                     | (CAST(julianday(date) - julianday(:start) AS INTEGER) << 2)
+                     | (is_present << 1)
+                     | is_holiday
+                FROM attendance WHERE +date BETWEEN :start AND :end
+            ''', params)), dtype=np.int64)
+            matrix.set_marks(marks >> 24, (marks >> 2) & 0x3FFFFF, (marks >> 1) & 1, marks & 1)
+
+        matrix.set_salary_history(*fetch_columns(conn, '''
+            SELECT staff_id, CAST(julianday(effective_from) - julianday(:start) AS INTEGER), salary
+            FROM salary_history
+            ORDER BY staff_id, effective_from, id
+        ''', params, 3))
+
+        matrix.add_deductions(*fetch_columns(conn, '''
+            SELECT
+                a.staff_id,
+                CAST(substr(ar.due_date, 1, 4) AS INTEGER),
+                CAST(substr(ar.due_date, 6, 2) AS INTEGER),
+                SUM(ar.amount)
+            FROM advance_repayments ar
+            JOIN advances a ON ar.advance_id = a.id
+            WHERE ar.due_date BETWEEN :start AND :end
+            AND ar.is_paid = 0
+            GROUP BY 1, 2, 3
+        ''', params, 4))
+        return matrix
     
     # Dashboard Analytics
-    def get_dashboard_stats(self, year=None, month=None):
-        with self.get_connection() as conn:
-            if year is None or month is None:
-                today = date.today()
-                year = today.year
-                month = today.month
-            
-            # Total staff
-            staff_count = pd.read_sql_query("SELECT COUNT(*) as count FROM staff", conn).iloc[0]['count']
-            
-            # Average attendance percentage
-            first_day = f"{year}-{month:02d}-01"
-            last_day = f"{year}-{month:02d}-31"
-            
-            attendance_stats = pd.read_sql_query('''
-                SELECT 
-                    COUNT(DISTINCT staff_id) as total_staff,
-                    SUM(CASE WHEN is_present = 1 OR is_holiday = 1 THEN 1 ELSE 0 END) as total_present,
-                    COUNT(*) as total_days
-                FROM attendance
-                WHERE date BETWEEN ? AND ?
-            ''', conn, params=(first_day, last_day))
-            
-            if not attendance_stats.empty and attendance_stats.iloc[0]['total_days'] > 0:
-                avg_attendance = (attendance_stats.iloc[0]['total_present'] / attendance_stats.iloc[0]['total_days']) * 100
-            else:
-                avg_attendance = 0
-            
-            # Total salary paid this month
-            report_df = self.get_monthly_report(year, month)
-            total_salary = report_df['final_salary'].sum() if not report_df.empty else 0
-            
-            # Total advance given this month
-            advances_df = pd.read_sql_query('''
-                SELECT SUM(amount) as total_advance
-                FROM advances
-                WHERE date BETWEEN ? AND ?
-            ''', conn, params=(first_day, last_day))
-            
-            total_advance = advances_df.iloc[0]['total_advance'] if not advances_df.empty and advances_df.iloc[0]['total_advance'] is not None else 0
-            
-            return {
-                'total_staff': staff_count,
-                'avg_attendance': avg_attendance,
-                'total_salary': total_salary,
-                'total_advance': total_advance
-            }
+    def get_dashboard_stats(self, year=None, month=None, day=None):
+        """Dashboard figures for a month and a day (default: today).
+
+        Read from dashboard_counters, which the write paths keep current, so
+        the cost does not grow with staff count or history. On a holiday
+        every visible staff member counts as present.
+        """
+        today = date.today()
+        if year is None or month is None:
+            year, month = today.year, today.month
+        day = to_date_str(day or today)
+        period = f"{year:04d}-{month:02d}"
+        keys = [
+            ('staff_count', ''), ('outstanding_total', ''),
+            ('attendance_marked', day), ('attendance_present', day),
+            ('payroll_total', period), ('month_attended', period),
+            ('month_marked', period), ('month_advance', period),
+        ]
+        conn = self.get_connection()
+        counters = dict.fromkeys((name for name, _ in keys), 0)
+        counters.update(conn.execute(f'''
+            SELECT name, value FROM dashboard_counters
+            WHERE (name, period) IN (VALUES {', '.join(['(?, ?)'] * len(keys))})
+        ''', [value for key in keys for value in key]).fetchall())
+        is_holiday = conn.execute('SELECT EXISTS (SELECT 1 FROM holidays WHERE date = ?)', (day,)).fetchone()[0]
+
+        staff_count = int(counters['staff_count'])
+        marked = counters['month_marked']
+        return {
+            'total_staff': staff_count,
+            'avg_attendance': counters['month_attended'] / marked * 100 if marked else 0,
+            'total_salary': counters['payroll_total'],
+            'total_advance': counters['month_advance'],
+            'total_outstanding': counters['outstanding_total'],
+            'present_today': staff_count if is_holiday else int(counters['attendance_present']),
+            'marked_today': staff_count if is_holiday else int(counters['attendance_marked']),
+        }
 
     def get_advance_deduction(self, staff_id, year, month):
         """Calculate advance deductions for a staff member in a given month."""
-        with self.get_connection() as conn:
-            # Get the first and last day of the month
-            first_day = date(year, month, 1)
-            if month == 12:
-                last_day = date(year + 1, 1, 1) - timedelta(days=1)
-            else:
-                last_day = date(year, month + 1, 1) - timedelta(days=1)
-            
-            # Get advance repayments due in this month
-            query = '''
-                SELECT SUM(ar.amount) as total_deduction
-                FROM advance_repayments ar
-                JOIN advances a ON ar.advance_id = a.id
-                WHERE a.staff_id = ?
-                AND ar.due_date BETWEEN ? AND ?
-                AND ar.is_paid = 0
-            '''
-            
-            result = pd.read_sql_query(query, conn, params=(staff_id, first_day, last_day))
-            return float(result['total_deduction'].iloc[0]) if not result.empty and result['total_deduction'].iloc[0] is not None else 0.0
+        conn = self.get_connection()
+        # Get the first and last day of the month
+        first_day = date(year, month, 1)
+        if month == 12:
+            last_day = date(year + 1, 1, 1) - timedelta(days=1)
+        else:
+            last_day = date(year, month + 1, 1) - timedelta(days=1)
+        
+        # Get advance repayments due in this month
+        query = '''
+            SELECT SUM(ar.amount) as total_deduction
+            FROM advance_repayments ar
+            JOIN advances a ON ar.advance_id = a.id
+            WHERE a.staff_id = ?
+            AND ar.due_date BETWEEN ? AND ?
+            AND ar.is_paid = 0
+        '''
+        
+        result = pd.read_sql_query(query, conn, params=(staff_id, first_day, last_day))
+        return float(result['total_deduction'].iloc[0]) if not result.empty and result['total_deduction'].iloc[0] is not None else 0.0
 
     def change_password(self, username, current_password, new_password):
         """Change a user's password after verifying their current password."""
-        with self.get_connection() as conn:
+        with self.transaction() as conn:
             cursor = conn.cursor()
             # First verify the current password
             cursor.execute('SELECT password FROM users WHERE username = ?', (username,))
@@ -863,199 +2599,231 @@ class Database:
                 SET password = ?
                 WHERE username = ?
             ''', (hashed_password, username))
-            conn.commit()
             
             return True, "Password updated successfully"
 
     def get_attendance_calendar(self, year, month):
-        """Get attendance calendar for a specific month."""
-        with self.get_connection() as conn:
-            # Get the first and last day of the month
-            first_day = date(year, month, 1)
-            if month == 12:
-                last_day = date(year + 1, 1, 1) - timedelta(days=1)
-            else:
-                last_day = date(year, month + 1, 1) - timedelta(days=1)
-            
-            # Get all staff
-            staff_df = pd.read_sql_query("SELECT id, name FROM staff", conn)
-            
-            # Get all attendance records for the month
-            attendance_df = pd.read_sql_query('''
-                SELECT staff_id, date, is_present, is_holiday
-                FROM attendance
-                WHERE date BETWEEN ? AND ?
-            ''', conn, params=(first_day, last_day))
-            
-            # Create a pivot table for the calendar view
-            if not attendance_df.empty:
-                pivot_df = attendance_df.pivot(
-                    index='staff_id', 
-                    columns='date', 
-                    values='is_present'
-                ).fillna(False)
-                
-                # Merge with staff names
-                result_df = staff_df.merge(pivot_df, left_on='id', right_index=True)
-                
-                # Rename columns to show dates
-                result_df = result_df.rename(columns={col: col.strftime('%d') for col in result_df.columns if isinstance(col, pd.Timestamp)})
-                
-                return result_df
-            else:
-                return staff_df
+        """Staff-by-day attendance for a month as an AttendanceCalendar.
+
+        One query returns each visible staff member's day bit masks from
+        either attendance store, and NumPy expands them into the matrix.
+        """
+        _, num_days = calendar.monthrange(year, month)
+        params = {
+            'year': year,
+            'month': month,
+            'start': date(year, month, 1).isoformat(),
+            'end': date(year, month, num_days).isoformat(),
+        }
+        conn = self.get_connection()
+        rows = conn.execute(_MONTH_MASKS_SQL[get_attendance_store(conn)], params).fetchall()
+        holidays = conn.execute(
+            'SELECT date, name FROM holidays WHERE date BETWEEN :start AND :end', params
+        ).fetchall()
+        staff_ids, names, *masks = zip(*rows) if rows else ((),) * 5
+        return AttendanceCalendar(
+            year, month, staff_ids, names,
+            mask_status_codes(*masks, num_days=num_days),
+            {int(day[8:10]): name for day, name in holidays},
+        )
 
     def get_staff_salary_cycle(self, staff_id):
         """Get salary cycle for a specific staff member."""
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT salary_cycle_start, salary_cycle_end 
-                FROM staff 
-                WHERE id = ?
-            ''', (staff_id,))
-            result = cursor.fetchone()
-            if result:
-                return {
-                    'start': int(result[0]) if result[0] else 1,
-                    'end': int(result[1]) if result[1] else 31
-                }
-            return {'start': 1, 'end': 31}  # Default values
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT salary_cycle_start, salary_cycle_end 
+            FROM staff 
+            WHERE id = ?
+        ''', (staff_id,))
+        result = cursor.fetchone()
+        if result:
+            return {
+                'start': cycle_day(result[0], 1),
+                'end': cycle_day(result[1], 31)
+            }
+        return {'start': 1, 'end': 31}  # Default values
 
     def set_staff_salary_cycle(self, staff_id, start_day, end_day):
         """Set salary cycle for a specific staff member."""
-        with self.get_connection() as conn:
+        with self.transaction() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 UPDATE staff 
                 SET salary_cycle_start = ?, salary_cycle_end = ?
                 WHERE id = ?
             ''', (start_day, end_day, staff_id))
-            conn.commit()
 
     def get_all_advances(self):
         """Get all advance payments."""
-        with self.get_connection() as conn:
-            return pd.read_sql_query('''
-                SELECT a.*, s.name as staff_name
-                FROM advances a
-                JOIN staff s ON a.staff_id = s.id
-                ORDER BY a.date DESC
-            ''', conn)
+        conn = self.get_connection()
+        return pd.read_sql_query('''
+            SELECT a.*, s.name as staff_name
+            FROM advances a
+            JOIN staff s ON a.staff_id = s.id
+            ORDER BY a.date DESC
+        ''', conn)
 
     def add_advance_repayment(self, advance_id, amount, due_date):
         """Add a new advance repayment record."""
-        with self.get_connection() as conn:
+        with self.transaction() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 INSERT INTO advance_repayments (advance_id, amount, due_date)
                 VALUES (?, ?, ?)
             ''', (advance_id, amount, due_date))
-            conn.commit()
-            return cursor.lastrowid
+            repayment_id = cursor.lastrowid
+            self._refresh_repayment_summary(conn, repayment_id)
+            return repayment_id
 
     def mark_repayment_paid(self, repayment_id, paid_date=None):
         """Mark an advance repayment as paid."""
         if paid_date is None:
             paid_date = date.today()
             
-        with self.get_connection() as conn:
+        with self.transaction() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 UPDATE advance_repayments
                 SET is_paid = 1, paid_date = ?
                 WHERE id = ?
             ''', (paid_date, repayment_id))
-            conn.commit()
+            self._refresh_repayment_summary(conn, repayment_id)
+
+    def _refresh_repayment_summary(self, conn, repayment_id):
+        row = conn.execute('''
+            SELECT a.staff_id, ar.due_date
+            FROM advance_repayments ar
+            JOIN advances a ON ar.advance_id = a.id
+            WHERE ar.id = ?
+        ''', (repayment_id,)).fetchone()
+        if row:
+            refresh_monthly_summary(conn, row[1], row[1], [row[0]])
+            refresh_staff_counters(conn)
+
+    def rebuild_monthly_summary(self):
+        """Recompute the monthly_summary rollup and dashboard counters from raw rows."""
+        with self.transaction() as conn:
+            rebuild_rollups(conn)
+
+    def get_attendance_store(self):
+        return get_attendance_store(self.get_connection())
+
+    def convert_attendance_store(self, store):
+        """Move all attendance into the 'rows' or 'bitmap' store and switch to it.
+
+        Returns the number of staff-day marks moved. The source table is
+        emptied; run VACUUM afterwards to return the space to the filesystem.
+        """
+        if store not in ATTENDANCE_STORES:
+            raise ValueError(f"Unknown attendance store: {store}")
+        with self.transaction() as conn:
+            current = get_attendance_store(conn)
+            if current == store:
+                return 0
+            if store == 'bitmap':
+                # Each (staff_id, date) is unique, so summing distinct bits ORs them
+                conn.execute('''
+                    INSERT INTO attendance_bitmap (staff_id, year, month, marked_mask, present_mask, holiday_mask)
+                    SELECT
+                        staff_id,
+                        CAST(substr(date, 1, 4) AS INTEGER) AS year,
+                        CAST(substr(date, 6, 2) AS INTEGER) AS month,
+                        SUM(1 << (CAST(substr(date, 9, 2) AS INTEGER) - 1)),
+                        SUM(CASE WHEN is_present = 1 THEN 1 << (CAST(substr(date, 9, 2) AS INTEGER) - 1) ELSE 0 END),
+                        SUM(CASE WHEN is_holiday = 1 THEN 1 << (CAST(substr(date, 9, 2) AS INTEGER) - 1) ELSE 0 END)
+                    FROM attendance
+                    GROUP BY staff_id, year, month
+                ''')
+                moved = conn.execute('DELETE FROM attendance').rowcount
+            else:
+                cursor = conn.execute(f'''
+                    INSERT INTO attendance (staff_id, date, is_present, is_holiday)
+                    SELECT staff_id, date, is_present, is_holiday
+                    FROM ({_ATTENDANCE_ROWS_SQL['bitmap']})
+                ''', {'start': date.min.isoformat(), 'end': date.max.isoformat()})
+                moved = cursor.rowcount
+                conn.execute('DELETE FROM attendance_bitmap')
+            conn.execute('''
+                INSERT OR REPLACE INTO settings (key, value)
+                VALUES ('attendance_store', ?)
+            ''', (store,))
+            return moved
 
     def get_pending_repayments(self, staff_id=None, start_date=None, end_date=None):
         """Get all pending advance repayments."""
-        with self.get_connection() as conn:
-            query = '''
-                SELECT 
-                    ar.id as repayment_id,
-                    ar.advance_id,
-                    s.id as staff_id,
-                    s.name as staff_name,
-                    a.amount as total_advance,
-                    ar.amount as repayment_amount,
-                    ar.due_date,
-                    a.date as advance_date
-                FROM advance_repayments ar
-                JOIN advances a ON ar.advance_id = a.id
-                JOIN staff s ON a.staff_id = s.id
-                WHERE ar.is_paid = 0
-            '''
-            
-            params = []
-            if staff_id:
-                query += ' AND s.id = ?'
-                params.append(staff_id)
-            if start_date:
-                query += ' AND ar.due_date >= ?'
-                params.append(start_date)
-            if end_date:
-                query += ' AND ar.due_date <= ?'
-                params.append(end_date)
-                
-            query += ' ORDER BY ar.due_date'
+        conn = self.get_connection()
+        query = '''
+            SELECT 
+                ar.id as repayment_id,
+                ar.advance_id,
+                s.id as staff_id,
+                s.name as staff_name,
+                a.amount as total_advance,
+                ar.amount as repayment_amount,
+                ar.due_date,
+                a.date as advance_date
+            FROM advance_repayments ar
+            JOIN advances a ON ar.advance_id = a.id
+            JOIN staff s ON a.staff_id = s.id
+            WHERE ar.is_paid = 0
+        '''
+        
+        params = []
+        if staff_id:
+            query += ' AND s.id = ?'
+            params.append(staff_id)
+        if start_date:
+            query += ' AND ar.due_date >= ?'
+            params.append(start_date)
+        if end_date:
+            query += ' AND ar.due_date <= ?'
+            params.append(end_date)
             
-            return pd.read_sql_query(query, conn, params=params)
+        query += ' ORDER BY ar.due_date'
+        
+        return pd.read_sql_query(query, conn, params=params)
 
     def get_advance_repayment_history(self, advance_id):
         """Get repayment history for a specific advance."""
-        with self.get_connection() as conn:
-            return pd.read_sql_query('''
-                SELECT 
-                    ar.*,
-                    CASE 
-                        WHEN ar.is_paid = 1 THEN 'Paid'
-                        ELSE 'Pending'
-                    END as status
-                FROM advance_repayments ar
-                WHERE ar.advance_id = ?
-                ORDER BY ar.due_date
-            ''', conn, params=(advance_id,))
-
-    def get_staff_outstanding(self, staff_id=None):
-        """Get outstanding amounts for staff (advances - repayments)"""
-        with self.get_connection() as conn:
-            query = '''
-                SELECT 
-                    s.id,
-                    s.name,
-                    COALESCE(SUM(a.amount), 0) as total_advance,
-                    COALESCE(SUM(CASE WHEN ar.is_paid = 1 THEN ar.amount ELSE 0 END), 0) as total_paid,
-                    COALESCE(SUM(a.amount), 0) - COALESCE(SUM(CASE WHEN ar.is_paid = 1 THEN ar.amount ELSE 0 END), 0) as outstanding
-                FROM staff s
-                LEFT JOIN advances a ON s.id = a.staff_id
-                LEFT JOIN advance_repayments ar ON a.id = ar.advance_id
-            '''
-            
-            params = []
-            if staff_id:
-                query += ' WHERE s.id = ?'
-                params.append(staff_id)
-            
-            query += ' GROUP BY s.id, s.name'
-            query += ' HAVING outstanding > 0'
-            
-            return pd.read_sql_query(query, conn, params=params)
+        conn = self.get_connection()
+        return pd.read_sql_query('''
+            SELECT 
+                ar.*,
+                CASE 
+                    WHEN ar.is_paid = 1 THEN 'Paid'
+                    ELSE 'Pending'
+                END as status
+            FROM advance_repayments ar
+            WHERE ar.advance_id = ?
+            ORDER BY ar.due_date
+        ''', conn, params=(advance_id,))
+
+    def get_staff_outstanding(self, staff_id=None, limit=None):
+        """Visible staff with advances not yet repaid, largest first.
+
+        Returns id, name, total_advance, total_paid and outstanding, at most
+        `limit` rows when given.
+        """
+        query = _STAFF_OUTSTANDING_SQL + ' ORDER BY outstanding DESC, s.name'
+        if limit is not None:
+            query += f' LIMIT {int(limit)}'
+        conn = self.get_connection()
+        return pd.read_sql_query(query, conn, params={'staff_id': staff_id})
 
     def get_attendance_range(self, start_date, end_date):
         """Get attendance data for a date range."""
         try:
-            query = """
+            conn = self.get_connection()
+            query = f"""
                 SELECT a.id, a.staff_id, a.date, a.is_present, a.is_holiday, s.name
-                FROM attendance a
+                FROM ({attendance_rows_sql(conn)}) a
                 JOIN staff s ON a.staff_id = s.id
-                WHERE a.date BETWEEN ? AND ?
                 ORDER BY a.date, s.name
             """
-            with self.get_connection() as conn:
-                cursor = conn.cursor()
-                cursor.execute(query, (start_date, end_date))
-                rows = cursor.fetchall()
+            cursor = conn.cursor()
+            cursor.execute(query, {'start': to_date_str(start_date), 'end': to_date_str(end_date)})
+            rows = cursor.fetchall()
             if not rows:
                 return pd.DataFrame(columns=['id', 'staff_id', 'date', 'is_present', 'is_holiday', 'name'])
             return pd.DataFrame(rows, columns=['id', 'staff_id', 'date', 'is_present', 'is_holiday', 'name'])
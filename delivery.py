@@ -0,0 +1,178 @@
+"""Delivery status tracking for sent messages.
+
+Every send attempt is logged in message_log (see Database.finish_outbox_message).
+Statuses then reach the log in bulk, by either of:
+
+- reconcile_deliveries, which lists the statuses of recently sent messages
+  through the transport a page at a time, and upserts those that changed;
+- StatusCallbackServer, a local endpoint for Twilio's status callbacks,
+  which buffers them and upserts them every flush interval.
+
+Neither makes a request or a write per message.
+"""
+import threading
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+from twilio.request_validator import RequestValidator
+
+from transports import TIMESTAMP_FORMAT, utc_timestamp
+
+# Messages older than this are not reconciled any more: Twilio stops
+# updating a message's status within about three days
+RECONCILE_WINDOW_DAYS = 3
+
+# Status updates written per transaction
+RECONCILE_BATCH_SIZE = 500
+
+# Listing starts this long before the oldest unresolved message was logged,
+# since the provider's send time comes slightly before the log row
+_RECONCILE_MARGIN = timedelta(minutes=5)
+
+
+def reconcile_deliveries(db, transport, window_days=RECONCILE_WINDOW_DAYS, batch_size=RECONCILE_BATCH_SIZE):
+    """Bring the status of unresolved messages up to date from the transport.
+
+    Returns (messages unresolved before, rows updated).
+    """
+    oldest, unresolved = db.get_unresolved_message_sids(window_days)
+    if not unresolved:
+        return 0, 0
+    since = datetime.strptime(oldest, TIMESTAMP_FORMAT) - _RECONCILE_MARGIN
+    remaining = set(unresolved)
+    updated = 0
+    updates = []
+    for status in transport.fetch_statuses(since):
+        if status[0] not in remaining:
+            continue
+        remaining.discard(status[0])
+        updates.append(status)
+        if len(updates) >= batch_size:
+            updated += db.update_message_statuses(updates)
+            updates = []
+        if not remaining:
+            # Every unresolved message has been seen; skip the other pages
+            break
+    if updates:
+        updated += db.update_message_statuses(updates)
+    return len(unresolved), updated
+
+
+class _CallbackHandler(BaseHTTPRequestHandler):
+    server_version = 'HaazriBookStatus/1.0'
+
+    def do_POST(self):
+        receiver = self.server.receiver
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8')
+        params = {key: values[0] for key, values in parse_qs(body).items()}
+        if receiver.validator is not None:
+            url = receiver.public_url.rstrip('/') + self.path
+            if not receiver.validator.validate(url, params, self.headers.get('X-Twilio-Signature', '')):
+                return self._reply(403)
+        if not params.get('MessageSid') or not params.get('MessageStatus'):
+            return self._reply(400)
+        error_code = params.get('ErrorCode')
+        receiver.add((
+            params['MessageSid'],
+            params['MessageStatus'],
+            int(error_code) if error_code else None,
+            None,
+            utc_timestamp(datetime.now(timezone.utc)),
+        ))
+        self._reply(204)
+
+    def _reply(self, status):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StatusCallbackServer:
+    """Receives Twilio status callbacks and writes them to message_log in bulk.
+
+    Callbacks are buffered and upserted every `flush_interval` seconds, or
+    as soon as `batch_size` are waiting. With `auth_token` set, callbacks
+    must carry a valid X-Twilio-Signature for `public_url` (default: the
+    local address), the URL Twilio posts to. Listens on `host`, loopback
+    by default for use behind a reverse proxy or tunnel.
+    """
+
+    def __init__(self, db, port=0, auth_token=None, public_url=None, flush_interval=1.0,
+                 batch_size=RECONCILE_BATCH_SIZE, host='127.0.0.1'):
+        self.db = db
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.validator = RequestValidator(auth_token) if auth_token else None
+        self.received = 0
+        self._updates = []
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._httpd = ThreadingHTTPServer((host, port), _CallbackHandler)
+        self._httpd.daemon_threads = True
+        self._httpd.receiver = self
+        self.public_url = public_url or self.url
+        self._threads = []
+
+    @property
+    def url(self):
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def add(self, update):
+        with self._lock:
+            self._updates.append(update)
+            self.received += 1
+            full = len(self._updates) >= self.batch_size
+        if full:
+            self._wake.set()
+
+    def flush(self):
+        """Write the buffered updates; returns the rows changed."""
+        with self._lock:
+            updates, self._updates = self._updates, []
+        if not updates:
+            return 0
+        try:
+            return self.db.update_message_statuses(updates)
+        except Exception as e:
+            print(f"Error saving message statuses: {e}")
+            with self._lock:
+                self._updates[:0] = updates
+            return 0
+
+    def _run_flusher(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+        self.flush()
+        self.db.connections.close()
+
+    def _spawn(self, target, name):
+        thread = threading.Thread(target=target, name=name, daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    def start(self):
+        """Serve and flush from background threads; returns self."""
+        self._spawn(self._httpd.serve_forever, 'status-callbacks')
+        self._spawn(self._run_flusher, 'status-flusher')
+        return self
+
+    def serve_forever(self):
+        """Serve from the calling thread, flushing from a background one."""
+        self._spawn(self._run_flusher, 'status-flusher')
+        self._httpd.serve_forever()
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        self._stop.set()
+        self._wake.set()
+        for thread in self._threads:
+            thread.join()
@@ -0,0 +1,73 @@
+"""Excel exports streamed from database cursors.
+
+Workbooks are written with openpyxl's write-only mode: each row is appended
+as it comes from the cursor and flushed to a temporary file, so memory stays
+flat however many staff or days a register covers.
+"""
+import calendar
+from datetime import date
+
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font
+
+from database import ADVANCE_LEDGER_COLUMNS, REPORT_COLUMNS
+from payroll import ABSENT, LEAVE, PRESENT, UNMARKED
+
+XLSX_MIME = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+# Attendance register letters, unmarked days left empty; holiday dates show
+# HOLIDAY_CODE for everyone
+REGISTER_CODES = {UNMARKED: None, ABSENT: 'A', PRESENT: 'P', LEAVE: 'L'}
+HOLIDAY_CODE = 'H'
+
+
+def payroll_workbook_name(year, month):
+    return f"payroll_{year}_{month:02d}.xlsx"
+
+
+def _column_title(column):
+    return column.replace('_', ' ').title()
+
+
+def _add_sheet(workbook, title, headers):
+    """A write-only sheet with a bold, frozen header row."""
+    sheet = workbook.create_sheet(title)
+    sheet.freeze_panes = 'C2'
+    bold = Font(bold=True)
+    cells = []
+    for header in headers:
+        cell = WriteOnlyCell(sheet, value=header)
+        cell.font = bold
+        cells.append(cell)
+    sheet.append(cells)
+    return sheet
+
+
+def write_payroll_workbook(db, year, month, target):
+    """Write a month's payroll, attendance register and advances ledger.
+
+    `target` is a file path or a binary file object. The Payroll sheet
+    matches get_monthly_report, the Attendance sheet has one column per day
+    and the Advances sheet lists every advance given up to the month end.
+    """
+    _, num_days = calendar.monthrange(year, month)
+    workbook = Workbook(write_only=True)
+
+    payroll = _add_sheet(workbook, 'Payroll', [_column_title(column) for column in REPORT_COLUMNS])
+    for row in db.iter_monthly_report(year, month):
+        payroll.append(row)
+
+    holidays = {int(day[8:10]) for day in db.get_holidays(year, month)['date']}
+    register = _add_sheet(workbook, 'Attendance', ['Id', 'Name'] + list(range(1, num_days + 1)))
+    for staff_id, name, statuses in db.iter_attendance_register(year, month):
+        register.append([staff_id, name] + [
+            HOLIDAY_CODE if day in holidays else REGISTER_CODES[status]
+            for day, status in enumerate(statuses, 1)
+        ])
+
+    ledger = _add_sheet(workbook, 'Advances', [_column_title(column) for column in ADVANCE_LEDGER_COLUMNS])
+    for row in db.iter_advance_ledger(date(year, month, num_days)):
+        ledger.append(row)
+
+    workbook.save(target)
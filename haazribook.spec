@@ -12,8 +12,18 @@ a = Analysis(
     binaries=[],
     datas=[
         ('app.py', '.'),
+        ('caching.py', '.'),
+        ('config.py', '.'),
         ('database.py', '.'),
+        ('delivery.py', '.'),
+        ('exports.py', '.'),
+        ('manage.py', '.'),
         ('messaging.py', '.'),
+        ('payroll.py', '.'),
+        ('payslips.py', '.'),
+        ('snapshot.py', '.'),
+        ('transports.py', '.'),
+        ('trends.py', '.'),
         ('staff.db', '.'),
         ('requirements.txt', '.'),
     ],
@@ -25,6 +35,17 @@ a = Analysis(
         'bcrypt',
         'xlsxwriter',
         'python-dotenv',
+        'numpy',
+        'pyarrow',
+        'pyarrow.dataset',
+        'pyarrow.parquet',
+        'openpyxl',
+        'twilio',
+        'twilio.rest',
+        'twilio.request_validator',
+        'requests',
+        'http.server',
+        'concurrent.futures',
     ],
     hookspath=[],
     hooksconfig={},
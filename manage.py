@@ -0,0 +1,122 @@
+"""Maintenance commands for a HaazriBook database.
+
+Usage:
+    python manage.py rebuild-summary
+    python manage.py convert-attendance bitmap
+    python manage.py snapshot analytics/
+    python manage.py twilio-standin --port 8765 --throttle-rate 0.1
+    python manage.py reconcile-messages
+    python manage.py status-webhook --port 8766 --public-url https://example.com
+"""
+import argparse
+
+from database import ATTENDANCE_STORES, Database
+from delivery import RECONCILE_WINDOW_DAYS, StatusCallbackServer, reconcile_deliveries
+from messaging import MessagingService
+from snapshot import write_snapshot
+from transports import LocalTwilioServer
+
+
+def rebuild_summary(db, args):
+    db.rebuild_monthly_summary()
+    conn = db.get_connection()
+    count = conn.execute('SELECT COUNT(*) FROM monthly_summary').fetchone()[0]
+    counters = conn.execute('SELECT COUNT(*) FROM dashboard_counters').fetchone()[0]
+    print(f"Rebuilt monthly_summary: {count} rows, dashboard_counters: {counters} rows")
+
+
+def convert_attendance(db, args):
+    moved = db.convert_attendance_store(args.store)
+    # Give the pages freed by the old store back to the filesystem
+    db.get_connection().execute('VACUUM')
+    print(f"Attendance store is now '{args.store}': {moved} marks converted")
+
+
+def snapshot(db, args):
+    written = write_snapshot(db, args.directory, through=args.through, full=args.full)
+    for table, months in written.items():
+        print(f"{table}: {len(months)} new partitions")
+
+
+def twilio_standin(db, args):
+    server = LocalTwilioServer(
+        args.port, args.latency, args.error_rate, args.throttle_rate,
+        delivery_delay=args.delivery_delay, undelivered_rate=args.undelivered_rate
+    )
+    print(f"Twilio stand-in listening on {server.url}; set twilio_api_url to it. Ctrl+C to stop.")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+        print(f"Requests: {server.counts}")
+
+
+def reconcile_messages(db, args):
+    service = MessagingService(db)
+    if not service.is_configured():
+        print("Messaging is not configured.")
+        return
+    unresolved, updated = reconcile_deliveries(db, service.transport, args.days)
+    print(f"Checked {unresolved} messages awaiting a final status: {updated} updated")
+
+
+def status_webhook(db, args):
+    server = StatusCallbackServer(
+        db, args.port, db.get_setting('twilio_auth_token'), args.public_url, host=args.host
+    )
+    print(f"Receiving status callbacks on {server.url}; set messaging_status_callback to "
+          f"{server.public_url}/<any path>. Ctrl+C to stop.")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+        print(f"Callbacks received: {server.received}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--db', default='staff.db', help='database file (default: staff.db)')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    rebuild = commands.add_parser('rebuild-summary', help='recompute the monthly_summary rollup and dashboard counters from raw rows')
+    rebuild.set_defaults(func=rebuild_summary)
+
+    convert = commands.add_parser('convert-attendance', help='switch the attendance store layout')
+    convert.add_argument('store', choices=ATTENDANCE_STORES)
+    convert.set_defaults(func=convert_attendance)
+
+    snap = commands.add_parser('snapshot', help='export history to month-partitioned Parquet files')
+    snap.add_argument('directory')
+    snap.add_argument('--through', help='last month to export, YYYY-MM (default: last complete month)')
+    snap.add_argument('--full', action='store_true', help='rewrite every partition instead of adding new attendance and holiday months')
+    snap.set_defaults(func=snapshot)
+
+    standin = commands.add_parser('twilio-standin', help='serve a local imitation of the Twilio Messages API')
+    standin.add_argument('--port', type=int, default=8765)
+    standin.add_argument('--latency', type=float, default=0.0, help='seconds to wait before answering')
+    standin.add_argument('--error-rate', type=float, default=0.0, help='share of requests answered 500')
+    standin.add_argument('--throttle-rate', type=float, default=0.0, help='share of requests answered 429')
+    standin.add_argument('--delivery-delay', type=float, default=1.0, help='seconds before a message is delivered')
+    standin.add_argument('--undelivered-rate', type=float, default=0.0, help='share of messages never delivered')
+    standin.set_defaults(func=twilio_standin)
+
+    reconcile = commands.add_parser('reconcile-messages', help='fetch delivery statuses of recently sent messages')
+    reconcile.add_argument('--days', type=int, default=RECONCILE_WINDOW_DAYS, help='how far back to check')
+    reconcile.set_defaults(func=reconcile_messages)
+
+    webhook = commands.add_parser('status-webhook', help='receive Twilio delivery status callbacks')
+    webhook.add_argument('--host', default='127.0.0.1', help='address to listen on (default: loopback only)')
+    webhook.add_argument('--port', type=int, default=8766)
+    webhook.add_argument('--public-url', help='URL Twilio posts to, for checking signatures (default: the local address)')
+    webhook.set_defaults(func=status_webhook)
+
+    args = parser.parse_args()
+    args.func(Database(args.db), args)
+
+
+if __name__ == '__main__':
+    main()
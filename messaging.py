@@ -1,21 +1,189 @@
 import os
-from twilio.rest import Client
+import random
+import threading
+import time
+import uuid
+from datetime import date
 from database import Database
+from transports import FileSinkTransport, SendError, TwilioTransport
+
+# Outbox worker threads when the messaging_workers setting is unset
+OUTBOX_WORKERS = 4
+
+# Seconds an idle worker sleeps before checking the outbox again; enqueueing
+# wakes the workers straight away
+OUTBOX_POLL_INTERVAL = 5
+
+# Sends per second from one sender number when the messaging_rate setting
+# is unset; Twilio queues or rejects bursts above a number's allowance
+MESSAGING_RATE = 1.0
+
+# Attempts per outbox message, and the exponential backoff between them
+OUTBOX_MAX_ATTEMPTS = 5
+RETRY_BASE_DELAY = 2.0
+RETRY_MAX_DELAY = 300.0
+
+# Values of the messaging_transport setting: send through Twilio (or the
+# server at the twilio_api_url setting), or append to messaging_sink_path
+MESSAGING_TRANSPORTS = ('twilio', 'sink')
+DEFAULT_SINK_PATH = 'messages.jsonl'
+
+
+class TokenBucket:
+    """Thread-safe rate limiter: `rate` tokens per second, at most `capacity` saved up."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Take a token, sleeping until one is available."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+def backoff_delay(attempts):
+    """Seconds before retrying after `attempts` tries: exponential with full jitter."""
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempts - 1)))
+
+
+def message_key(staff_id, kind, period):
+    """Idempotency key of the `kind` message to a staff member for a period
+    or record (a month, an advance id, a repayment id and day)."""
+    return f"{kind}:{int(staff_id)}:{period}"
+
+
+def attendance_summary_text(name, year, month, days_present, calculated_salary, total_advance, final_salary):
+    return (
+        f"Dear {name},\n\n"
+        f"Your attendance summary for {year}-{month:02d}:\n"
+        f"You were present on {int(days_present)} days.\n"
+        f"Salary: ₹{calculated_salary:,.2f}\n"
+        f"Advance: ₹{total_advance:,.2f}\n"
+        f"Final: ₹{final_salary:,.2f}\n\n"
+        f"Thank you for your hard work!"
+    )
+
+
+class OutboxWorkerPool:
+    """Threads that drain message_outbox, sending through a MessagingService.
+
+    Each worker claims one pending message at a time, so `workers` is the
+    number of sends in flight at once. A claim lasts OUTBOX_LEASE seconds;
+    a message whose worker died mid-send is taken over after that, so pools
+    in other processes on the same database leave live claims alone.
+    """
+
+    def __init__(self, service, workers=OUTBOX_WORKERS):
+        self.service = service
+        self.workers = workers
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._threads = []
+
+    def start(self):
+        pool_id = uuid.uuid4().hex
+        for i in range(self.workers):
+            owner = f"{pool_id}:{i}"
+            thread = threading.Thread(target=self._run, args=(owner,), name=f"outbox-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def wake(self):
+        self._wake.set()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        self._wake.set()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def _record(self, write, message_id, *args, **kwargs):
+        """Run an outbox status write for a claimed message, retrying until it
+        succeeds or the pool stops.
+
+        The message may already have gone out, so it is not dropped back to
+        pending; if the pool stops first, the claim lapses and it is sent again.
+        """
+        while True:
+            try:
+                write(message_id, *args, **kwargs)
+                return
+            except Exception as e:
+                print(f"Error recording outbox message {message_id}: {e}")
+            if self._stop.wait(OUTBOX_POLL_INTERVAL):
+                return
+
+    def _run(self, owner):
+        db = self.service.db
+        while not self._stop.is_set():
+            try:
+                claimed = db.claim_outbox_messages(owner)
+            except Exception as e:
+                print(f"Error claiming outbox messages: {e}")
+                claimed = []
+            if not claimed:
+                self._wake.wait(OUTBOX_POLL_INTERVAL)
+                self._wake.clear()
+                continue
+            for message_id, _, to_number, body, attempts in claimed:
+                try:
+                    sid = self.service.deliver(to_number, body)
+                except SendError as e:
+                    if e.retryable and attempts < OUTBOX_MAX_ATTEMPTS:
+                        self._record(db.retry_outbox_message, message_id, owner,
+                                     backoff_delay(attempts), str(e), e.code)
+                    else:
+                        self._record(db.finish_outbox_message, message_id, owner, False, str(e), error_code=e.code)
+                except Exception as e:
+                    self._record(db.finish_outbox_message, message_id, owner, False, str(e))
+                else:
+                    self._record(db.finish_outbox_message, message_id, owner, True, sid=sid)
+        db.connections.close()
+
 
 class MessagingService:
-    def __init__(self):
-        self.db = Database()
+    """Staff notifications through a transport (see transports.py).
+
+    `transport` defaults to the one named by the messaging_transport setting.
+    """
+
+    def __init__(self, db=None, transport=None):
+        self.db = db or Database()
+        self.workers = None
+        # One TokenBucket per sender number
+        self._buckets = {}
+        self._buckets_lock = threading.Lock()
         self.twilio_account_sid = self.db.get_setting('twilio_account_sid')
         self.twilio_auth_token = self.db.get_setting('twilio_auth_token')
         self.twilio_from_number = self.db.get_setting('twilio_from_number')
-        
+        self.transport = transport or self._configured_transport()
+    
+    def _configured_transport(self):
+        kind = self.db.get_setting('messaging_transport', 'twilio')
+        if kind == 'sink':
+            return FileSinkTransport(self.db.get_setting('messaging_sink_path', DEFAULT_SINK_PATH))
         if self.twilio_account_sid and self.twilio_auth_token:
-            self.client = Client(self.twilio_account_sid, self.twilio_auth_token)
-        else:
-            self.client = None
+            return TwilioTransport(
+                self.twilio_account_sid, self.twilio_auth_token,
+                self.db.get_setting('twilio_api_url'),
+                self.db.get_setting('messaging_status_callback')
+            )
+        return None
     
     def is_configured(self):
-        return self.client is not None
+        return self.transport is not None
     
     def configure(self, account_sid, auth_token, from_number):
         self.db.set_setting('twilio_account_sid', account_sid)
@@ -26,80 +194,139 @@ class MessagingService:
         self.twilio_auth_token = auth_token
         self.twilio_from_number = from_number
         
-        self.client = Client(account_sid, auth_token)
+        self.transport = self._configured_transport()
     
-    def send_message(self, to_number, message):
+    def rate_limiter(self, from_number):
+        """The TokenBucket pacing sends from `from_number`, at the messaging_rate setting."""
+        with self._buckets_lock:
+            bucket = self._buckets.get(from_number)
+            if bucket is None:
+                rate = float(self.db.get_setting('messaging_rate', MESSAGING_RATE))
+                bucket = self._buckets[from_number] = TokenBucket(rate)
+            return bucket
+
+    def deliver(self, to_number, message):
+        """Send one message, waiting for the sender number's rate limit.
+
+        Returns the provider's message SID; raises SendError.
+        """
         if not self.is_configured():
-            return False, "Twilio is not configured. Please set up your Twilio credentials in the settings."
+            raise SendError("Twilio is not configured. Please set up your Twilio credentials in the settings.")
         
+        self.rate_limiter(self.twilio_from_number).acquire()
+        return self.transport.send(self.twilio_from_number, to_number, message)
+    
+    def send_message(self, to_number, message):
+        """Send straight away, bypassing the outbox; the attempt is logged in message_log."""
         try:
-            self.client.messages.create(
-                body=message,
-                from_=self.twilio_from_number,
-                to=to_number
-            )
-            return True, "Message sent successfully."
-        except Exception as e:
+            sid = self.deliver(to_number, message)
+        except SendError as e:
+            self.db.log_message(to_number, error=str(e), error_code=e.code)
             return False, f"Failed to send message: {str(e)}"
+        self.db.log_message(to_number, sid)
+        return True, "Message sent successfully."
     
-    def send_attendance_summary(self, staff_id, year, month):
-        """Send monthly attendance summary to a staff member"""
-        staff_df = self.db.get_all_staff()
-        staff = staff_df[staff_df['id'] == staff_id].iloc[0]
-        
-        if not staff['phone']:
+    def start_workers(self, workers=None):
+        """Start the outbox worker pool once and return it.
+
+        `workers` defaults to the messaging_workers setting.
+        """
+        if self.workers is None:
+            workers = workers or int(self.db.get_setting('messaging_workers', OUTBOX_WORKERS))
+            self.workers = OutboxWorkerPool(self, workers)
+            self.workers.start()
+        return self.workers
+
+    def enqueue_messages(self, messages, batch=None):
+        """Queue (staff_id, to_number, body, idempotency_key) messages for the worker pool.
+
+        Returns (batch id, keys already queued or sent) as Database.enqueue_messages;
+        progress is Database.get_outbox_progress(batch).
+        """
+        batch, duplicates = self.db.enqueue_messages(messages, batch)
+        self.start_workers().wake()
+        return batch, duplicates
+
+    def _queue_one(self, staff_id, kind, period, message):
+        """Queue a message to one staff member; returns (queued, reason)."""
+        staff = self.db.get_staff_directory([staff_id]).get(int(staff_id))
+        if staff is None:
+            return False, "Staff member not found."
+        name, phone = staff
+        if not phone:
             return False, "Staff member does not have a phone number."
-        
-        # Get attendance data
-        report_df = self.db.get_monthly_report(year, month)
-        staff_report = report_df[report_df['staff_id'] == staff_id].iloc[0]
-        
-        # Format message
-        message = (
-            f"Dear {staff['name']},\n\n"
-            f"Your attendance summary for {year}-{month:02d}:\n"
-            f"You were present on {int(staff_report['days_present'])} days.\n"
-            f"Salary: ₹{staff_report['calculated_salary']:,.2f}\n"
-            f"Advance: ₹{staff_report['total_advance']:,.2f}\n"
-            f"Final: ₹{staff_report['final_salary']:,.2f}\n\n"
-            f"Thank you for your hard work!"
-        )
-        
-        return self.send_message(staff['phone'], message)
+        _, duplicates = self.enqueue_messages([
+            (staff_id, phone, message(name), message_key(staff_id, kind, period))
+        ])
+        if duplicates:
+            return False, "Message already queued or sent."
+        return True, "Message queued."
+
+    def _monthly_summaries(self, year, month, staff_ids=None):
+        """([(staff_id, phone, message)], {staff_id: reason skipped}) for the
+        month's attendance summaries, from one report and one staff read."""
+        directory = self.db.get_staff_directory(staff_ids)
+        wanted = set(directory) if staff_ids is None else {int(staff_id) for staff_id in staff_ids}
+        messages = []
+        skipped = {staff_id: "Staff member not found." for staff_id in wanted - set(directory)}
+        for staff_id, name, _, days_present, _, calculated, advance, final in self.db.iter_monthly_report(year, month):
+            if staff_id not in wanted:
+                continue
+            phone = directory[staff_id][1]
+            if not phone:
+                skipped[staff_id] = "Staff member does not have a phone number."
+                continue
+            messages.append((staff_id, phone, attendance_summary_text(
+                name, year, month, days_present, calculated, advance, final
+            ), message_key(staff_id, 'attendance_summary', f"{year}-{month:02d}")))
+        return messages, skipped
+
+    def send_monthly_summaries(self, year, month, staff_ids=None, batch=None):
+        """Queue the month's attendance summary for `staff_ids` (default: all
+        visible staff) on the outbox.
+
+        Each summary is keyed by staff member and month, so sending again
+        only retries summaries that failed. Returns (batch id, or
+        None when nothing was queued, and {staff_id: reason} for staff that
+        were skipped).
+        """
+        messages, skipped = self._monthly_summaries(year, month, staff_ids)
+        if not messages:
+            return None, skipped
+        batch, duplicates = self.enqueue_messages(messages, batch)
+        duplicates = set(duplicates)
+        for staff_id, _, _, key in messages:
+            if key in duplicates:
+                skipped[staff_id] = "Summary already queued or sent."
+        return (batch if len(duplicates) < len(messages) else None), skipped
+
+    def send_attendance_summary(self, staff_id, year, month):
+        """Queue monthly attendance summary to a staff member"""
+        messages, skipped = self._monthly_summaries(year, month, [staff_id])
+        if not messages:
+            return False, skipped[int(staff_id)]
+        _, duplicates = self.enqueue_messages(messages)
+        if duplicates:
+            return False, "Summary already queued or sent."
+        return True, "Message queued."
     
-    def send_advance_notification(self, staff_id, amount, date):
-        """Send notification about a new advance payment"""
-        staff_df = self.db.get_all_staff()
-        staff = staff_df[staff_df['id'] == staff_id].iloc[0]
-        
-        if not staff['phone']:
-            return False, "Staff member does not have a phone number."
-        
-        # Format message
-        message = (
-            f"Dear {staff['name']},\n\n"
+    def send_advance_notification(self, staff_id, amount, date, advance_id):
+        """Queue notification about a new advance payment, once per advance"""
+        return self._queue_one(staff_id, 'advance', advance_id, lambda name: (
+            f"Dear {name},\n\n"
             f"An advance payment of ₹{amount:,.2f} has been recorded on {date}.\n"
             f"This will be deducted from your salary.\n\n"
             f"Thank you!"
-        )
-        
-        return self.send_message(staff['phone'], message)
+        ))
     
-    def send_repayment_reminder(self, staff_id, amount, due_date):
-        """Send reminder about pending advance repayment"""
-        staff_df = self.db.get_all_staff()
-        staff = staff_df[staff_df['id'] == staff_id].iloc[0]
-        
-        if not staff['phone']:
-            return False, "Staff member does not have a phone number."
-        
-        # Format message
-        message = (
-            f"Dear {staff['name']},\n\n"
+    def send_repayment_reminder(self, staff_id, amount, due_date, repayment_id, sent_on=None):
+        """Queue reminder about pending advance repayment, at most once per
+        instalment per day (`sent_on`, default today)"""
+        period = f"{repayment_id}/{sent_on or date.today()}"
+        return self._queue_one(staff_id, 'repayment_reminder', period, lambda name: (
+            f"Dear {name},\n\n"
             f"This is a reminder that you have an advance repayment of ₹{amount:,.2f} "
             f"due on {due_date}.\n\n"
             f"Please ensure this is deducted from your salary.\n\n"
             f"Thank you!"
-        )
-        
-        return self.send_message(staff['phone'], message) 
\ No newline at end of file
+        ))
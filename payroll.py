@@ -0,0 +1,245 @@
+"""Vectorised payroll over a staff-by-day attendance matrix.
+
+Database.get_payroll_matrix() loads whole months into a PayrollMatrix; the
+totals below are NumPy reductions over that matrix, so the cost of a payroll
+run grows with staff x days and never with a Python loop per staff member.
+"""
+from datetime import date
+
+import numpy as np
+import pandas as pd
+
+# Status codes held in PayrollMatrix.status
+UNMARKED = 0
+ABSENT = 1
+PRESENT = 2
+LEAVE = 3  # marked holiday/leave without being present
+
+# Calendar-only code for holiday dates, which count for everyone
+HOLIDAY = 4
+
+STATUS_LABELS = {UNMARKED: '', ABSENT: 'Absent', PRESENT: 'Present', LEAVE: 'Leave', HOLIDAY: 'Holiday'}
+
+_EPOCH_YEAR = 1970
+
+
+def status_codes(is_present, is_holiday):
+    """Status codes for arrays of is_present / is_holiday flags."""
+    is_present = np.asarray(is_present, dtype=bool)
+    is_holiday = np.asarray(is_holiday, dtype=bool)
+    return np.where(is_present, PRESENT, np.where(is_holiday, LEAVE, ABSENT)).astype(np.int8)
+
+
+def mask_status_codes(marked, present, holiday, num_days=31):
+    """Status codes of shape (len(marked), num_days) from per-month day bit
+    masks (bit 0 is day 1), as stored in attendance_bitmap."""
+    shifts = np.arange(num_days, dtype=np.int64)
+
+    def bits(masks):
+        return ((np.asarray(masks, dtype=np.int64)[:, None] >> shifts) & 1).astype(bool)
+
+    return np.where(bits(marked), status_codes(bits(present), bits(holiday)), UNMARKED).astype(np.int8)
+
+
+class AttendanceCalendar:
+    """Attendance status for staff x days of one month.
+
+    Rows follow `staff_ids` and `names`; columns are the month's `days`
+    (with short `day_labels`). Holiday dates are HOLIDAY for everyone and
+    named in `holidays` ({day of month: name}).
+    """
+
+    def __init__(self, year, month, staff_ids, names, status, holidays):
+        self.year = year
+        self.month = month
+        self.staff_ids = np.asarray(staff_ids, dtype=np.int64)
+        self.names = np.asarray(names, dtype=object)
+        self.days = [date(year, month, day) for day in range(1, status.shape[1] + 1)]
+        self.day_labels = [day.strftime('%d %a') for day in self.days]
+        self.holidays = dict(holidays)
+        self.status = status
+        if self.holidays:
+            self.status[:, [day - 1 for day in self.holidays]] = HOLIDAY
+
+    def counts(self, code):
+        """Staff with status `code` on each day."""
+        return (self.status == code).sum(axis=0)
+
+    def to_frame(self):
+        """Wide DataFrame: id, name and one status label column per day."""
+        labels = np.array([STATUS_LABELS[code] for code in sorted(STATUS_LABELS)], dtype=object)
+        frame = pd.DataFrame(labels[self.status], columns=self.day_labels)
+        frame.insert(0, 'name', self.names)
+        frame.insert(0, 'id', self.staff_ids)
+        return frame
+
+
+class PayrollMatrix:
+    """Attendance status for staff x days, with holidays, salaries and deductions.
+
+    Rows follow `staff_ids`; columns are the days from `start` to `end`
+    inclusive. Monthly figures are arrays of shape (staff, months).
+    `salaries` is each staff member's salary when they have no salary history.
+    """
+
+    def __init__(self, staff_ids, names, salaries, start, end):
+        self.staff_ids = np.asarray(staff_ids, dtype=np.int64)
+        self.names = np.asarray(names, dtype=object)
+        self.salaries = np.asarray(salaries, dtype=np.float64)
+        self.days = np.arange(np.datetime64(start, 'D'), np.datetime64(end, 'D') + 1)
+        day_months = self.days.astype('datetime64[M]')
+        self.months, self.month_starts = np.unique(day_months, return_index=True)
+        self.days_in_month = np.diff(np.append(self.month_starts, len(self.days)))
+
+        self.status = np.zeros((len(self.staff_ids), len(self.days)), dtype=np.int8)
+        self.holiday_mask = np.zeros(len(self.days), dtype=bool)
+        self.deductions = np.zeros((len(self.staff_ids), len(self.months)))
+        self.daily_salary = np.repeat(self.salaries[:, None], len(self.days), axis=1)
+
+        self._id_order = np.argsort(self.staff_ids, kind='stable')
+        self._sorted_ids = self.staff_ids[self._id_order]
+
+    # Loading
+    def staff_rows(self, staff_ids):
+        """Matrix rows for `staff_ids`, and a mask of ids that are in the matrix."""
+        staff_ids = np.asarray(staff_ids, dtype=np.int64)
+        if not len(self._sorted_ids):
+            return np.zeros(len(staff_ids), dtype=np.intp), np.zeros(len(staff_ids), dtype=bool)
+        pos = np.searchsorted(self._sorted_ids, staff_ids).clip(0, len(self._sorted_ids) - 1)
+        return self._id_order[pos], self._sorted_ids[pos] == staff_ids
+
+    def month_offsets(self, years, months):
+        """Month columns for arrays of calendar years and months."""
+        numbers = (np.asarray(years, dtype=np.int64) - _EPOCH_YEAR) * 12 + np.asarray(months, dtype=np.int64) - 1
+        return numbers - self.months[0].astype(np.int64)
+
+    def set_holidays(self, day_offsets):
+        self.holiday_mask[np.asarray(day_offsets, dtype=np.intp)] = True
+
+    def set_marks(self, staff_ids, day_offsets, is_present, is_holiday):
+        """Store one mark per (staff, day offset from start)."""
+        rows, valid = self.staff_rows(staff_ids)
+        days = np.asarray(day_offsets, dtype=np.intp)
+        self.status[rows[valid], days[valid]] = status_codes(is_present, is_holiday)[valid]
+
+    def set_month_masks(self, staff_ids, years, months, marked, present, holiday):
+        """Store marks given as per-month day bit masks (bit 0 is day 1)."""
+        rows, valid = self.staff_rows(staff_ids)
+        month_idx = self.month_offsets(years, months)
+        valid &= (month_idx >= 0) & (month_idx < len(self.months))
+        rows, month_idx = rows[valid], month_idx[valid]
+        status = mask_status_codes(*(np.asarray(masks, dtype=np.int64)[valid] for masks in (marked, present, holiday)))
+
+        shifts = np.arange(31, dtype=np.int64)
+        columns = self.month_starts[month_idx][:, None] + shifts
+        in_month = shifts < self.days_in_month[month_idx][:, None]
+        self.status[np.broadcast_to(rows[:, None], columns.shape)[in_month], columns[in_month]] = status[in_month]
+
+    def set_salary_history(self, staff_ids, day_offsets, salaries):
+        """Resolve the salary in force on each day from effective-dated changes.
+
+        Rows must be ordered by staff, effective date and insertion order, as
+        salary_history is read. A change lasts until the next one for the same
+        staff member, and the earliest also covers the days before it.
+        """
+        rows, valid = self.staff_rows(staff_ids)
+        offsets = np.asarray(day_offsets, dtype=np.int64)[valid].clip(-1, len(self.days))
+        salaries = np.asarray(salaries, dtype=np.float64)[valid]
+        order = np.argsort(rows[valid], kind='stable')
+        rows, offsets, salaries = rows[valid][order], offsets[order], salaries[order]
+        if not len(rows):
+            return
+
+        # Sorted (row, offset) keys turn the per-day lookup into one
+        # searchsorted over every staff member with history
+        span = len(self.days) + 2
+        keys = rows * span + offsets + 1
+        history_rows, first = np.unique(rows, return_index=True)
+        day_keys = history_rows[:, None] * span + np.arange(len(self.days)) + 1
+        current = np.searchsorted(keys, day_keys, side='right') - 1
+        current = np.maximum(current, first[:, None])
+        self.daily_salary[history_rows] = salaries[current]
+
+    def add_deductions(self, staff_ids, years, months, amounts):
+        rows, valid = self.staff_rows(staff_ids)
+        month_idx = self.month_offsets(years, months)
+        valid &= (month_idx >= 0) & (month_idx < len(self.months))
+        np.add.at(self.deductions, (rows[valid], month_idx[valid]), np.asarray(amounts, dtype=np.float64)[valid])
+
+    # Reductions
+    def _per_month(self, values):
+        return np.add.reduceat(values.astype(np.int32), self.month_starts, axis=-1)
+
+    def _count(self, code):
+        # Marks on holiday dates are covered by the holiday itself
+        return self._per_month((self.status == code) & ~self.holiday_mask)
+
+    def holiday_days(self):
+        return self._per_month(self.holiday_mask)
+
+    def working_days(self):
+        return self.days_in_month - self.holiday_days()
+
+    def present_days(self):
+        """Present days per staff and month, with holidays counted as present."""
+        return self._count(PRESENT) + self.holiday_days()
+
+    def leave_days(self):
+        return self._count(LEAVE)
+
+    def absent_days(self):
+        return self._count(ABSENT)
+
+    def calculated_salary(self):
+        """Salary for present days and holidays over working days.
+
+        Each credited day is paid at the salary in force that day, so a
+        mid-month change is pro-rated within the month.
+        """
+        credited = (self.status == PRESENT) | self.holiday_mask
+        earned = np.add.reduceat(np.where(credited, self.daily_salary, 0.0), self.month_starts, axis=1)
+        working_days = self.working_days()
+        return np.divide(earned, working_days, out=np.zeros(earned.shape), where=working_days > 0)
+
+    def final_salary(self):
+        return self.calculated_salary() - self.deductions
+
+    def day_offset(self, day):
+        """Column of a date in the matrix."""
+        return int((np.datetime64(day, 'D') - self.days[0]).astype(np.int64))
+
+    def window_totals(self, rows, first, stop):
+        """Totals for matrix `rows` over day columns first..stop-1 as one pay period.
+
+        Returns (days_present, working_days, calculated_salary, salary at the
+        end of the window), with the same rules as a calendar month.
+        """
+        status = self.status[rows, first:stop]
+        holidays = self.holiday_mask[first:stop]
+        holiday_days = int(holidays.sum())
+        working_days = (stop - first) - holiday_days
+
+        present = status == PRESENT
+        days_present = (present & ~holidays).sum(axis=1) + holiday_days
+        earned = np.where(present | holidays, self.daily_salary[rows, first:stop], 0.0).sum(axis=1)
+        calculated = earned / working_days if working_days > 0 else np.zeros(len(rows))
+        return days_present, working_days, calculated, self.daily_salary[rows, stop - 1]
+
+    def report(self):
+        """Payroll totals per staff member over the whole range.
+
+        For a single month this matches Database.get_monthly_report().
+        """
+        calculated = self.calculated_salary().sum(axis=1)
+        total_advance = self.deductions.sum(axis=1)
+        return pd.DataFrame({
+            'id': self.staff_ids,
+            'name': self.names,
+            # Salary in force at the end of the range
+            'monthly_salary': self.daily_salary[:, -1],
+            'days_present': self.present_days().sum(axis=1),
+            'working_days': int(self.working_days().sum()),
+            'calculated_salary': calculated,
+            'total_advance': total_advance,
+            'final_salary': calculated - total_advance,
+        })
@@ -0,0 +1,311 @@
+"""Columnar Parquet snapshots of attendance and payroll history.
+
+write_snapshot() copies the history tables into a directory of Parquet files
+partitioned by month (<table>/month=YYYY-MM/part-0.parquet) plus the staff
+list, for analysis in notebooks without querying the live database. Only
+complete months are exported. Attendance and holiday months already on disk
+are never rewritten, so repeated runs only append to them; the tables in
+MUTABLE_TABLES are rewritten in full on every run. `full=True` exports
+everything again, for example after correcting old attendance or holidays.
+
+Snapshot reads such a directory back through Arrow datasets.
+"""
+import calendar
+import json
+import os
+import shutil
+import tempfile
+from datetime import date, datetime
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from database import attendance_rows_sql, cycle_day, get_attendance_store, get_schema_version, to_date_str
+from payroll import PayrollMatrix
+
+# Rows fetched from SQLite and written to Parquet at a time
+BATCH_ROWS = 65536
+
+MANIFEST_NAME = 'snapshot.json'
+STAFF_FILE = 'staff.parquet'
+
+# Partitioned history tables: the date column each is partitioned by and
+# its exported columns with their Arrow types
+SNAPSHOT_TABLES = {
+    'attendance': ('date', [
+        ('staff_id', pa.int64()),
+        ('date', pa.date32()),
+        ('is_present', pa.bool_()),
+        ('is_holiday', pa.bool_()),
+    ]),
+    'advances': ('date', [
+        ('id', pa.int64()),
+        ('staff_id', pa.int64()),
+        ('amount', pa.float64()),
+        ('date', pa.date32()),
+        ('repayment_type', pa.string()),
+        ('emi_amount', pa.float64()),
+        ('total_emi_count', pa.int64()),
+        ('remaining_amount', pa.float64()),
+        ('status', pa.string()),
+    ]),
+    'advance_repayments': ('due_date', [
+        ('id', pa.int64()),
+        ('advance_id', pa.int64()),
+        ('amount', pa.float64()),
+        ('due_date', pa.date32()),
+        ('is_paid', pa.bool_()),
+        ('paid_date', pa.date32()),
+    ]),
+    'salary_history': ('effective_from', [
+        ('id', pa.int64()),
+        ('staff_id', pa.int64()),
+        ('salary', pa.float64()),
+        ('effective_from', pa.date32()),
+        ('effective_to', pa.date32()),
+    ]),
+    'holidays': ('date', [
+        ('id', pa.int64()),
+        ('date', pa.date32()),
+        ('name', pa.string()),
+    ]),
+}
+
+# History tables whose rows keep changing after their month closes: a
+# repayment is paid, an advance's balance and status follow, and a later
+# salary change closes the previous segment. Every month of these is
+# rewritten on each run; they are small next to attendance.
+MUTABLE_TABLES = ('advances', 'advance_repayments', 'salary_history')
+
+# Rewritten on every run; payroll needs names, salaries and visibility.
+# Cycle days are exported as day numbers (see database.cycle_day).
+STAFF_COLUMNS = [
+    ('id', pa.int64()),
+    ('name', pa.string()),
+    ('phone', pa.string()),
+    ('monthly_salary', pa.float64()),
+    ('salary_cycle_start', pa.int64()),
+    ('salary_cycle_end', pa.int64()),
+    ('hidden', pa.bool_()),
+]
+
+
+def _select_list(columns):
+    # Dates are stored as ISO text, sometimes with a time part
+    return ', '.join(
+        f'substr({name}, 1, 10)' if kind == pa.date32() else name
+        for name, kind in columns
+    )
+
+
+def _record_batch(rows, schema):
+    """A RecordBatch from SQLite row tuples, converting 0/1 and ISO text."""
+    arrays = []
+    for values, field in zip(zip(*rows), schema):
+        if field.type == pa.date32():
+            arrays.append(pa.array(values, pa.string()).cast(pa.date32()))
+        elif field.type == pa.bool_():
+            arrays.append(pa.array(values, pa.int64()).cast(pa.bool_()))
+        else:
+            arrays.append(pa.array(values, field.type))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def _write_parquet(cursor, schema, path):
+    """Stream a cursor into a Parquet file, replacing `path` only when complete."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    partial = path + '.partial'
+    with pq.ParquetWriter(partial, schema) as writer:
+        while True:
+            rows = cursor.fetchmany(BATCH_ROWS)
+            if not rows:
+                break
+            writer.write_batch(_record_batch(rows, schema))
+    os.replace(partial, path)
+
+
+def _write_staff(conn, path):
+    """Write the staff list, reading stored cycle dates as day numbers."""
+    schema = pa.schema(STAFF_COLUMNS)
+    rows = [
+        (*row[:4], cycle_day(row[4], 1), cycle_day(row[5], 31), row[6])
+        for row in conn.execute(f'SELECT {_select_list(STAFF_COLUMNS)} FROM staff ORDER BY id')
+    ]
+    table = pa.Table.from_batches([_record_batch(rows, schema)]) if rows else schema.empty_table()
+    pq.write_table(table, path)
+
+
+def _table_months(conn, table, column):
+    if table == 'attendance' and get_attendance_store(conn) == 'bitmap':
+        sql = "SELECT DISTINCT printf('%04d-%02d', year, month) FROM attendance_bitmap"
+    else:
+        sql = f'SELECT DISTINCT substr({column}, 1, 7) FROM {table}'
+    return sorted(row[0] for row in conn.execute(sql) if row[0])
+
+
+def _partition_path(root, table, month):
+    return os.path.join(root, table, f'month={month}', 'part-0.parquet')
+
+
+def _remove_stale_months(root, table, months):
+    """Delete a table's month partitions that are no longer in `months`."""
+    path = os.path.join(root, table)
+    if not os.path.isdir(path):
+        return
+    keep = {f'month={month}' for month in months}
+    for name in os.listdir(path):
+        if name.startswith('month=') and name not in keep:
+            shutil.rmtree(os.path.join(path, name), ignore_errors=True)
+
+
+def _previous_month(today):
+    return f'{today.year - (today.month == 1):04d}-{(today.month - 2) % 12 + 1:02d}'
+
+
+def write_snapshot(db, root, through=None, full=False):
+    """Export history up to the month `through` ('YYYY-MM', default: the
+    last complete month) into `root`.
+
+    Returns {table: [months written]}. Each month is read in its own short
+    query, so the live database is never held for the whole export. The
+    staff list and manifest are staged and moved into place last, so a
+    failed run never leaves a manifest describing partitions it did not
+    finish.
+    """
+    through = through or _previous_month(date.today())
+    conn = db.get_connection()
+    os.makedirs(root, exist_ok=True)
+    staging = tempfile.mkdtemp(prefix='.staging-', dir=root)
+    try:
+        _write_staff(conn, os.path.join(staging, STAFF_FILE))
+        written = _write_partitions(conn, root, through, full)
+        with open(os.path.join(staging, MANIFEST_NAME), 'w') as manifest:
+            json.dump({
+                'through': through,
+                'taken_at': datetime.now().isoformat(timespec='seconds'),
+                'schema_version': get_schema_version(conn),
+            }, manifest, indent=2)
+        os.replace(os.path.join(staging, STAFF_FILE), os.path.join(root, STAFF_FILE))
+        os.replace(os.path.join(staging, MANIFEST_NAME), os.path.join(root, MANIFEST_NAME))
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+    return written
+
+
+def _write_partitions(conn, root, through, full):
+    """Write the missing month partitions of every history table, and every
+    month of the MUTABLE_TABLES."""
+    written = {}
+    for table, (column, columns) in SNAPSHOT_TABLES.items():
+        if full:
+            shutil.rmtree(os.path.join(root, table), ignore_errors=True)
+        source = f'({attendance_rows_sql(conn)})' if table == 'attendance' else table
+        schema = pa.schema(columns)
+        rewrite = table in MUTABLE_TABLES
+        months = [month for month in _table_months(conn, table, column) if month <= through]
+        if rewrite:
+            _remove_stale_months(root, table, months)
+        written[table] = []
+        for month in months:
+            path = _partition_path(root, table, month)
+            if not rewrite and os.path.exists(path):
+                continue
+            params = {'start': f'{month}-01', 'end': f'{month}-31'}
+            cursor = conn.execute(f'''
+                SELECT {_select_list(columns)} FROM {source}
+                WHERE {column} BETWEEN :start AND :end
+                ORDER BY {column}
+            ''', params)
+            _write_parquet(cursor, schema, path)
+            written[table].append(month)
+    return written
+
+
+class Snapshot:
+    """Read-only access to a snapshot directory written by write_snapshot()."""
+
+    def __init__(self, root):
+        self.root = root
+        with open(os.path.join(root, MANIFEST_NAME)) as manifest:
+            self.manifest = json.load(manifest)
+
+    @property
+    def through(self):
+        """Last month ('YYYY-MM') the snapshot covers."""
+        return self.manifest['through']
+
+    def table(self, name, start_date=None, end_date=None, columns=None):
+        """Rows of a snapshot table as an Arrow table.
+
+        History tables can be limited to start_date..end_date on their
+        partition date column; only the months involved are read.
+        """
+        if name == 'staff':
+            return pq.read_table(os.path.join(self.root, STAFF_FILE), columns=columns)
+        column, fields = SNAPSHOT_TABLES[name]
+        schema = pa.schema(fields)
+        path = os.path.join(self.root, name)
+        if not os.path.isdir(path):
+            return schema.empty_table().select(columns or schema.names)
+
+        month_field = pa.field('month', pa.string())
+        dataset = ds.dataset(
+            path, schema=schema.append(month_field), format='parquet',
+            partitioning=ds.partitioning(pa.schema([month_field]), flavor='hive'),
+        )
+        # The month condition prunes partitions, the date condition rows
+        condition = ds.scalar(True)
+        if start_date is not None:
+            start = date.fromisoformat(to_date_str(start_date))
+            condition &= (ds.field('month') >= start.isoformat()[:7]) & (ds.field(column) >= pa.scalar(start))
+        if end_date is not None:
+            end = date.fromisoformat(to_date_str(end_date))
+            condition &= (ds.field('month') <= end.isoformat()[:7]) & (ds.field(column) <= pa.scalar(end))
+        return dataset.to_table(columns=columns or schema.names, filter=condition)
+
+    def frame(self, name, start_date=None, end_date=None, columns=None):
+        """table() as a pandas DataFrame."""
+        return self.table(name, start_date, end_date, columns).to_pandas()
+
+    def payroll_matrix(self, start_date, end_date):
+        """A PayrollMatrix for the whole months covering start_date..end_date,
+        loaded like Database.get_payroll_matrix but from the snapshot."""
+        start = date.fromisoformat(to_date_str(start_date)).replace(day=1)
+        end = date.fromisoformat(to_date_str(end_date))
+        end = end.replace(day=calendar.monthrange(end.year, end.month)[1])
+        origin = np.datetime64(start, 'D')
+
+        def offsets(values):
+            return (values.to_numpy().astype('datetime64[D]') - origin).astype(np.int64)
+
+        staff = self.frame('staff')
+        staff = staff[~staff['hidden'].fillna(False).astype(bool)]
+        staff = staff.sort_values(['name', 'id'], kind='stable')
+        matrix = PayrollMatrix(staff['id'], staff['name'], staff['monthly_salary'], start, end)
+
+        matrix.set_holidays(offsets(self.table('holidays', start, end, ['date'])['date']))
+
+        marks = self.table('attendance', start, end)
+        matrix.set_marks(
+            marks['staff_id'].to_numpy(), offsets(marks['date']),
+            marks['is_present'].to_numpy(),
+            marks['is_holiday'].to_numpy(),
+        )
+
+        history = self.frame('salary_history', columns=['id', 'staff_id', 'salary', 'effective_from'])
+        history = history.sort_values(['staff_id', 'effective_from', 'id'], kind='stable')
+        matrix.set_salary_history(
+            history['staff_id'].to_numpy(),
+            (history['effective_from'].to_numpy().astype('datetime64[D]') - origin).astype(np.int64),
+            history['salary'].to_numpy(),
+        )
+
+        due = self.frame('advance_repayments', start, end, ['advance_id', 'amount', 'due_date', 'is_paid'])
+        due = due[~due['is_paid'].fillna(False).astype(bool)].merge(
+            self.frame('advances', columns=['id', 'staff_id']), left_on='advance_id', right_on='id'
+        )
+        due_dates = due['due_date'].to_numpy().astype('datetime64[M]').astype(np.int64)
+        matrix.add_deductions(due['staff_id'].to_numpy(), due_dates // 12 + 1970, due_dates % 12 + 1, due['amount'].to_numpy())
+        return matrix
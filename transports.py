@@ -0,0 +1,350 @@
+"""Message transports used by MessagingService, and a local Twilio stand-in.
+
+A transport sends one message with send(from_number, to_number, body),
+returns the provider's message SID and raises SendError on failure.
+fetch_statuses(since) yields (sid, status, error_code, error_message,
+status_updated_at) for messages sent since a UTC datetime, reading them in
+pages rather than one request per message:
+
+- TwilioTransport talks to the Twilio Messages API, or to any server that
+  mimics it (`api_url`);
+- FileSinkTransport appends messages to a JSON lines file and never fails;
+  every message it wrote reads back as delivered.
+
+LocalTwilioServer mimics the Messages API on localhost with configurable
+latency, throttling, error and undelivered rates, and posts status
+callbacks, so throughput, retries and delivery tracking can be measured
+with no network (see benchmark.py messaging and manage.py twilio-standin).
+"""
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlsplit
+from urllib.request import Request, urlopen
+
+from requests import RequestException
+from twilio.base.exceptions import TwilioRestException
+from twilio.request_validator import RequestValidator
+from twilio.rest import Client
+
+# HTTP statuses worth retrying: throttled, or a server-side failure
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+# Messages per page when listing statuses; Twilio allows up to 1000
+STATUS_PAGE_SIZE = 1000
+
+# Format of the timestamps fetch_statuses yields, as SQLite's CURRENT_TIMESTAMP
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+class SendError(Exception):
+    """A message was not accepted. `retryable` failures may succeed later."""
+
+    def __init__(self, message, retryable=False, code=None):
+        super().__init__(message)
+        self.retryable = retryable
+        self.code = code
+
+
+def utc_timestamp(value):
+    """A datetime as a TIMESTAMP_FORMAT string in UTC (naive values are UTC)."""
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc)
+    return value.strftime(TIMESTAMP_FORMAT)
+
+
+class TwilioTransport:
+    """Sends through twilio.rest.Client; `api_url` replaces https://api.twilio.com.
+
+    With `status_callback` set, Twilio posts each status change of a sent
+    message to that URL (see delivery.StatusCallbackServer).
+    """
+
+    def __init__(self, account_sid, auth_token, api_url=None, status_callback=None):
+        self.client = Client(account_sid, auth_token)
+        if api_url:
+            self.client.api.base_url = api_url
+        self.status_callback = status_callback
+
+    def send(self, from_number, to_number, body):
+        options = {'status_callback': self.status_callback} if self.status_callback else {}
+        try:
+            return self.client.messages.create(body=body, from_=from_number, to=to_number, **options).sid
+        except TwilioRestException as e:
+            raise SendError(e.msg, retryable=e.status in RETRYABLE_STATUSES, code=e.code) from e
+        except RequestException as e:
+            # Connection failures and timeouts
+            raise SendError(str(e), retryable=True) from e
+        except Exception as e:
+            raise SendError(str(e)) from e
+
+    def fetch_statuses(self, since):
+        for message in self.client.messages.stream(date_sent_after=since, page_size=STATUS_PAGE_SIZE):
+            yield (
+                message.sid,
+                message.status,
+                message.error_code,
+                message.error_message,
+                message.date_updated and utc_timestamp(message.date_updated),
+            )
+
+
+class FileSinkTransport:
+    """Appends each message as a JSON line to `path` instead of sending it."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def send(self, from_number, to_number, body):
+        sid = 'SK' + uuid.uuid4().hex
+        line = json.dumps({
+            'sid': sid,
+            'from': from_number,
+            'to': to_number,
+            'body': body,
+            'sent_at': utc_timestamp(datetime.now(timezone.utc)),
+        })
+        with self._lock, open(self.path, 'a', encoding='utf-8') as sink:
+            sink.write(line + '\n')
+        return sid
+
+    def fetch_statuses(self, since):
+        since = utc_timestamp(since)
+        try:
+            sink = open(self.path, encoding='utf-8')
+        except FileNotFoundError:
+            return
+        with sink:
+            for line in sink:
+                message = json.loads(line)
+                if message['sent_at'] >= since:
+                    yield message['sid'], 'delivered', None, None, message['sent_at']
+
+
+_MESSAGES_PATH = re.compile(r'^/2010-04-01/Accounts/(?P<account>[^/]+)/Messages(?:/(?P<sid>SM[0-9a-f]+))?\.json$')
+
+# Error code of an undelivered message at the stand-in: unreachable handset
+UNDELIVERED_ERROR_CODE = 30003
+
+
+def _rfc2822(moment):
+    return datetime.fromtimestamp(moment, timezone.utc).strftime('%a, %d %b %Y %H:%M:%S +0000')
+
+
+def _parse_date_sent(value):
+    """Seconds since the epoch of a DateSent filter: a date or ISO datetime, UTC."""
+    moment = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return moment.timestamp()
+
+
+class _StandinHandler(BaseHTTPRequestHandler):
+    server_version = 'TwilioStandin/1.0'
+
+    def do_POST(self):
+        standin = self.server.standin
+        url = urlsplit(self.path)
+        match = _MESSAGES_PATH.match(url.path)
+        if match is None or match['sid']:
+            return self._not_found()
+        form = parse_qs(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8'))
+        outcome = standin.outcome()
+        if standin.latency:
+            time.sleep(standin.latency)
+        if outcome == 'throttled':
+            return self._reply(429, {'code': 20429, 'message': 'Too Many Requests', 'status': 429})
+        if outcome == 'failed':
+            return self._reply(500, {'code': 20500, 'message': 'Internal Server Error', 'status': 500})
+        if not all(form.get(field) for field in ('To', 'From', 'Body')):
+            return self._reply(400, {'code': 21604, 'message': "A 'To', 'From' and 'Body' are required", 'status': 400})
+
+        message = standin.accept(
+            match['account'], form['From'][0], form['To'][0], form['Body'][0],
+            form.get('StatusCallback', [None])[0]
+        )
+        self._reply(201, standin.message_json(message, 'queued'))
+
+    def do_GET(self):
+        standin = self.server.standin
+        url = urlsplit(self.path)
+        match = _MESSAGES_PATH.match(url.path)
+        if match is None:
+            return self._not_found()
+        if match['sid']:
+            message = standin.messages.get(match['sid'])
+            if message is None:
+                return self._not_found()
+            return self._reply(200, standin.message_json(message))
+
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        page = int(query.get('Page', 0))
+        page_size = int(query.get('PageSize', 50))
+        since = _parse_date_sent(query['DateSent>']) if 'DateSent>' in query else 0
+        with standin.lock:
+            standin.counts['pages'] += 1
+            messages = [m for m in standin.messages.values() if m['created'] >= since]
+        chunk = messages[page * page_size:(page + 1) * page_size]
+        more = (page + 1) * page_size < len(messages)
+        self._reply(200, {
+            'messages': [standin.message_json(message) for message in chunk],
+            'page': page,
+            'page_size': page_size,
+            'start': page * page_size,
+            'end': page * page_size + len(chunk) - 1,
+            'uri': self.path,
+            'first_page_uri': f"{url.path}?{urlencode({**query, 'Page': 0})}",
+            'previous_page_uri': f"{url.path}?{urlencode({**query, 'Page': page - 1})}" if page else None,
+            'next_page_uri': f"{url.path}?{urlencode({**query, 'Page': page + 1})}" if more else None,
+        })
+
+    def _not_found(self):
+        self._reply(404, {'code': 20404, 'message': 'The requested resource was not found', 'status': 404})
+
+    def _reply(self, status, payload):
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class LocalTwilioServer:
+    """A local HTTP server answering Twilio's create, fetch and list message calls.
+
+    Each create waits `latency` seconds, then is throttled (429) with
+    probability `throttle_rate`, fails (500) with probability `error_rate`,
+    or is accepted (201). An accepted message reads as sent until
+    `delivery_delay` seconds later, then as delivered, or undelivered with
+    probability `undelivered_rate`; its final status is posted to the
+    message's StatusCallback, signed with `auth_token` when given. `counts`
+    tallies create outcomes and list pages served.
+    """
+
+    def __init__(self, port=0, latency=0.0, error_rate=0.0, throttle_rate=0.0, seed=None,
+                 delivery_delay=0.0, undelivered_rate=0.0, auth_token=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.delivery_delay = delivery_delay
+        self.undelivered_rate = undelivered_rate
+        self.validator = RequestValidator(auth_token) if auth_token else None
+        self.counts = {'accepted': 0, 'throttled': 0, 'failed': 0, 'pages': 0, 'callbacks': 0}
+        self.messages = {}
+        self.lock = threading.Lock()
+        self._random = random.Random(seed)
+        self._httpd = ThreadingHTTPServer(('127.0.0.1', port), _StandinHandler)
+        self._httpd.daemon_threads = True
+        self._httpd.standin = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def outcome(self):
+        with self.lock:
+            draw = self._random.random()
+            if draw < self.throttle_rate:
+                outcome = 'throttled'
+            elif draw < self.throttle_rate + self.error_rate:
+                outcome = 'failed'
+            else:
+                outcome = 'accepted'
+            self.counts[outcome] += 1
+        return outcome
+
+    def accept(self, account_sid, from_number, to_number, body, status_callback=None):
+        """Record an accepted message and schedule its status callback."""
+        with self.lock:
+            undelivered = self._random.random() < self.undelivered_rate
+            message = {
+                'sid': 'SM' + uuid.uuid4().hex,
+                'account_sid': account_sid,
+                'from': from_number,
+                'to': to_number,
+                'body': body,
+                'created': time.time(),
+                'outcome': 'undelivered' if undelivered else 'delivered',
+            }
+            self.messages[message['sid']] = message
+        if status_callback:
+            timer = threading.Timer(self.delivery_delay, self._post_status, (message, status_callback))
+            timer.daemon = True
+            timer.start()
+        return message
+
+    def status(self, message):
+        if time.time() - message['created'] < self.delivery_delay:
+            return 'sent'
+        return message['outcome']
+
+    def message_json(self, message, status=None):
+        status = status or self.status(message)
+        created = _rfc2822(message['created'])
+        final = status in ('delivered', 'undelivered')
+        return {
+            'sid': message['sid'],
+            'account_sid': message['account_sid'],
+            'to': message['to'],
+            'from': message['from'],
+            'body': message['body'],
+            'status': status,
+            'num_segments': '1',
+            'direction': 'outbound-api',
+            'date_created': created,
+            'date_updated': _rfc2822(message['created'] + self.delivery_delay) if final else created,
+            'date_sent': created,
+            'error_code': UNDELIVERED_ERROR_CODE if status == 'undelivered' else None,
+            'error_message': 'Unreachable destination handset' if status == 'undelivered' else None,
+            'price': None,
+            'uri': f"/2010-04-01/Accounts/{message['account_sid']}/Messages/{message['sid']}.json",
+        }
+
+    def _post_status(self, message, url):
+        status = message['outcome']
+        params = {
+            'AccountSid': message['account_sid'],
+            'MessageSid': message['sid'],
+            'SmsSid': message['sid'],
+            'MessageStatus': status,
+            'SmsStatus': status,
+            'From': message['from'],
+            'To': message['to'],
+        }
+        if status == 'undelivered':
+            params['ErrorCode'] = str(UNDELIVERED_ERROR_CODE)
+        headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+        if self.validator:
+            headers['X-Twilio-Signature'] = self.validator.compute_signature(url, params)
+        try:
+            urlopen(Request(url, urlencode(params).encode('utf-8'), headers), timeout=10).close()
+        except OSError as e:
+            print(f"Error posting status callback to {url}: {e}")
+            return
+        with self.lock:
+            self.counts['callbacks'] += 1
+
+    def start(self):
+        """Serve from a background thread; returns self."""
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name='twilio-standin', daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        self._httpd.serve_forever()
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
@@ -0,0 +1,153 @@
+"""Rolling attendance rates over days, months or years.
+
+A rate is present days as a percentage of marked days in a trailing window
+(7, 30 and 90 days by default); days with no marks in the window have no
+rate. Series are computed by SQLite window functions over a calendar of
+days:
+
+- the company series reads the per-day attendance counters kept in
+  dashboard_counters, so it never touches raw attendance;
+- a staff member's series reads their attendance once, as an index range.
+
+Long ranges are downsampled in the same query to at most MAX_POINTS days.
+"""
+from datetime import date, timedelta
+
+import pandas as pd
+import plotly.graph_objects as go
+
+from database import attendance_rows_sql, to_date_str
+
+TREND_WINDOWS = (7, 30, 90)
+
+# Most points a trend series returns; longer ranges keep every n-th day
+MAX_POINTS = 400
+
+# Line colour per window on trend charts, shortest first
+TREND_COLORS = ('#90caf9', '#1976d2', '#0d47a1')
+
+# Daily (day, present, marked) sources for :start..:end
+_COMPANY_DAILY_SQL = '''
+    SELECT
+        period AS day,
+        SUM(CASE WHEN name = 'attendance_present' THEN value END) AS present,
+        SUM(CASE WHEN name = 'attendance_marked' THEN value END) AS marked
+    FROM dashboard_counters
+    WHERE name IN ('attendance_marked', 'attendance_present')
+    AND period BETWEEN :start AND :end
+    GROUP BY period
+'''
+
+_STAFF_DAILY_SQL = '''
+    SELECT date AS day, is_present AS present, 1 AS marked
+    FROM ({rows}) WHERE staff_id = :staff_id
+'''
+
+
+def rate_column(window):
+    return f'rate_{window}d'
+
+
+def trend_step(start, end, max_points=MAX_POINTS):
+    """Days between returned points so start..end has at most max_points."""
+    days = (end - start).days + 1
+    return max(1, -(-days // max_points))
+
+
+def attendance_trend(db, start_date, end_date, staff_id=None, windows=TREND_WINDOWS, max_points=MAX_POINTS):
+    """Rolling attendance rates for start_date..end_date.
+
+    Returns a DataFrame with a `date` column and one rate_<n>d column per
+    window, for the company (visible staff) or for one staff member.
+    """
+    start = date.fromisoformat(to_date_str(start_date))
+    end = date.fromisoformat(to_date_str(end_date))
+    params = {
+        # Read from the leading days so the first windows are full
+        'start': (start - timedelta(days=max(windows) - 1)).isoformat(),
+        'since': start.isoformat(),
+        'end': end.isoformat(),
+        'step': trend_step(start, end, max_points),
+        'staff_id': staff_id,
+    }
+    rates = ',\n'.join(
+        f'''100.0 * SUM(daily.present) OVER (ORDER BY days.day ROWS {window - 1} PRECEDING)
+            / NULLIF(SUM(daily.marked) OVER (ORDER BY days.day ROWS {window - 1} PRECEDING), 0)
+            AS {rate_column(window)}'''
+        for window in windows
+    )
+
+    conn = db.get_connection()
+    if staff_id is None:
+        daily_sql = _COMPANY_DAILY_SQL
+    else:
+        daily_sql = _STAFF_DAILY_SQL.format(rows=attendance_rows_sql(conn))
+    return pd.read_sql_query(f'''
+        WITH RECURSIVE days(day) AS (
+            SELECT :start
+            UNION ALL
+            SELECT date(day, '+1 day') FROM days WHERE day < :end
+        ),
+        daily AS ({daily_sql}),
+        series AS (
+            SELECT days.day AS date, {rates}
+            FROM days
+            LEFT JOIN daily ON daily.day = days.day
+        )
+        SELECT * FROM series
+        WHERE date >= :since
+        AND (CAST(julianday(date) - julianday(:since) AS INTEGER) % :step = 0 OR date = :end)
+        ORDER BY date
+    ''', conn, params=params, parse_dates=['date'])
+
+
+def staff_rolling_rates(db, end_date=None, windows=TREND_WINDOWS):
+    """Each visible staff member's rates over the windows ending at end_date
+    (default: today), ordered by name. Reads the longest window's
+    attendance once."""
+    end = date.fromisoformat(to_date_str(end_date or date.today()))
+    params = {
+        'start': (end - timedelta(days=max(windows) - 1)).isoformat(),
+        'end': end.isoformat(),
+    }
+    rates = []
+    for window in windows:
+        params[f'from_{window}'] = (end - timedelta(days=window - 1)).isoformat()
+        rates.append(
+            f'''100.0 * SUM(a.is_present) FILTER (WHERE a.date >= :from_{window})
+                / NULLIF(COUNT(a.date) FILTER (WHERE a.date >= :from_{window}), 0)
+                AS {rate_column(window)}'''
+        )
+
+    conn = db.get_connection()
+    # Joined from staff so the rows store is read by (staff_id, date) seeks
+    return pd.read_sql_query(f'''
+        SELECT s.id, s.name, {', '.join(rates)}
+        FROM staff s
+        LEFT JOIN ({attendance_rows_sql(conn)}) a ON a.staff_id = s.id
+        WHERE s.hidden IS NULL OR s.hidden = 0
+        GROUP BY s.id
+        ORDER BY s.name, s.id
+    ''', conn, params=params)
+
+
+def trend_figure(trend, windows=TREND_WINDOWS):
+    """A plotly line chart of an attendance_trend() frame."""
+    fig = go.Figure()
+    for window, color in zip(windows, TREND_COLORS):
+        fig.add_trace(go.Scatter(
+            x=trend['date'],
+            y=trend[rate_column(window)],
+            name=f'{window}-day',
+            mode='lines',
+            line=dict(color=color),
+            connectgaps=False,
+            hovertemplate='%{x|%d %b %Y}: %{y:.1f}%<extra>' + f'{window}-day</extra>',
+        ))
+    fig.update_layout(
+        yaxis=dict(title='Attendance rate (%)', range=[0, 100]),
+        margin=dict(l=10, r=10, t=10, b=10),
+        legend=dict(orientation='h', y=1.1),
+        hovermode='x unified',
+    )
+    return fig